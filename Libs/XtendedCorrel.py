@@ -1,20 +1,23 @@
 import pandas as pd
 import numpy as np
 from scipy.stats import rankdata
-from scipy.signal import decimate
 import math
-import time
-import matplotlib.pyplot as plt
-from sklearn.preprocessing import KBinsDiscretizer
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
+N_BINS = 50
+MAX_SAMPLES = 99999
+# Hoeffding's D is undefined below 5 samples (its denominator is N*(N-1)*(N-2)*(N-3)*(N-4))
+MIN_SAMPLES = 5
+
+
 def hoeffding(*arg):
-  
+
     if(len(arg)==1):
       if isinstance(arg[0], pd.DataFrame):
         if(arg[0].shape[0]>1):
-          return arg[0].apply(lambda x: arg[0].apply(lambda y: hoeffding(x.values, y.values)))
+          matrix = hoeffding_matrix(arg[0].values, arg[0].values)
+          return pd.DataFrame(matrix, index=arg[0].columns, columns=arg[0].columns)
     else:
       if(len(arg)==2):
         if type(arg[0]) is not np.ndarray:
@@ -23,90 +26,184 @@ def hoeffding(*arg):
         if type(arg[1]) is np.ndarray:
           if (len(arg[0].shape)>1):
             return print("ERROR inputs : hoeffding(df >2col) or hoeffding(numpy.array -1d- ,numpy.array -1d-)")
-        
-        xin=arg[0]
-        yin=arg[1]
-        #crop data to the smallest array, length have to be equal
-        if len(xin)<len(yin):
-          yin=yin[:len(xin)]
-        if len(xin)>len(yin):
-          xin=xin[:len(yin)]
-
-        # dropna
-        x = xin[~(np.isnan(xin) | np.isnan(yin))]
-        y = yin[~(np.isnan(xin) | np.isnan(yin))]
-
-        # undersampling if length too long
-        lenx=len(x)
-        if lenx>99999:
-            factor=math.ceil(lenx/100000)
-            x=x[::factor]
-            y=y[::factor]
-
-        # bining if too much "definition"
-        if len(np.unique(x))>50:
-            est = KBinsDiscretizer(n_bins=50, encode='ordinal', strategy='quantile') #faster strategy='quantile' but less accurate
-            est.fit(x.reshape(-1, 1))  
-            Rtemp = est.transform(x.reshape(-1, 1))
-            R=rankdata(Rtemp)
-        else:
-            R=rankdata(x)
-        if len(np.unique(y))>50:
-            est1 = KBinsDiscretizer(n_bins=50, encode='ordinal', strategy='quantile') #faster strategy='quantile' but less accurate
-            est1.fit(y.reshape(-1, 1))  
-            Stemp = est1.transform(y.reshape(-1, 1))
-            S=rankdata(Stemp)
+
+        x, y = hoeffding_samples(arg[0], arg[1])
+
+        R = hoeffding_ranks(x)
+        S = hoeffding_ranks(y)
+
+        return hoeffding_d(R, S)
+      return print("ERROR inputs : hoeffding(df >2col) or hoeffding(numpy.array -1d- ,numpy.array -1d-)")
+
+
+def hoeffding_samples(xin, yin):
+    """
+    Crop to the same length, drop the pairs with NaN and undersample if too long
+    """
+    #crop data to the smallest array, length have to be equal
+    if len(xin)<len(yin):
+      yin=yin[:len(xin)]
+    if len(xin)>len(yin):
+      xin=xin[:len(yin)]
+
+    # dropna
+    x = xin[~(np.isnan(xin) | np.isnan(yin))]
+    y = yin[~(np.isnan(xin) | np.isnan(yin))]
+
+    return undersample(x), undersample(y)
+
+
+def undersample(x):
+    # undersampling if length too long
+    lenx=len(x)
+    if lenx>MAX_SAMPLES:
+        factor=math.ceil(lenx/100000)
+        x=x[::factor]
+    return x
+
+
+def quantile_bins(x, n_bins=N_BINS):
+    """
+    Ordinal bin of each value, same as KBinsDiscretizer(n_bins, encode='ordinal', strategy='quantile').fit_transform
+    """
+    bin_edges = np.asarray(np.percentile(x, np.linspace(0, 100, n_bins + 1)))
+    # Remove bins whose width are too small (i.e., <= 1e-8)
+    bin_edges = bin_edges[np.ediff1d(bin_edges, to_begin=np.inf) > 1e-8]
+    return np.searchsorted(bin_edges[1:-1], x, side="right").astype(np.float64)
+
+
+def hoeffding_ranks(x, n_bins=N_BINS):
+    # bining if too much "definition"
+    if len(np.unique(x))>n_bins:
+        return rankdata(quantile_bins(x, n_bins))
+    return rankdata(x)
+
+
+def hoeffding_d(R, S, r_codes=None, s_codes=None):
+    """
+    Hoeffding's D from the ranks, using the contingency table of the (few) distinct ranks: O(N + B^2)
+    :param r_codes, s_codes: index of each rank among the sorted distinct ranks, computed if not given
+    """
+    if len(R) < MIN_SAMPLES:
+        return np.nan
+
+    if r_codes is None:
+        r_codes = np.unique(R, return_inverse=True)[1]
+    if s_codes is None:
+        s_codes = np.unique(S, return_inverse=True)[1]
+
+    n_r = int(r_codes.max()) + 1
+    n_s = int(s_codes.max()) + 1
+
+    table = np.bincount(r_codes * n_s + s_codes, minlength=n_r * n_s).reshape(n_r, n_s)
+
+    # cumulative counts strictly below the cell in R, in S, and in both
+    below_r = np.zeros_like(table)
+    below_r[1:, :] = np.cumsum(table, axis=0)[:-1, :]
+    below_s = np.zeros_like(table)
+    below_s[:, 1:] = np.cumsum(table, axis=1)[:, :-1]
+    below_both = np.zeros_like(table)
+    below_both[1:, 1:] = np.cumsum(np.cumsum(table, axis=0), axis=1)[:-1, :-1]
+
+    # Same operations, in the same order, as the per-sample loop of hoeffding_d_loop()
+    Q_table = 1.0 + below_both + 1/4 * (table - 1) + 1/2 * below_s + 1/2 * below_r
+    Q = Q_table[r_codes, s_codes]
+
+    return hoeffding_statistic(Q, R, S)
+
+
+def hoeffding_statistic(Q, R, S):
+
+    N=R.shape
+
+    D1 = np.sum( np.multiply((Q-1),(Q-2)) );
+    D2 = np.sum( np.multiply(np.multiply((R-1),(R-2)),np.multiply((S-1),(S-2)) ) );
+    D3 = np.sum( np.multiply(np.multiply((R-2),(S-2)),(Q-1)) );
+
+    D = 30*((N[0]-2)*(N[0]-3)*D1 + D2 - 2*(N[0]-2)*D3) / (N[0]*(N[0]-1)*(N[0]-2)*(N[0]-3)*(N[0]-4));
+
+    return D
+
+
+def hoeffding_d_loop(R, S):
+    """
+    Original per-sample implementation, kept as reference for equivalence checks
+    """
+    N=R.shape
+    if N[0] < MIN_SAMPLES:
+        return np.nan
+
+    dico={(np.nan,np.nan):np.nan}
+    dicoRin={np.nan:np.nan}
+    dicoSin={np.nan:np.nan}
+    dicoRless={np.nan:np.nan}
+    dicoSless={np.nan:np.nan}
+    Q=np.ones(N[0])
+
+    i=0;
+    for r,s in np.nditer([R,S]):
+        r=float(r)
+        s=float(s)
+        if (r,s) in dico.keys():
+            Q[i]=dico[(r,s)]
         else:
-            S=rankdata(y)      
-
-        # core processing
-        N=x.shape
-        dico={(np.nan,np.nan):np.nan}
-        dicoRin={np.nan:np.nan}
-        dicoSin={np.nan:np.nan}
-        dicoRless={np.nan:np.nan}
-        dicoSless={np.nan:np.nan}
-        Q=np.ones(N[0])
-
-        i=0;
-        for r,s in np.nditer([R,S]):
-            r=float(r)
-            s=float(s)
-            if (r,s) in dico.keys():
-                Q[i]=dico[(r,s)]
+          if r in dicoRin.keys():
+              isinR=dicoRin[r]
+              lessR=dicoRless[r]
+          else:
+              isinR=np.isin(R,r)
+              dicoRin[r]=isinR
+              lessR=np.less(R,r)
+              dicoRless[r]=lessR
+
+          if s in dicoSin.keys():
+              isinS=dicoSin[s]
+              lessS=dicoSless[s]
+          else:
+              isinS=np.isin(S,s)
+              dicoSin[s]=isinS
+              lessS=np.less(S,s)
+              dicoSless[s]=lessS
+
+
+          Q[i] = Q[i] + np.count_nonzero(lessR & lessS) \
+                + 1/4 * (np.count_nonzero(isinR & isinS)-1) \
+                + 1/2 * (np.count_nonzero(isinR & lessS)) \
+                 + 1/2 * (np.count_nonzero(lessR & isinS))
+          dico[(r,s)]=Q[i]
+        i+=1
+
+    return hoeffding_statistic(Q, R, S)
+
+
+def hoeffding_matrix(matrix1, matrix2):
+    """
+    Hoeffding's D of every column of matrix1 with every column of matrix2
+    Columns without NaN are binned and ranked once, pairs involving NaN go through hoeffding()
+    :return: array (columns1, columns2)
+    """
+    matrix1 = np.asarray(matrix1, dtype=np.float64)
+    matrix2 = np.asarray(matrix2, dtype=np.float64)
+
+    length = min(matrix1.shape[0], matrix2.shape[0])
+    matrix1 = matrix1[:length]
+    matrix2 = matrix2[:length]
+
+    def column_ranks(column):
+        if np.isnan(column).any():
+            return None
+        R = hoeffding_ranks(undersample(column))
+        return R, np.unique(R, return_inverse=True)[1]
+
+    ranks1 = [column_ranks(matrix1[:, i]) for i in range(matrix1.shape[1])]
+    ranks2 = [column_ranks(matrix2[:, j]) for j in range(matrix2.shape[1])]
+
+    matrix = np.empty((matrix1.shape[1], matrix2.shape[1]))
+    for i in range(matrix1.shape[1]):
+        for j in range(matrix2.shape[1]):
+            if ranks1[i] is None or ranks2[j] is None:
+                matrix[i, j] = hoeffding(matrix1[:, i], matrix2[:, j])
             else:
-              if r in dicoRin.keys():
-                  isinR=dicoRin[r]
-                  lessR=dicoRless[r]
-              else:
-                  isinR=np.isin(R,r)
-                  dicoRin[r]=isinR
-                  lessR=np.less(R,r)
-                  dicoRless[r]=lessR
-
-              if s in dicoSin.keys():
-                  isinS=dicoSin[s]
-                  lessS=dicoSless[s]
-              else:
-                  isinS=np.isin(S,s)
-                  dicoSin[s]=isinS
-                  lessS=np.less(S,s)
-                  dicoSless[s]=lessS
-
-
-              Q[i] = Q[i] + np.count_nonzero(lessR & lessS) \
-                    + 1/4 * (np.count_nonzero(isinR & isinS)-1) \
-                    + 1/2 * (np.count_nonzero(isinR & lessS)) \
-                     + 1/2 * (np.count_nonzero(lessR & isinS)) 
-              dico[(r,s)]=Q[i]
-            i+=1
-
-        D1 = np.sum( np.multiply((Q-1),(Q-2)) );
-        D2 = np.sum( np.multiply(np.multiply((R-1),(R-2)),np.multiply((S-1),(S-2)) ) );
-        D3 = np.sum( np.multiply(np.multiply((R-2),(S-2)),(Q-1)) );
-
-        D = 30*((N[0]-2)*(N[0]-3)*D1 + D2 - 2*(N[0]-2)*D3) / (N[0]*(N[0]-1)*(N[0]-2)*(N[0]-3)*(N[0]-4));
-
-
-        return D
-      return print("ERROR inputs : hoeffding(df >2col) or hoeffding(numpy.array -1d- ,numpy.array -1d-)")
\ No newline at end of file
+                matrix[i, j] = hoeffding_d(ranks1[i][0], ranks2[j][0], ranks1[i][1], ranks2[j][1])
+
+    return matrix
@@ -18,6 +18,17 @@ project_structure_path = BIN_PATH / "project_structure.json"
 ALLOWED_DECIMALS = 4
 EPSILON = 1e-10 # CONSTANT TO AVOID DIVISION BY ZERO
 
+# Zones of the tank, split on the side view by UPPER and LOWER
+ZONES = ["TOP", "MID", "BOT"]
+
+# Speed classes (cm/s): Freezing < 1 <= Swimming < 10 <= Rapid Movement
+SPEED_THRESHOLDS = (1, 10)
+# Angular velocity classes (degree/s): Slow <= 90 < Fast
+ANGULAR_VELOCITY_THRESHOLD = 90
+
+# Storage type of the per-frame series kept by the result classes (Distance, Speed, ...), "float32" halves their memory
+SERIES_DTYPE = "float64"
+
 
 ORDINALS = ['1st', '2nd', '3rd', '4th', '5th', '6th', '7th', '8th', '9th']
 CHARS = [chr(i) for i in range(65, 65+26)]
@@ -26,3 +37,11 @@ CHARS = [chr(i) for i in range(65, 65+26)]
 FISH_KEY_FORMAT = "Fish {}"
 SAVED_TRAJECTORY_FORMAT = "Fish {}.csv"
 
+# "csv" : one .csv per fish (default)
+# "npy" : one .npy array per fish + .json metadata, loaded with memory mapping
+TRAJECTORY_STORES = ["csv", "npy"]
+
+
+# "full"        : match Side View and Top View trajectories on every frame (default)
+# "progressive" : match on a decimated sample, using more frames only while the assignment is ambiguous
+MATCHING_MODES = ["full", "progressive"]
@@ -1,42 +1,61 @@
 from pathlib import Path
 import math
+import hashlib
+import numpy as np
 import pandas as pd
 
 
 from Libs.general import Loader, Time, Events, Area, Distance, Speed, Angle, Speed_A
-from Libs.misc import compute_turning_angle, event_extractor, FD_Entropy_Calculator, HullVolumeCalculator, calculate_turning_angle
-from . import ALLOWED_DECIMALS
+from Libs.misc import compute_turning_angle, bouts, FD_Entropy_Calculator, HullVolumeCalculator, ShoalDistanceCalculator, ShoalHeadingCalculator, calculate_turning_angle, speed_outlier_replacer, params_hash
+from . import ALLOWED_DECIMALS, ZONES, SPEED_THRESHOLDS
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+# "numpy" : vectorized kernels (default)
+# "loop"  : original frame-by-frame implementation, kept as reference for equivalence checks
+ENGINES = ["numpy", "loop"]
+
+# Endpoints are calculated (and cached) by group, each group only depends on the trajectory and these parameters
+GROUP_PARAMETERS = {"kinematics": ["CONVERSION TV", "FRAME RATE", "DURATION"],
+                    "angle": ["CONVERSION TV", "FRAME RATE"],
+                    "zone": ["UPPER", "LOWER", "CONVERSION TV", "FRAME RATE", "DURATION"],
+                    "center": ["CENTER X", "CENTER Y", "CENTER Z", "CONVERSION TV"],
+                    "complexity": []}
+ENDPOINT_GROUPS = list(GROUP_PARAMETERS.keys())
+
+# Names of the speed classes delimited by SPEED_THRESHOLDS
+SPEED_CLASSES = ["FREEZING", "SWIMMING", "RAPID"]
+
+# Increase when the calculation of cached endpoints changes
+ENDPOINT_CACHE_VERSION = 4
+
+
 class GeneralAnalysis(Loader):
-    def __init__(self, project_dir, batch_num, treatment_char, fish_num, params):
+    def __init__(self, project_dir, batch_num, treatment_char, fish_num, params, engine="numpy", store="csv"):
         super().__init__(project_dir = project_dir, 
                          batch_num=batch_num, 
                          treatment_char=treatment_char, 
                          fish_num=fish_num,
-                         params = params
+                         params = params,
+                         store = store
                          )
 
+        assert engine in ENGINES, f"engine must be one of {ENGINES}"
+        self.engine = engine
+
         self.TJ_df = self.FISH
         
         # self.BasicCalculation()
 
-    
-    def BasicCalculation(self, DEFAULT_INTERVAL = 1):
-
-        if DEFAULT_INTERVAL > self.PARAMS["FRAME RATE"]:
-            logger.error(f"User set {DEFAULT_INTERVAL=} but {self.PARAMS['FRAME RATE']=} is smaller than {DEFAULT_INTERVAL=}. Please check the code.")
-            raise Exception(f"{self.PARAMS['FRAME RATE']=} is smaller than {DEFAULT_INTERVAL=}. Please check the code.")
-
-        if self.PARAMS["FRAME RATE"] % DEFAULT_INTERVAL != 0:
-            logger.error(f"User set {DEFAULT_INTERVAL=} but {self.PARAMS['FRAME RATE']=} is not divisible by {DEFAULT_INTERVAL=}. Please check the code.")
-            raise Exception(f"{self.PARAMS['FRAME RATE']=} is not divisible by {DEFAULT_INTERVAL=}. Please check the code.")
-
 
+    def Kinematics_Reference(self):
+        """
+        Frame-by-frame reference implementation of distance, raw speed and position zoning
+        :return: distance_list (cm), speed_list (cm/s, before outlier replacement), positions
+        """
         distance_list = []
 
         for i in range(len(self.TJ_df)-1):
@@ -51,43 +70,150 @@ class GeneralAnalysis(Loader):
             distance_list.append(dist)
             # UNIT: cm
 
-        self.distance = Distance(distance_list = distance_list)
-
-        #####################################################################################
-
-        SPEED_THRESHOLD = 50
         speed_list = []
-        replace_count = 0
         for i in range(len(distance_list)):
             # Speed = Distance/Time
             speed = distance_list[i]/(1/self.PARAMS["FRAME RATE"])
-            if speed >= SPEED_THRESHOLD:
-                # logger.debug(f"Speed of {speed} cm/s detected at frame {i} (index {i+1})")
-                # Find the nearest frame with speed < SPEED_THRESHOLD
-                for j in range(i-1, 0, -1):
-                    if speed_list[j] < SPEED_THRESHOLD:
-                        # Replace the speed with the nearest frame
-                        speed = speed_list[j]
-                        # logger.debug(f"Speed replaced with {speed} cm/s at frame {j} (index {j+1})")
-                        replace_count += 1
-                        break
-            
             speed_list.append(speed)
             # UNIT: cm/s
 
+        positions = []
+        for z_sv in self.TJ_df['Z_SV'].tolist():
+            if z_sv < self.PARAMS["UPPER"]:
+                positions.append("TOP")
+            elif z_sv > self.PARAMS["LOWER"]:
+                positions.append("BOT")
+            else:
+                positions.append("MID")
+
+        return distance_list, speed_list, positions
+    
+
+    def Kinematics_Vectorized(self):
+        """
+        Vectorized equivalent of Kinematics_Reference(), produces identical values
+        :return: distance_list (cm), speed_list (cm/s, before outlier replacement), positions
+        """
+        coords = self.TJ_df[['X', 'Y', 'Z']].to_numpy(dtype=float)
+        steps = np.diff(coords, axis=0)
+
+        # float_power mirrors the scalar x**2 (C pow) of the reference loop, np.square/np.hypot can differ by 1 ulp
+        squared = np.float_power(steps, 2)
+        distances = np.sqrt(squared[:, 0] + squared[:, 1] + squared[:, 2])
+        distances = distances/self.PARAMS["CONVERSION TV"]
+        speeds = distances/(1/self.PARAMS["FRAME RATE"])
+
+        z_sv = self.TJ_df['Z_SV'].to_numpy(dtype=float)
+        positions = np.full(z_sv.shape, "MID", dtype=object)
+        positions[z_sv > self.PARAMS["LOWER"]] = "BOT"
+        positions[z_sv < self.PARAMS["UPPER"]] = "TOP"
+
+        return distances.tolist(), speeds.tolist(), positions.tolist()
+
+    
+    def Group_Keys(self, AV_interval = 1):
+        """
+        Cache key of each endpoint group: hash of the trajectory + the parameters the group depends on
+        :return: dict group -> key
+        """
+        coords = np.ascontiguousarray(self.TJ_df[['X', 'Y', 'Z', 'Z_SV']].to_numpy(dtype=np.float64))
+        trajectory_hash = hashlib.sha1(coords.tobytes()).hexdigest()
+
+        keys = {}
+        for group in ENDPOINT_GROUPS:
+            depends_on = {"trajectory": trajectory_hash, 
+                          "group": group, 
+                          "version": ENDPOINT_CACHE_VERSION}
+            for param in GROUP_PARAMETERS[group]:
+                depends_on[param] = self.PARAMS[param]
+            if group == "angle":
+                depends_on["AV INTERVAL"] = AV_interval
+            keys[group] = params_hash(depends_on)
+
+        return keys
+
+
+    def BasicCalculation(self, DEFAULT_INTERVAL = 1, groups = None):
+        """
+        :param groups: endpoint groups to calculate (see ENDPOINT_GROUPS), None = all
+        """
+        if groups == None:
+            groups = ENDPOINT_GROUPS
+
+        if "angle" in groups:
+            self.Interval_Check(DEFAULT_INTERVAL)
+
+        if "kinematics" in groups or "angle" in groups or "zone" in groups:
+            self.Kinematics_Section()
+
+        if "angle" in groups:
+            self.Angle_Section(DEFAULT_INTERVAL)
+
+        if "zone" in groups:
+            self.Zone_Section()
+
+        if "center" in groups:
+            self.Center_Section()
+
+        if "complexity" in groups:
+            self.Complexity_Section()
+
+
+    def Interval_Check(self, DEFAULT_INTERVAL):
+
+        if DEFAULT_INTERVAL > self.PARAMS["FRAME RATE"]:
+            logger.error(f"User set {DEFAULT_INTERVAL=} but {self.PARAMS['FRAME RATE']=} is smaller than {DEFAULT_INTERVAL=}. Please check the code.")
+            raise Exception(f"{self.PARAMS['FRAME RATE']=} is smaller than {DEFAULT_INTERVAL=}. Please check the code.")
+
+        if self.PARAMS["FRAME RATE"] % DEFAULT_INTERVAL != 0:
+            logger.error(f"User set {DEFAULT_INTERVAL=} but {self.PARAMS['FRAME RATE']=} is not divisible by {DEFAULT_INTERVAL=}. Please check the code.")
+            raise Exception(f"{self.PARAMS['FRAME RATE']=} is not divisible by {DEFAULT_INTERVAL=}. Please check the code.")
+
+
+    def Kinematics_Section(self):
+
+        if self.engine == "numpy":
+            self.distance_list, raw_speed_list, self.positions = self.Kinematics_Vectorized()
+        else:
+            self.distance_list, raw_speed_list, self.positions = self.Kinematics_Reference()
+
+        self.distance = Distance(distance_list = self.distance_list)
+
+        #####################################################################################
+
+        SPEED_THRESHOLD = 50
+        speed_list, replace_count, outlier_runs = speed_outlier_replacer(raw_speed_list, threshold = SPEED_THRESHOLD)
+        # UNIT: cm/s
+
+        self.speed_outliers = {"replace_count": replace_count,
+                               "run_lengths": outlier_runs.tolist()}
+
         logger.debug(f"Speed replaced {replace_count} times due to speed > {SPEED_THRESHOLD} cm/s")
+        if len(outlier_runs) > 0:
+            logger.debug(f"{len(outlier_runs)} outlier runs, longest = {outlier_runs.max()} frames")
 
         self.speed = Speed(speed_list = speed_list,
                            total_frames=self.TOTAL_FRAMES)
 
-        #####################################################################################
+        # Bouts of every speed class, (starts, lengths) in frames. Same classes as Speed.Classifier()
+        speed_classes = np.searchsorted(SPEED_THRESHOLDS, speed_list, side="right")
+        class_bouts = bouts(speed_classes, range(len(SPEED_CLASSES)))
+        self.speed_bouts = {name: class_bouts[i] for i, name in enumerate(SPEED_CLASSES)}
+
+        self.freezing_bouts = len(self.speed_bouts["FREEZING"][0])
+        self.rapid_bouts = len(self.speed_bouts["RAPID"][0])
+        freezing_durations = self.Bout_Durations("FREEZING")
+        self.freezing_bout_avg = freezing_durations.mean() if len(freezing_durations) > 0 else 0
+
+
+    def Angle_Section(self, DEFAULT_INTERVAL = 1):
 
         # We only care about the turning angle of the fish on XY plane
         # We don't care about the turning angle of the fish on Z axis
         # Because the fish is not supposed to turn on Z axis
 
-        turning_angle = TurningAngles(X_coords = self.TJ_df['X'].tolist(),
-                                      Y_coords = self.TJ_df['Y'].tolist())
+        turning_angle = TurningAngles(X_coords = self.TJ_df['X'].to_numpy(),
+                                      Y_coords = self.TJ_df['Y'].to_numpy())
         
         
         self.turning_angle = Angle(angle_class = turning_angle, 
@@ -98,72 +224,156 @@ class GeneralAnalysis(Loader):
         
         self.meandering = self.turning_angle.total / self.distance.total * 100
 
-        #####################################################################################
 
-        self.time_in_top = 0
-        self.time_in_middle = 0
-        self.time_in_bottom = 0
+    def Turning_Angle(self, interval = 1):
+        """
+        self.turning_angle at the given interval, calculated on demand (it is skipped when the angle endpoints are cached)
+        """
+        if hasattr(self, "turning_angle"):
+            self.turning_angle.set_interval(interval=interval)
+        elif hasattr(self, "distance"):
+            self.Angle_Section(interval)
+        else:
+            self.BasicCalculation(interval, groups = ["angle"])
 
-        self.positions = []
+        return self.turning_angle
 
-        for z_sv in self.TJ_df['Z_SV'].tolist():
-            if z_sv < self.PARAMS["UPPER"]:
-                self.time_in_top += 1
-                self.positions.append("TOP")
-            elif z_sv > self.PARAMS["LOWER"]:
-                self.time_in_bottom += 1
-                self.positions.append("BOT")
-            else:
-                self.time_in_middle += 1
-                self.positions.append("MID")
-
-        self.time_in_top = self.time_in_top / self.TOTAL_FRAMES * 100
-        self.time_in_middle = self.time_in_middle / self.TOTAL_FRAMES * 100
-        self.time_in_bottom = self.time_in_bottom / self.TOTAL_FRAMES * 100
-
-        try:
-            travel_in_TOP_dict = event_extractor(self.positions, "TOP")
-            travel_in_TOP_dict = {k: v/self.PARAMS["FRAME RATE"] for k, v in travel_in_TOP_dict.items()}
-        except:
-            # find unique values in self.positions
-            unique_values = list(set(self.positions))
-            # count the number of each unique value
-            counts = {}
-            for value in unique_values:
-                counts[value] = self.positions.count(value)
-
-            message = f"self.position does not have 'TOP' value. It has "
-            for value, count in counts.items():
-                message += f"{value} : {count}; "
-            logger.debug(message)
-
-            if len(self.positions) == self.TOTAL_FRAMES:
-                travel_in_TOP_dict = {"-1" : -1}
-                logger.debug("set travel_in_TOP_dict to {-1}:-1, so that the program can continue.")
-            else:
+
+    def Release(self):
+        """
+        Drop the per-frame series once the endpoints are calculated, only the summaries (and TJ_df) are kept.
+        Turning_Angle() still recalculates the angles of any interval
+        """
+        for name in ["distance", "speed", "turning_angle", "distance_in_TOP", "distance_to_center"]:
+            if hasattr(self, name):
+                getattr(self, name).drop_series()
+
+        for name in ["distance_list", "positions", "zone_bouts", "speed_bouts"]:
+            if hasattr(self, name):
+                delattr(self, name)
+
+
+    def Zone_Section(self):
+
+        # Bouts of every zone, (starts, lengths) in frames
+        self.zone_bouts = bouts(self.positions, ZONES)
+        frames_in = {zone: int(lengths.sum()) for zone, (_, lengths) in self.zone_bouts.items()}
+
+        self.time_in_top = frames_in["TOP"] / self.TOTAL_FRAMES * 100
+        self.time_in_middle = frames_in["MID"] / self.TOTAL_FRAMES * 100
+        self.time_in_bottom = frames_in["BOT"] / self.TOTAL_FRAMES * 100
+
+        top_starts, top_lengths = self.zone_bouts["TOP"]
+
+        if len(top_starts) == 0:
+            logger.debug(f"self.position does not have 'TOP' value. It has {frames_in}")
+
+            if len(self.positions) != self.TOTAL_FRAMES:
                 raise Exception("There were something wrong with the position counting step. Please check the code.")
             
-        if len(travel_in_TOP_dict) == 0:
             travel_in_TOP_dict = {"-1" : -1}
-            logger.debug("Empty travel_in_TOP_dict, set travel_in_TOP_dict to {-1}:-1, so that the program can continue.")
+            logger.debug("set travel_in_TOP_dict to {-1}:-1, so that the program can continue.")
+        else:
+            travel_in_TOP_dict = {(start, start + length - 1): length/self.PARAMS["FRAME RATE"] 
+                                  for start, length in zip(top_starts.tolist(), top_lengths.tolist())}
 
         self.travel_in_TOP = Events(event_dict = travel_in_TOP_dict, duration=self.PARAMS["DURATION"])
 
-        #####################################################################################
+        # UNIT: s, the whole duration if the fish never went to the top
+        if len(top_starts) == 0:
+            self.latency_to_top = self.PARAMS["DURATION"]
+        else:
+            self.latency_to_top = top_starts[0] / self.PARAMS["FRAME RATE"]
 
-        distance_to_center_list = self.distance_to(TARGET="CENTER")
-        self.distance_to_center = Distance(distance_list = distance_to_center_list)
+        top_durations = self.Bout_Durations("TOP")
+        self.top_bout_avg = top_durations.mean() if len(top_durations) > 0 else 0
+        self.top_bout_longest = top_durations.max() if len(top_durations) > 0 else 0
 
         #####################################################################################
 
-        distance_in_TOP = self.distance_in(distance_list, self.positions, "TOP")
+        distance_in_TOP = self.distance_in(self.distance_list, self.positions, "TOP")
         self.distance_in_TOP = Distance(distance_list = distance_in_TOP)
 
-        #####################################################################################
 
-        self.fractal_dimension, self.entropy = FD_Entropy_Calculator(self.TJ_df)
+    def Time_Bins(self, bin_seconds = 60):
+        """
+        Endpoints of every time bin, all bins calculated at once with np.add.reduceat over the per-frame arrays.
+        A step (distance, speed) belongs to the bin of the frame it starts from, an entry to the bin of its first frame.
+        The percentages divide by the frames of the bin, Average Speed by its steps (one less in the last bin)
+        :param bin_seconds: bin duration (s), the last bin may be shorter
+        :return: DataFrame, one row per bin
+        """
+        if not hasattr(self, "distance_list") or self.speed.list is None:
+            self.Kinematics_Section()
+        if not hasattr(self, "zone_bouts"):
+            self.zone_bouts = bouts(self.positions, ZONES)
 
-        #####################################################################################
+        FRAME_RATE = self.PARAMS["FRAME RATE"]
+        bin_frames = int(round(bin_seconds * FRAME_RATE))
+        if bin_frames < 1:
+            raise ValueError(f"Time bins of {bin_seconds} s are shorter than one frame")
+
+        total_frames = len(self.positions)
+        bin_starts = np.arange(0, total_frames, bin_frames)
+        frames_per_bin = np.diff(np.append(bin_starts, total_frames))
+
+        def bin_sums(values):
+            # values has one entry per frame (or per step, one less), empty bins sum to 0
+            values = np.asarray(values, dtype=np.float64)
+            starts = bin_starts[bin_starts < len(values)]
+            sums = np.zeros(len(bin_starts))
+            if len(starts) > 0:
+                sums[:len(starts)] = np.add.reduceat(values, starts)
+            return sums
+
+        distances = np.asarray(self.distance_list, dtype=np.float64)
+        speeds = np.asarray(self.speed.list, dtype=np.float64)
+        speed_classes = np.searchsorted(SPEED_THRESHOLDS, speeds, side="right")
+        positions = np.asarray(self.positions)
+
+        steps_per_bin = bin_sums(np.ones(len(speeds)))
+
+        time_bins = {"Distance (cm)": bin_sums(distances),
+                     "Average Speed (cm/s)": bin_sums(speeds) / np.maximum(steps_per_bin, 1)}
+
+        for speed_class, name in zip(range(len(SPEED_CLASSES)), ["Freezing Time (%)", "Swimming Time (%)", "Rapid Movement Time (%)"]):
+            time_bins[name] = bin_sums(speed_classes == speed_class) / frames_per_bin * 100
+
+        for zone, name in zip(ZONES, ["Time in Top (%)", "Time in Middle (%)", "Time in Bottom (%)"]):
+            time_bins[name] = bin_sums(positions == zone) / frames_per_bin * 100
+
+        top_starts, _ = self.zone_bouts["TOP"]
+        time_bins["Entries to the Top (times)"] = np.bincount(top_starts // bin_frames, minlength=len(bin_starts))
+
+        bin_labels = [f"{start / FRAME_RATE:g}-{(start + frames) / FRAME_RATE:g} s" for start, frames in zip(bin_starts, frames_per_bin)]
+
+        return pd.DataFrame(time_bins, index=pd.Index(bin_labels, name="Time Bin")).round(ALLOWED_DECIMALS)
+
+
+    def Bout_Durations(self, name):
+        """
+        :param name: a zone (see ZONES) or a speed class ("FREEZING", "SWIMMING", "RAPID")
+        :return: duration of every bout, s
+        """
+        if name in getattr(self, "zone_bouts", {}):
+            _, lengths = self.zone_bouts[name]
+        elif name in getattr(self, "speed_bouts", {}):
+            _, lengths = self.speed_bouts[name]
+        else:
+            raise KeyError(f"No bouts calculated for {name}")
+
+        return lengths / self.PARAMS["FRAME RATE"]
+
+
+    def Center_Section(self):
+
+        distance_to_center_list = self.distance_to(TARGET="CENTER")
+        self.distance_to_center = Distance(distance_list = distance_to_center_list)
+
+
+    def Complexity_Section(self):
+
+        self.fractal_dimension, self.entropy, self.fractal_dimension_stats = FD_Entropy_Calculator(self.TJ_df, return_stats=True)
 
 
 
@@ -171,19 +381,54 @@ class TurningAngles():
 
     def __init__(self, X_coords, Y_coords):
 
-        self.X_coords = X_coords
-        self.Y_coords = Y_coords
+        self.X_coords = np.asarray(X_coords, dtype=np.float64)
+        self.Y_coords = np.asarray(Y_coords, dtype=np.float64)
 
     def turning_angles(self, interval=1):
         """
-        Calculate the turning angles of the fish
+        Calculate the turning angles of the fish, vectorized equivalent of turning_angles_loop()
+        Same convention as misc.calculate_turning_angle(): right turns are positive, left turns negative,
+        a step of length 0 gives 90 degrees and a NaN coordinate gives 0 degree
         :param interval: the interval between two points
+        :return: array of turning angles (degree)
+        """
+        X = self.X_coords[::interval]
+        Y = self.Y_coords[::interval]
+
+        # Direction vectors AB and BC of every consecutive triplet
+        DX = np.diff(X)
+        DY = np.diff(Y)
+        DX1, DY1, DX2, DY2 = DX[:-1], DY[:-1], DX[1:], DY[1:]
+
+        dot_product = DX1*DX2 + DY1*DY2
+        cross_product = DX1*DY2 - DY1*DX2
+
+        # arctan2 keeps full precision near 0 and 180 degrees, where acos of the cosine does not
+        theta_deg = np.degrees(np.arctan2(np.abs(cross_product), dot_product))
+        theta_deg[cross_product > 0] *= -1
+
+        zero_step = ((DX1 == 0) & (DY1 == 0)) | ((DX2 == 0) & (DY2 == 0))
+        theta_deg[zero_step] = 90.0
+        theta_deg[np.isnan(dot_product)] = 0.0
+
+        return theta_deg
+    
+    def turning_angles_multi(self, intervals):
+        """
+        :param intervals: list of intervals
+        :return: dict interval -> array of turning angles
+        """
+        return {interval: self.turning_angles(interval=interval) for interval in intervals}
+
+    def turning_angles_loop(self, interval=1):
+        """
+        Original point-by-point implementation, kept as reference for equivalence checks
         :return: a list of turning angles
         """
         turning_angles = []
 
-        intervalized_X_coords = self.X_coords[::interval]
-        intervalized_Y_coords = self.Y_coords[::interval]
+        intervalized_X_coords = self.X_coords[::interval].tolist()
+        intervalized_Y_coords = self.Y_coords[::interval].tolist()
 
         for i in range(len(intervalized_X_coords) - 2):
             turning_angle = calculate_turning_angle(intervalized_X_coords[i], intervalized_Y_coords[i], intervalized_X_coords[i + 1], intervalized_Y_coords[i + 1], intervalized_X_coords[i + 2], intervalized_Y_coords[i + 2])
@@ -217,6 +462,10 @@ class ShoalingAnalysis():
 
         self.shoalingvolume = self.CalculateShoalingVolume()
 
+        self.shoalingdistances = self.CalculateShoalingDistances()
+
+        self.shoalingheadings = self.CalculateShoalingHeadings()
+
 
     def CalculateShoalingArea(self):
 
@@ -224,4 +473,12 @@ class ShoalingAnalysis():
                                     
     def CalculateShoalingVolume(self):
     
-        return HullVolumeCalculator(self.fishes_coords)
\ No newline at end of file
+        return HullVolumeCalculator(self.fishes_coords)
+
+    def CalculateShoalingDistances(self):
+
+        return ShoalDistanceCalculator(self.fishes_coords)
+
+    def CalculateShoalingHeadings(self):
+
+        return ShoalHeadingCalculator(self.fishes_coords)
\ No newline at end of file
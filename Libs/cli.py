@@ -0,0 +1,173 @@
+"""
+Headless command-line entry point, drives the Executor without the customtkinter GUI
+
+    python -m Libs.cli analyze <project_dir> --batch 1 --treatments A,B --corr pearson --workers 8
+    python -m Libs.cli export-csv <project_dir> --batch 1
+"""
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+from Libs.scheduler import Scheduler
+from Libs.misc import get_batch_nums, get_treatment_chars, get_trajectories_dir, get_normalized_trajectories_dir, export_trajectories_to_csv
+from . import TRAJECTORY_STORES, MATCHING_MODES
+
+logger = logging.getLogger(__name__)
+
+
+CORR_TYPES = ['pearson', 'spearman', 'kendalltau', 'hoeffd', 'dCor', 'MIC']
+
+
+def comma_list(value):
+    return [item.strip() for item in value.split(",") if item.strip() != ""]
+
+
+def build_parser():
+
+    parser = argparse.ArgumentParser(prog="python -m Libs.cli",
+                                     description="F3LA headless batch runner")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyze = subparsers.add_parser("analyze", help="Analyze treatments of a project and write EndPoints.xlsx")
+    analyze.add_argument("project_dir", type=Path, help="Project directory (the one containing 'Batch N' folders)")
+    analyze.add_argument("--batch", type=comma_list, default=None,
+                         help="Batch number(s), comma separated. Default: all batches")
+    analyze.add_argument("--treatments", type=comma_list, default=None,
+                         help="Treatment characters, comma separated (e.g. A,B). Default: all treatments")
+    analyze.add_argument("--corr", choices=CORR_TYPES, default="pearson",
+                         help="Correlation used to match Side View and Top View trajectories")
+    analyze.add_argument("--matching", choices=MATCHING_MODES, default="full",
+                         help="'progressive' matches the views on a decimated sample first, using more frames only if ambiguous")
+    analyze.add_argument("--av-interval", type=int, default=None,
+                         help="Angular velocity interval in frames. Default: FRAME RATE")
+    analyze.add_argument("--workers", type=int, default=None,
+                         help="Number of treatments analyzed concurrently. Default: number of CPU cores")
+    analyze.add_argument("--fish-workers", type=int, default=1,
+                         help="Number of processes per treatment used to analyze the fishes")
+    analyze.add_argument("--overwrite", action="store_true",
+                         help="Re-analyze treatments already written to EndPoints.xlsx")
+    analyze.add_argument("--store", choices=TRAJECTORY_STORES, default="csv",
+                         help="Format of the saved trajectories, 'npy' is smaller and faster to reload")
+    analyze.add_argument("--time-bins", type=float, default=None, metavar="SECONDS",
+                         help="Also write the endpoints of every SECONDS long time bin to a '[treatment] - Time Bins' sheet")
+    analyze.add_argument("--no-endpoint-cache", dest="endpoint_cache", action="store_false",
+                         help="Recalculate every endpoint instead of reusing the ones cached by previous runs")
+    analyze.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+
+    export = subparsers.add_parser("export-csv", help="Write .csv copies of the trajectories saved as .npy")
+    export.add_argument("project_dir", type=Path, help="Project directory (the one containing 'Batch N' folders)")
+    export.add_argument("--batch", type=comma_list, default=None,
+                        help="Batch number(s), comma separated. Default: all batches")
+    export.add_argument("--treatments", type=comma_list, default=None,
+                        help="Treatment characters, comma separated (e.g. A,B). Default: all treatments")
+    export.add_argument("--overwrite", action="store_true", help="Overwrite existing .csv files")
+    export.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+
+    return parser
+
+
+def print_timings(reports):
+
+    for (batch_num, treatment_char), report in reports.items():
+        print(f"Batch {batch_num} - {treatment_char}: {report['status']}")
+        if report["status"] == "Failed":
+            print(f"    error: {report['error']}")
+        for stage, seconds in report.get("timing", {}).items():
+            print(f"    {stage:<25} {seconds:>9.2f} s")
+
+
+def analyze(args):
+
+    if not args.project_dir.is_dir():
+        logger.error(f"Project directory {args.project_dir} not found.")
+        return 2
+
+    try:
+        batch_nums = None if args.batch == None else [int(batch_num) for batch_num in args.batch]
+    except ValueError:
+        logger.error(f"Invalid batch number(s): {args.batch}")
+        return 2
+
+    _starttime = time.time()
+
+    try:
+        scheduler = Scheduler(project_dir=args.project_dir,
+                              batch_nums=batch_nums,
+                              treatment_chars=args.treatments,
+                              corr_type=args.corr,
+                              AV_interval=args.av_interval,
+                              OVERWRITE=args.overwrite,
+                              workers=args.workers,
+                              fish_workers=args.fish_workers,
+                              store=args.store,
+                              matching=args.matching,
+                              endpoint_cache=args.endpoint_cache,
+                              time_bins=args.time_bins)
+        reports = scheduler.run()
+    except Exception as e:
+        logger.error("Analysis failed.")
+        logger.exception(e)
+        return 1
+
+    print_timings(reports)
+    for stage, seconds in scheduler.timing.items():
+        print(f"{stage:<29} {seconds:>9.2f} s")
+    print(f"Total: {time.time() - _starttime:.2f} s")
+
+    if len(reports) == 0:
+        logger.error("No treatment found to analyze.")
+        return 1
+
+    if any(report["status"] == "Failed" for report in reports.values()):
+        return 1
+
+    return 0
+
+
+def export_csv(args):
+
+    if not args.project_dir.is_dir():
+        logger.error(f"Project directory {args.project_dir} not found.")
+        return 2
+
+    try:
+        batch_nums = get_batch_nums(args.project_dir) if args.batch == None else [int(batch_num) for batch_num in args.batch]
+    except ValueError:
+        logger.error(f"Invalid batch number(s): {args.batch}")
+        return 2
+
+    written = 0
+    for batch_num in batch_nums:
+        chars = get_treatment_chars(args.project_dir, batch_num) if args.treatments == None else args.treatments
+        for treatment_char in chars:
+            directories = [get_trajectories_dir(args.project_dir, batch_num, treatment_char)]
+            for unit in ["pixel", "cm"]:
+                directories.append(get_normalized_trajectories_dir(args.project_dir, batch_num, treatment_char, unit))
+            for directory in directories:
+                written += len(export_trajectories_to_csv(directory, overwrite = args.overwrite))
+
+    print(f"{written} trajectories exported to .csv")
+
+    return 0
+
+
+def main(argv=None):
+
+    args = build_parser().parse_args(argv)
+
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s %(levelname)-8s [%(name)s] %(message)s")
+
+    if args.command == "analyze":
+        return analyze(args)
+
+    if args.command == "export-csv":
+        return export_csv(args)
+
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,15 @@
 import pandas as pd
 import time
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pickle import PicklingError
 
-from Libs.analyzer import GeneralAnalysis, ShoalingAnalysis
-from Libs.general import TrajectoriesLoader, Parameters
-from Libs.misc import get_trajectories_dir, has_csv_file, append_df_to_excel, excel_polish, get_working_dir, merge_cells, check_sheet_existence, remove_sheet_by_name
-from . import TEMPLATE_PATH, CHARS
+from Libs.analyzer import GeneralAnalysis, ShoalingAnalysis, ENDPOINT_GROUPS
+from Libs.general import TrajectoriesLoader, Parameters, trajectories_cache_key, write_trajectories_manifest, backup_trajectories, restore_trajectories, discard_trajectories_backup
+from Libs.misc import get_trajectories_dir, get_sideview_trajectory_path, get_topview_trajectory_path, has_trajectory_file, list_trajectories, load_manifest, get_working_dir, check_sheet_existence, ExcelReport
+from Libs.misc import get_endpoints_cache_dir, load_endpoints_cache, save_endpoints_cache
+from . import TEMPLATE_PATH, CHARS, TRAJECTORY_STORES
 
 import logging
 
@@ -17,47 +22,86 @@ logger = logging.getLogger(__name__)
 
 #         super().__init__(project_dir=project_dir, batch_num=batch_num, treatment_char=treatment_char, fish_num=fish_num)
 
-def EndPoints_Adder(object):
+# Endpoint name -> group (see ENDPOINT_GROUPS), in column order of EndPoints.xlsx
+ENDPOINT_NAMES = {"Total Distance": "kinematics",
+                  "Average Speed": "kinematics",
+                  "Total Absolute Turn Angle": "angle",
+                  "Average Angular Velocity": "angle",
+                  "Slow Angular Velocity Percentage": "angle",
+                  "Fast Angular Velocity Percentage": "angle",
+                  "Meandering": "angle",
+                  "Freezing Time": "kinematics",
+                  "Swimming Time": "kinematics",
+                  "Rapid Movement Time": "kinematics",
+                  "Time in Top": "zone",
+                  "Time in Middle": "zone",
+                  "Time in Bottom": "zone",
+                  "Average distance to Center of the Tank": "center",
+                  "Total distances traveled in Top": "zone",
+                  "Total entries to the Top": "zone",
+                  "Fractal Dimension": "complexity",
+                  "Entropy": "complexity",
+                  # Endpoints added later are appended, the columns of existing EndPoints.xlsx sheets keep their position
+                  "Fractal Dimension Std Error": "complexity",
+                  "Fractal Dimension Intercept Std Error": "complexity",
+                  "Fractal Dimension R^2": "complexity",
+                  "Freezing Bouts": "kinematics",
+                  "Average Freezing Bout Duration": "kinematics",
+                  "Rapid Movement Bouts": "kinematics",
+                  "Latency to the Top": "zone",
+                  "Average Top Bout Duration": "zone",
+                  "Longest Top Bout Duration": "zone"}
+
+
+def EndPoints_Adder(object, groups = None):
+    """
+    :param groups: endpoint groups to add (see ENDPOINT_GROUPS), the object only needs the attributes of these groups. None = all
+    """
+
+    if groups == None:
+        groups = ENDPOINT_GROUPS
 
     endpoints = {}
 
     def add_endpoint(name, value, unit):
         endpoints[name] = {"value": value, "unit": unit}
 
-    name = "Total Distance"
-    value = object.distance.total
-    unit = object.distance.unit
-    add_endpoint(name, value, unit)
-
-    name = "Average Speed"
-    value = object.speed.avg
-    unit = object.speed.unit
-    add_endpoint(name, value, unit)
-
-    name = "Total Absolute Turn Angle"
-    value = object.turning_angle.total
-    unit = object.turning_angle.unit
-    add_endpoint(name, value, unit)
-
-    name = "Average Angular Velocity"
-    value = object.turning_angle.velocity.avg
-    unit = object.turning_angle.velocity.unit
-    add_endpoint(name, value, unit)
-
-    name = "Slow Angular Velocity Percentage"
-    value = object.turning_angle.velocity.slow
-    unit = "%"
-    add_endpoint(name, value, unit)
-
-    name = "Fast Angular Velocity Percentage"
-    value = object.turning_angle.velocity.fast
-    unit = "%"
-    add_endpoint(name, value, unit)
-
-    name = "Meandering"
-    value = object.meandering
-    unit = "degree/m"
-    add_endpoint(name, value, unit)
+    if "kinematics" in groups:
+        name = "Total Distance"
+        value = object.distance.total
+        unit = object.distance.unit
+        add_endpoint(name, value, unit)
+
+        name = "Average Speed"
+        value = object.speed.avg
+        unit = object.speed.unit
+        add_endpoint(name, value, unit)
+
+    if "angle" in groups:
+        name = "Total Absolute Turn Angle"
+        value = object.turning_angle.total
+        unit = object.turning_angle.unit
+        add_endpoint(name, value, unit)
+
+        name = "Average Angular Velocity"
+        value = object.turning_angle.velocity.avg
+        unit = object.turning_angle.velocity.unit
+        add_endpoint(name, value, unit)
+
+        name = "Slow Angular Velocity Percentage"
+        value = object.turning_angle.velocity.slow
+        unit = "%"
+        add_endpoint(name, value, unit)
+
+        name = "Fast Angular Velocity Percentage"
+        value = object.turning_angle.velocity.fast
+        unit = "%"
+        add_endpoint(name, value, unit)
+
+        name = "Meandering"
+        value = object.meandering
+        unit = "degree/m"
+        add_endpoint(name, value, unit)
 
     # name = "Latent Time - Slow"
     # value = object.latent_time_slow
@@ -69,60 +113,194 @@ def EndPoints_Adder(object):
     # unit = "%"
     # add_endpoint(name, value, unit)
 
-    name = "Freezing Time"
-    value = object.speed.slow
-    unit = "%"
-    add_endpoint(name, value, unit)
-
-    name = "Swimming Time"
-    value = object.speed.medium
-    unit = "%"
-    add_endpoint(name, value, unit)
-
-    name = "Rapid Movement Time"
-    value = object.speed.fast
-    unit = "%"
-    add_endpoint(name, value, unit)
-
-    name = "Time in Top"
-    value = object.time_in_top
-    unit = "%"
-    add_endpoint(name, value, unit)
-
-    name = "Time in Middle"
-    value = object.time_in_middle
-    unit = "%"
-    add_endpoint(name, value, unit)
-
-    name = "Time in Bottom"
-    value = object.time_in_bottom
-    unit = "%"
-    add_endpoint(name, value, unit)
-
-    name = "Average distance to Center of the Tank"
-    value = object.distance_to_center.avg
-    unit = object.distance_to_center.unit
-    add_endpoint(name, value, unit)
-
-    name = "Total distances traveled in Top"
-    value = object.distance_in_TOP.total / 100
-    unit = "m"
-    add_endpoint(name, value, unit)
-
-    name = "Total entries to the Top"
-    value = object.travel_in_TOP.count
-    unit = "times"
-    add_endpoint(name, value, unit)
-
-    name = "Fractal Dimension"
-    value = object.fractal_dimension
-    unit = ""
-    add_endpoint(name, value, unit)
-
-    name = "Entropy"
-    value = object.entropy
-    unit = ""
-    add_endpoint(name, value, unit)
+    if "kinematics" in groups:
+        name = "Freezing Time"
+        value = object.speed.slow
+        unit = "%"
+        add_endpoint(name, value, unit)
+
+        name = "Swimming Time"
+        value = object.speed.medium
+        unit = "%"
+        add_endpoint(name, value, unit)
+
+        name = "Rapid Movement Time"
+        value = object.speed.fast
+        unit = "%"
+        add_endpoint(name, value, unit)
+
+        name = "Freezing Bouts"
+        value = object.freezing_bouts
+        unit = "times"
+        add_endpoint(name, value, unit)
+
+        name = "Average Freezing Bout Duration"
+        value = object.freezing_bout_avg
+        unit = "s"
+        add_endpoint(name, value, unit)
+
+        name = "Rapid Movement Bouts"
+        value = object.rapid_bouts
+        unit = "times"
+        add_endpoint(name, value, unit)
+
+    if "zone" in groups:
+        name = "Time in Top"
+        value = object.time_in_top
+        unit = "%"
+        add_endpoint(name, value, unit)
+
+        name = "Time in Middle"
+        value = object.time_in_middle
+        unit = "%"
+        add_endpoint(name, value, unit)
+
+        name = "Time in Bottom"
+        value = object.time_in_bottom
+        unit = "%"
+        add_endpoint(name, value, unit)
+
+    if "center" in groups:
+        name = "Average distance to Center of the Tank"
+        value = object.distance_to_center.avg
+        unit = object.distance_to_center.unit
+        add_endpoint(name, value, unit)
+
+    if "zone" in groups:
+        name = "Total distances traveled in Top"
+        value = object.distance_in_TOP.total / 100
+        unit = "m"
+        add_endpoint(name, value, unit)
+
+        name = "Total entries to the Top"
+        value = object.travel_in_TOP.count
+        unit = "times"
+        add_endpoint(name, value, unit)
+
+        name = "Latency to the Top"
+        value = object.latency_to_top
+        unit = "s"
+        add_endpoint(name, value, unit)
+
+        name = "Average Top Bout Duration"
+        value = object.top_bout_avg
+        unit = "s"
+        add_endpoint(name, value, unit)
+
+        name = "Longest Top Bout Duration"
+        value = object.top_bout_longest
+        unit = "s"
+        add_endpoint(name, value, unit)
+
+    if "complexity" in groups:
+        name = "Fractal Dimension"
+        value = object.fractal_dimension
+        unit = ""
+        add_endpoint(name, value, unit)
+
+        name = "Entropy"
+        value = object.entropy
+        unit = ""
+        add_endpoint(name, value, unit)
+
+        name = "Fractal Dimension Std Error"
+        value = object.fractal_dimension_stats["bErr"]
+        unit = ""
+        add_endpoint(name, value, unit)
+
+        name = "Fractal Dimension Intercept Std Error"
+        value = object.fractal_dimension_stats["aErr"]
+        unit = ""
+        add_endpoint(name, value, unit)
+
+        name = "Fractal Dimension R^2"
+        value = object.fractal_dimension_stats["RR"]
+        unit = ""
+        add_endpoint(name, value, unit)
+
+    # Column order of EndPoints.xlsx
+    return {name: endpoints[name] for name in ENDPOINT_NAMES if name in endpoints}
+
+
+def Fish_Analyzer(project_dir, batch_num, treatment_char, fish_num, params, EPA=True, AV_interval=1, store='csv', endpoint_cache=True, keep_series=True, time_bins=None):
+    """
+    Load and analyze a single fish. Defined at module level so that it can be sent to a worker process.
+    :param endpoint_cache: reuse the endpoint groups whose trajectory and parameters are unchanged since the last run
+    :param keep_series: if False, the per-frame series of the GeneralAnalysis object are dropped once the endpoints are calculated
+    :param time_bins: if set, bin duration (s) of the time-binned endpoints saved to fish.time_bins
+    :return: fish_num, GeneralAnalysis object, endpoints dict (None if EPA is False), elapsed time
+    """
+    _starttime = time.time()
+
+    fish = GeneralAnalysis(project_dir = project_dir, 
+                           batch_num = batch_num, 
+                           treatment_char = treatment_char, 
+                           fish_num = fish_num,
+                           params = params,
+                           store = store)
+    endpoints = None
+    if EPA == True:
+        logger.info(f"EndPoints analysis for Fish {fish_num} initiated...")
+        if endpoint_cache:
+            endpoints = Cached_EndPoints(fish, AV_interval = AV_interval)
+        else:
+            fish.BasicCalculation(DEFAULT_INTERVAL = AV_interval)
+            endpoints = EndPoints_Adder(fish)
+        if time_bins != None:
+            fish.time_bins = fish.Time_Bins(bin_seconds = time_bins)
+    else:
+        logger.info(f"EndPoints analysis for Fish {fish_num} skipped.")
+
+    # Only the interval of the endpoints is kept, the other ones are recalculated on demand
+    if hasattr(fish, "turning_angle"):
+        fish.turning_angle.clear_cache()
+
+    if not keep_series:
+        fish.Release()
+
+    return fish_num, fish, endpoints, time.time() - _starttime
+
+
+def Cached_EndPoints(fish, AV_interval=1):
+    """
+    Only calculate the endpoint groups missing from the cache of the fish (or calculated from another trajectory / parameters),
+    e.g. a new AV_interval only recalculates the "angle" group, new UPPER / LOWER only the "zone" group
+    :return: endpoints dict, same order as EndPoints_Adder()
+    """
+    cache_path = get_endpoints_cache_dir(fish.project_dir, fish.batch_num, fish.treatment_char) / f"{fish.fish_stem}.json"
+
+    keys = fish.Group_Keys(AV_interval = AV_interval)
+    cache = load_endpoints_cache(cache_path)
+
+    def is_cached(group):
+        if group not in cache or cache[group].get("key") != keys[group]:
+            return False
+        names = [name for name, name_group in ENDPOINT_NAMES.items() if name_group == group]
+        return all(name in cache[group].get("endpoints", {}) for name in names)
+
+    cached_groups = [group for group in ENDPOINT_GROUPS if is_cached(group)]
+    missing_groups = [group for group in ENDPOINT_GROUPS if group not in cached_groups]
+
+    if len(missing_groups) == 0:
+        logger.debug(f"EndPoints of {fish.fish_stem} loaded from {cache_path}")
+    else:
+        logger.debug(f"EndPoints of {fish.fish_stem}: calculating {missing_groups}, cached {cached_groups}")
+        fish.BasicCalculation(DEFAULT_INTERVAL = AV_interval, groups = missing_groups)
+        calculated = EndPoints_Adder(fish, groups = missing_groups)
+
+        for group in missing_groups:
+            cache[group] = {"key": keys[group],
+                            "endpoints": {name: endpoint for name, endpoint in calculated.items() 
+                                          if ENDPOINT_NAMES[name] == group}}
+        try:
+            save_endpoints_cache(cache_path, cache)
+        except Exception as e:
+            logger.warning(f"Failed to save the endpoints cache of {fish.fish_stem}: {e}")
+
+    endpoints = {}
+    for name, group in ENDPOINT_NAMES.items():
+        if name in cache[group]["endpoints"]:
+            endpoints[name] = cache[group]["endpoints"][name]
 
     return endpoints
 
@@ -134,7 +312,13 @@ class Executor():
                  batch_num=1, 
                  treatment_char="A", 
                  EndPointsAnalyze=True, 
-                 progress_window=None):
+                 progress_window=None,
+                 workers=None,
+                 report=None,
+                 store='csv',
+                 endpoint_cache=True,
+                 keep_series=True,
+                 time_bins=None):
 
         self.ERROR = None
 
@@ -144,6 +328,28 @@ class Executor():
 
         self.progress_window = progress_window
 
+        # Shared ExcelReport, when given the results are only written when its owner calls report.Write()
+        self.report = report
+
+        # Format of the saved trajectories, see TRAJECTORY_STORES
+        assert store in TRAJECTORY_STORES, f"store must be one of {TRAJECTORY_STORES}"
+        self.store = store
+
+        # Reuse the per-fish endpoints whose trajectory and parameters are unchanged, see Cached_EndPoints()
+        self.endpoint_cache = endpoint_cache
+
+        # Keep the per-frame series (speed, distances, angles...) of every fish in self.FISHES, 
+        # False only keeps their summaries, for treatments with many fishes
+        self.keep_series = keep_series
+
+        # Bin duration (s) of the time-binned endpoints written to the "[treatment] - Time Bins" sheet, None = off
+        self.time_bins = time_bins
+
+        # Number of worker processes used to analyze the fishes, None = number of CPU cores, 1 = sequential
+        if workers == None:
+            workers = os.cpu_count() or 1
+        self.workers = max(1, int(workers))
+
 
 
         # FIRST CHECK
@@ -210,45 +416,104 @@ class Executor():
         return None
 
 
-    def TRAJECTORIES_LOADING(self, corr_type='pearson'):
+    def TRAJECTORIES_LOADING(self, corr_type='pearson', matching='full'):
         # THIRD CHECK
         _starttime = time.time()
 
         logger.info("Loading trajectories...")
 
         self.trajectories_dir = get_trajectories_dir(self.project_dir, self.batch_num, self.treatment_char)
-        # if self.trajectories_dir not exist or empty:
 
-        NEED_TO_LOAD_TRAJECTORIES = False
-
-        if not self.trajectories_dir.exists():
-            NEED_TO_LOAD_TRAJECTORIES = True
-        else:
-            has_csv = has_csv_file(self.trajectories_dir)
-            if has_csv:
-                NEED_TO_LOAD_TRAJECTORIES = False
-            else:
-                NEED_TO_LOAD_TRAJECTORIES = True
+        NEED_TO_LOAD_TRAJECTORIES = self.trajectories_outdated(corr_type = corr_type, matching = matching)
 
         if NEED_TO_LOAD_TRAJECTORIES:
-            _ = TrajectoriesLoader(project_dir = self.project_dir,
-                                   batch_num = self.batch_num, 
-                                   treatment_char=self.treatment_char,
-                                   TOTAL_FRAMES = self.TOTAL_FRAMES, 
-                                   NORMALIZE_RATIO = self.NORMALIZE_RATIO,
-                                   corr_type = corr_type)
+            # The previous trajectories are only deleted once the new ones are built
+            backup_dir = backup_trajectories(self.project_dir, self.batch_num, self.treatment_char)
+            try:
+                _ = TrajectoriesLoader(project_dir = self.project_dir,
+                                       batch_num = self.batch_num, 
+                                       treatment_char=self.treatment_char,
+                                       TOTAL_FRAMES = self.TOTAL_FRAMES, 
+                                       NORMALIZE_RATIO = self.NORMALIZE_RATIO,
+                                       corr_type = corr_type,
+                                       store = self.store,
+                                       matching = matching)
+            except BaseException:
+                logger.error(f"Failed to rebuild the trajectories of Batch {self.batch_num} - {self.treatment_char}")
+                restore_trajectories(self.project_dir, self.batch_num, self.treatment_char, backup_dir)
+                raise
+            discard_trajectories_backup(backup_dir)
         
         self.timing["Trajectories loading"] = time.time() - _starttime
 
 
-    def ENDPOINTS_ANALYSIS(self, OVERWRITE=False, AV_interval=None):
+    def trajectories_outdated(self, corr_type='pearson', matching='full'):
+        """
+        Compare the manifest of the saved trajectories with the current raw files and parameters
+        :return: True if the trajectories need to be (re)built
+        """
+        if not has_trajectory_file(self.trajectories_dir):
+            return True
+
+        try:
+            raw_paths = [get_sideview_trajectory_path(self.project_dir, self.batch_num, self.treatment_char),
+                         get_topview_trajectory_path(self.project_dir, self.batch_num, self.treatment_char)]
+            missing = [str(path) for path in raw_paths if not path.exists()]
+        except FileNotFoundError as e:
+            missing = [str(e)]
+        if len(missing) > 0:
+            logger.warning(f"Raw trajectories {missing} not found, using the saved trajectories")
+            return False
+
+        manifest = load_manifest(self.trajectories_dir)
+        if manifest == None:
+            # Trajectories saved before the manifests were introduced are kept, rebuilding them could change the endpoints
+            logger.warning(f"No manifest found in {self.trajectories_dir}, the saved trajectories are kept and recorded "
+                           "as built from the current raw files and parameters. Delete them to rebuild the trajectories")
+            saved = list_trajectories(self.trajectories_dir)
+            try:
+                write_trajectories_manifest(project_dir = self.project_dir,
+                                            batch_num = self.batch_num,
+                                            treatment_char = self.treatment_char,
+                                            TOTAL_FRAMES = self.TOTAL_FRAMES,
+                                            NORMALIZE_RATIO = self.NORMALIZE_RATIO,
+                                            corr_type = corr_type,
+                                            matching = matching,
+                                            fishes = len(saved),
+                                            store = "npy" if any(path.suffix == ".npy" for path in saved.values()) else "csv")
+            except Exception as e:
+                logger.warning(f"Failed to save the manifest of {self.trajectories_dir}: {e}")
+            return False
+
+        key, _ = trajectories_cache_key(project_dir = self.project_dir,
+                                        batch_num = self.batch_num,
+                                        treatment_char = self.treatment_char,
+                                        TOTAL_FRAMES = self.TOTAL_FRAMES,
+                                        NORMALIZE_RATIO = self.NORMALIZE_RATIO,
+                                        corr_type = corr_type,
+                                        matching = matching,
+                                        previous_files = manifest.get("files"))
+
+        if key != manifest.get("key"):
+            logger.info("Raw trajectories or loading parameters changed, trajectories will be rebuilt")
+            return True
+
+        logger.info("Saved trajectories are up to date")
+        return False
+
+
+    def ENDPOINTS_ANALYSIS(self, OVERWRITE=False, AV_interval=None, EXPORT=True):
+        """
+        :param EXPORT: write the results to EndPoints.xlsx, set to False when the results are written 
+                       by someone else (e.g. the Scheduler's single writer)
+        """
 
         # ENDPOINTS ANALYSIS
         _starttime = time.time()
 
         logger.info("Loading fish data...")
 
-        if self.EPA:
+        if self.EPA and EXPORT:
 
             REPORT = self.analyzed_check()
 
@@ -256,17 +521,10 @@ class Executor():
                 return "Existed", None
             
             if REPORT == "Analyzed" and OVERWRITE:
-                logger.info(f"Removing existing sheet of {self.treatment_char}...")
-
-                try:
-                    remove_sheet_by_name(self.excel_path, self.treatment_char)
-                    logger.info(f"Existing sheet of {self.treatment_char} removed.")
-                except:
-                    logger.error(f"Failed to remove existing sheet of {self.treatment_char}.")
-                    return "Skip", None
+                logger.info(f"Existing sheet of {self.treatment_char} will be replaced.")
                 
 
-        DEFAULT_INTERVAL = self.PARAMS["FRAME RATE"]
+        DEFAULT_INTERVAL = int(self.PARAMS["FRAME RATE"])
 
         if AV_interval == None:
             AV_interval = DEFAULT_INTERVAL
@@ -278,12 +536,13 @@ class Executor():
                 logger.error(f"Invalid AV_interval. Using default value = {self.PARAMS['FRAME RATE']} instead.")
 
 
-        # FishQuantities = count the number of .csv file in self.trajectories_dir
-        self.FishQuantities = len(list(self.trajectories_dir.glob("*.csv")))
+        # FishQuantities = count the number of saved trajectories (.csv or .npy) in self.trajectories_dir
+        self.FishQuantities = len(list_trajectories(self.trajectories_dir))
 
         self.FISHES = {}
         self.EndPoints = {}
         self.FishCoordinates = {}
+        self.TimeBins = {}
 
         self.Fish_Adder(EPA = self.EPA, AV_interval = AV_interval)
 
@@ -291,9 +550,14 @@ class Executor():
             ShoalingAnalyze = ShoalingAnalysis(self.FishCoordinates)
             self.shoalingarea = ShoalingAnalyze.shoalingarea
             self.shoalingvolume = ShoalingAnalyze.shoalingvolume
+            self.shoalingdistances = ShoalingAnalyze.shoalingdistances
+            self.shoalingheadings = ShoalingAnalyze.shoalingheadings
 
-            self.Export_To_Excel(excel_path = self.excel_path)
-            return_excel_path = self.excel_path
+            if EXPORT:
+                self.Export_To_Excel(excel_path = self.excel_path, report = self.report)
+                return_excel_path = self.excel_path
+            else:
+                return_excel_path = None
         else:
             return_excel_path = None
 
@@ -301,6 +565,15 @@ class Executor():
 
         return "Completed", return_excel_path
     
+    def Release(self):
+        """
+        Drop the per-fish objects and coordinates once the endpoints and shoaling data are computed,
+        keeps the Executor light when it is sent back from a worker process
+        """
+        self.FISHES = {}
+        self.FishCoordinates = {}
+        self.progress_window = None
+
     def update_progress_bar(self, value, text):
         if self.progress_window is not None:
             self.progress_window.task_update(value, text)
@@ -323,7 +596,10 @@ class Executor():
         return "Not analyzed"
 
 
-    def Add_Shoaling_Data_To_Excel(self, excel_path):
+    def Shoaling_Tables(self):
+        """
+        :return: shoaling_df (per frame, cm^2, cm^3, cm and unitless heading alignment) and avg_df (one row)
+        """
 
         sa = list(self.shoalingarea["ConvexHullVolume"])
         sv = list(self.shoalingvolume["ConvexHullVolume"])
@@ -342,38 +618,25 @@ class Executor():
         shoaling_df = pd.DataFrame({SA_HEADER: sa, SV_HEADER: sv})
         shoaling_df.index = list(self.shoalingarea.index)
 
-        sheet_name = "Shoaling"
-        append_df_to_excel(filename = excel_path,
-                           df = shoaling_df,
-                           sheet_name=sheet_name,
-                           startrow=0,
-                           col_sep=1,
-                           index=False)
-        logger.debug(f"Shoaling.xlsx is saved to {excel_path}, sheetname={sheet_name}")
-
-        SA_AVG_HEADER = SA_HEADER + " Average"
-        SV_AVG_HEADER = SV_HEADER + " Average"
-
-        sa_avg = shoaling_df[SA_HEADER].mean()
-        sv_avg = shoaling_df[SV_HEADER].mean()
-        avg_df = pd.DataFrame({SA_AVG_HEADER: [sa_avg], SV_AVG_HEADER: [sv_avg]})
-
-        append_df_to_excel(filename = excel_path,
-                           df=avg_df,
-                           sheet_name=self.treatment_char,
-                           startrow=0,
-                           index=False)
-        
-        merge_cells(file_path=excel_path,
-                    input_sheet_name=self.treatment_char,
-                    input_column_name=[SA_AVG_HEADER, SV_AVG_HEADER], 
-                    cell_step=len(self.FISHES),
-                    inplace = True)
+        # Convert the distances from pixel to cm
+        CONVERT_RATIO_DISTANCE = 1 / self.PARAMS["CONVERSION TV"]
+        DISTANCE_HEADERS = {"NearestNeighbourDistance": f"Nearest Neighbour Distance {self.treatment_char}",
+                            "InterIndividualDistance": f"Inter-individual Distance {self.treatment_char}",
+                            "CentroidDistance": f"Distance to Shoal Centroid {self.treatment_char}"}
+        for column, header in DISTANCE_HEADERS.items():
+            shoaling_df[header] = self.shoalingdistances[column].to_numpy() * CONVERT_RATIO_DISTANCE
 
-        return avg_df
+        HEADING_HEADERS = {"Polarization": f"Polarization {self.treatment_char}",
+                           "HeadingCorrelation": f"Heading Correlation {self.treatment_char}"}
+        for column, header in HEADING_HEADERS.items():
+            shoaling_df[header] = self.shoalingheadings[column].to_numpy()
+
+        avg_df = pd.DataFrame({f"{header} Average": [shoaling_df[header].mean()] for header in shoaling_df.columns})
+
+        return shoaling_df, avg_df
     
 
-    def Export_To_Excel(self, excel_path):
+    def EndPoints_Table(self):
         EndPoints_dict = {}
         for fish_num in self.EndPoints.keys():
             EndPoints_dict[fish_num] = {}
@@ -383,45 +646,149 @@ class Executor():
                 else:
                     EndPoints_dict[fish_num][f"{key} ({value['unit']})"] = value["value"]
 
-        df_endpoints = pd.DataFrame(EndPoints_dict).T
+        return pd.DataFrame(EndPoints_dict).T
+
+
+    def Time_Bins_Table(self):
+        """
+        :return: time-binned endpoints of every fish, indexed by (Fish, Time Bin), None if not calculated
+        """
+        if len(self.TimeBins) == 0:
+            return None
+
+        tables = {f"Fish {fish_num}": self.TimeBins[fish_num] for fish_num in sorted(self.TimeBins.keys())}
+        return pd.concat(tables, names=["Fish"])
+
+
+    def Export_To_Excel(self, excel_path, report = None):
+        """
+        :param report: ExcelReport collecting the tables of several treatments, written later by its owner.
+                       If None, the tables of this treatment are written right away
+        """
 
+        df_endpoints = self.EndPoints_Table()
+        shoaling_df, avg_df = self.Shoaling_Tables()
 
-        append_df_to_excel(filename = excel_path,
-                   df = df_endpoints,
-                   sheet_name=self.treatment_char)
-        logger.debug(f"EndPoints.xlsx is saved to {excel_path}")
+        WRITE_NOW = report is None
+        if WRITE_NOW:
+            report = ExcelReport()
 
-        self.Add_Shoaling_Data_To_Excel(excel_path)
+        report.Add_Treatment(excel_path = excel_path,
+                             treatment_char = self.treatment_char,
+                             endpoints_df = df_endpoints,
+                             average_df = avg_df,
+                             shoaling_df = shoaling_df)
 
-        excel_polish(excel_path)
-        logger.debug(f"EndPoints.xlsx is polished.")
+        time_bins_df = self.Time_Bins_Table()
+        if time_bins_df is not None:
+            report.Add_Sheet(excel_path = excel_path,
+                             sheet_name = f"{self.treatment_char} - Time Bins",
+                             df = time_bins_df)
+
+        if WRITE_NOW:
+            ERROR = list(report.Write().values())[0]
+            if ERROR != None:
+                raise IOError(ERROR)
+            logger.debug(f"EndPoints.xlsx is saved to {excel_path}")
 
 
     
     def Fish_Adder(self, EPA=True, AV_interval = 1):
 
-        for fish_num in range(1, self.FishQuantities+1):
-            _starttime = time.time()
-            self.FISHES[fish_num] = GeneralAnalysis(project_dir = self.project_dir, 
-                                                    batch_num = self.batch_num, 
-                                                    treatment_char = self.treatment_char, 
-                                                    fish_num = fish_num,
-                                                    params = self.PARAMS)
-            if EPA == True:
-                logger.info(f"EndPoints analysis for Fish {fish_num} initiated...")
-                self.FISHES[fish_num].BasicCalculation(DEFAULT_INTERVAL = AV_interval)
-                self.EndPoints[fish_num] = EndPoints_Adder(self.FISHES[fish_num])
-                self.FishCoordinates[fish_num] = self.FISHES[fish_num].TJ_df
-            else:
-                logger.info(f"EndPoints analysis for Fish {fish_num} skipped.")
+        workers = min(self.workers, self.FishQuantities)
+
+        if workers > 1:
+            try:
+                self.Fish_Adder_Parallel(EPA = EPA, AV_interval = AV_interval, workers = workers)
+                return
+            except (BrokenProcessPool, PicklingError) as e:
+                # Only a failure of the pool itself falls back, errors of the analysis are raised as in the sequential path
+                logger.warning(f"Parallel analysis with {workers} workers failed, analyzing sequentially instead.")
+                logger.warning(e)
 
-            self.timing[f"Analyze Fish {fish_num}"] = time.time() - _starttime
+        for fish_num in range(1, self.FishQuantities+1):
+            result = Fish_Analyzer(project_dir = self.project_dir, 
+                                   batch_num = self.batch_num, 
+                                   treatment_char = self.treatment_char, 
+                                   fish_num = fish_num,
+                                   params = self.PARAMS,
+                                   EPA = EPA,
+                                   AV_interval = AV_interval,
+                                   store = self.store,
+                                   endpoint_cache = self.endpoint_cache,
+                                   keep_series = self.keep_series,
+                                   time_bins = self.time_bins)
+            self.Fish_Collector(*result)
 
             progress = fish_num / self.FishQuantities * 100
             self.update_progress_bar(value=progress, text = f"Analyze Fish {fish_num}")
 
 
+    def Fish_Adder_Parallel(self, EPA=True, AV_interval = 1, workers = 2):
+
+        logger.info(f"Analyzing {self.FishQuantities} fishes with {workers} worker processes...")
+
+        results = {}
+
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = [pool.submit(Fish_Analyzer, 
+                                   self.project_dir, 
+                                   self.batch_num, 
+                                   self.treatment_char, 
+                                   fish_num, 
+                                   self.PARAMS, 
+                                   EPA, 
+                                   AV_interval,
+                                   self.store,
+                                   self.endpoint_cache,
+                                   self.keep_series,
+                                   self.time_bins) for fish_num in range(1, self.FishQuantities+1)]
+
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                results[result[0]] = result
+
+                progress = done / self.FishQuantities * 100
+                self.update_progress_bar(value=progress, text = f"Analyze Fish {result[0]}")
+
+        # Gather back in fish order
+        for fish_num in sorted(results.keys()):
+            self.Fish_Collector(*results[fish_num])
+
+
+    def Fish_Collector(self, fish_num, fish, endpoints, elapsed_time):
+
+        self.FISHES[fish_num] = fish
+        if endpoints is not None:
+            self.EndPoints[fish_num] = endpoints
+            self.FishCoordinates[fish_num] = fish.TJ_df
+            if hasattr(fish, "time_bins"):
+                self.TimeBins[fish_num] = fish.time_bins
+
+        self.timing[f"Analyze Fish {fish_num}"] = elapsed_time
+
+
+    def Speed_Threshold_Sweep(self, threshold_sets):
+        """
+        Freezing / Swimming / Rapid Movement percentages of every fish for several speed thresholds
+        :param threshold_sets: list of (THRESHOLD_1, THRESHOLD_2) in cm/s
+        :return: DataFrame indexed by (Fish, THRESHOLD_1, THRESHOLD_2)
+        """
+        tables = {}
+        for fish_num, fish in self.FISHES.items():
+            if not hasattr(fish, "speed") or fish.speed.list is None:
+                # skipped when the kinematics endpoints are cached, or dropped by fish.Release()
+                fish.Kinematics_Section()
+            tables[f"Fish {fish_num}"] = fish.speed.Sweep(threshold_sets)
+
+        return pd.concat(tables, names=["Fish"])
+
+
     def Save_AV_Plots(self, interval=1, bins=100, DISPLAY=True):
+        """
+        :param interval: interval or list of intervals, the turning angles of all intervals are calculated at once
+        """
+        intervals = list(interval) if isinstance(interval, (list, tuple)) else [interval]
 
         batch_dir = get_working_dir(self.project_dir, self.batch_num) 
         AV_plots_dir = batch_dir / "AV Plots"
@@ -429,21 +796,19 @@ class Executor():
         AV_plots_dir.mkdir(exist_ok=True, parents=True)
 
         for fish_num, fish in self.FISHES.items():
-            save_path = AV_plots_dir / f"Fish{fish_num}_i{interval}_b{bins}.png"
-            av_excel_path = AV_plots_dir / f"AV_i{interval}_b{bins}.xlsx"
-            fish.turning_angle.set_interval(interval=interval)
-            fish.turning_angle.velocity.plot_histogram(bins=bins, 
-                                                       save_path=save_path,
-                                                       excel_path = av_excel_path,
-                                                       fish_num=fish_num,
-                                                       DISPLAY=DISPLAY)
-            
-            logger.debug(f"AV plot for Fish {fish_num} saved to {save_path}")
-            
-                                                    
-    
-    
-
-    
-
+            turning_angle = fish.Turning_Angle(interval=intervals[0])
+            turning_angle.precompute(intervals)
+
+            for interval in intervals:
+                save_path = AV_plots_dir / f"Fish{fish_num}_i{interval}_b{bins}.png"
+                av_excel_path = AV_plots_dir / f"AV_i{interval}_b{bins}.xlsx"
+                turning_angle.set_interval(interval=interval)
+                turning_angle.velocity.plot_histogram(bins=bins, 
+                                                      save_path=save_path,
+                                                      excel_path = av_excel_path,
+                                                      fish_num=fish_num,
+                                                      DISPLAY=DISPLAY)
+                
+                logger.debug(f"AV plot for Fish {fish_num} saved to {save_path}")
 
+            turning_angle.clear_cache()
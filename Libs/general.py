@@ -5,6 +5,8 @@ import time
 import math
 from pathlib import Path
 import json
+import shutil
+import tempfile
 from statistics import mean
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -14,9 +16,9 @@ from scipy.stats import pearsonr, spearmanr, kendalltau
 # from minepy import MINE
 
 from Libs.misc import *
-from Libs.XtendedCorrel import hoeffding
+from Libs.XtendedCorrel import hoeffding, hoeffding_matrix
 
-from . import ALLOWED_DECIMALS, TEMPLATE_PATH, FISH_KEY_FORMAT, SAVED_TRAJECTORY_FORMAT, CHARS, NEG_INF, POS_INF
+from . import ALLOWED_DECIMALS, TEMPLATE_PATH, FISH_KEY_FORMAT, SAVED_TRAJECTORY_FORMAT, CHARS, NEG_INF, POS_INF, TRAJECTORY_STORES, MATCHING_MODES, SPEED_THRESHOLDS, ANGULAR_VELOCITY_THRESHOLD, SERIES_DTYPE, ZONES
 
 import logging
 
@@ -239,6 +241,94 @@ class ParamsCalculator():
 
 ##################################### LOAD & REARRANGER TRAJECTORIES #####################################
 
+def trajectories_cache_key(project_dir, batch_num, treatment_char, TOTAL_FRAMES, NORMALIZE_RATIO, corr_type, matching, previous_files = None):
+    """
+    Key of the inputs the saved trajectories depend on: the content of both raw view files and the loading parameters
+    :param previous_files: "files" record of the existing manifest, hashes are reused for unchanged files
+    :return: key, files record
+    """
+    if previous_files == None:
+        previous_files = {}
+
+    files = {}
+    for view, path in [("Side View", get_sideview_trajectory_path(project_dir, batch_num, treatment_char)),
+                       ("Top View", get_topview_trajectory_path(project_dir, batch_num, treatment_char))]:
+        files[view] = file_hash(path, previous = previous_files.get(view))
+
+    key = params_hash({"Side View": files["Side View"]["sha1"],
+                       "Top View": files["Top View"]["sha1"],
+                       "CORR TYPE": corr_type,
+                       "TOTAL_FRAMES": int(TOTAL_FRAMES),
+                       "NORMALIZE_RATIO": float(NORMALIZE_RATIO),
+                       "MATCHING": matching})
+
+    return key, files
+
+
+def write_trajectories_manifest(project_dir, batch_num, treatment_char, TOTAL_FRAMES, NORMALIZE_RATIO, corr_type, matching, fishes, store):
+    """
+    Record the inputs of the saved trajectories of a treatment, see trajectories_cache_key()
+    :return: manifest dict
+    """
+    key, files = trajectories_cache_key(project_dir = project_dir,
+                                        batch_num = batch_num,
+                                        treatment_char = treatment_char,
+                                        TOTAL_FRAMES = TOTAL_FRAMES,
+                                        NORMALIZE_RATIO = NORMALIZE_RATIO,
+                                        corr_type = corr_type,
+                                        matching = matching)
+    manifest = {"key": key, 
+                "files": files, 
+                "fishes": fishes,
+                "store": store}
+    save_manifest(get_trajectories_dir(project_dir, batch_num, treatment_char), manifest)
+    return manifest
+
+
+def trajectories_dirs(project_dir, batch_num, treatment_char):
+    """
+    Directories of the saved and normalized trajectories of a treatment
+    :return: dict name -> directory
+    """
+    dirs = {"trajectories": get_trajectories_dir(project_dir, batch_num, treatment_char)}
+    for unit in ["pixel", "cm"]:
+        dirs[f"trajectories_normalized_{unit}"] = get_normalized_trajectories_dir(project_dir, batch_num, treatment_char, unit)
+    return dirs
+
+
+def backup_trajectories(project_dir, batch_num, treatment_char):
+    """
+    Move the saved and normalized trajectories of a treatment to a temporary directory before they are rebuilt,
+    the backup is deleted with discard_trajectories_backup() once the rebuild succeeded, else put back with restore_trajectories()
+    :return: backup directory
+    """
+    static_dir = get_static_dir(project_dir, batch_num, treatment_char)
+    static_dir.mkdir(parents=True, exist_ok=True)
+    backup_dir = Path(tempfile.mkdtemp(prefix="trajectories_backup_", dir=static_dir))
+
+    moved = 0
+    for name, directory in trajectories_dirs(project_dir, batch_num, treatment_char).items():
+        moved += move_trajectories(directory, backup_dir / name)
+    logger.info(f"Moved {moved} outdated trajectory files of Batch {batch_num} - {treatment_char} to {backup_dir}")
+
+    return backup_dir
+
+
+def restore_trajectories(project_dir, batch_num, treatment_char, backup_dir):
+    """
+    Replace the (partially) rebuilt trajectories of a treatment by the backup of backup_trajectories()
+    """
+    for name, directory in trajectories_dirs(project_dir, batch_num, treatment_char).items():
+        remove_trajectories(directory)
+        move_trajectories(backup_dir / name, directory)
+    shutil.rmtree(backup_dir, ignore_errors=True)
+    logger.info(f"Previous trajectories of Batch {batch_num} - {treatment_char} restored")
+
+
+def discard_trajectories_backup(backup_dir):
+    shutil.rmtree(backup_dir, ignore_errors=True)
+
+
 class TrajectoriesLoader():
 
     def __init__(self, 
@@ -247,7 +337,11 @@ class TrajectoriesLoader():
                  treatment_char="A", 
                  TOTAL_FRAMES = 15000, 
                  NORMALIZE_RATIO = 1,
-                 corr_type='pearson'):
+                 corr_type='pearson',
+                 store='csv',
+                 matching='full',
+                 sample_frames=2000,
+                 margin_threshold=0.05):
 
         if project_dir == None:
             self.project_dir = TEMPLATE_PATH
@@ -255,6 +349,20 @@ class TrajectoriesLoader():
         else:
             self.project_dir = project_dir
 
+        self.batch_num = batch_num
+        self.treatment_char = treatment_char
+
+        assert store in TRAJECTORY_STORES, f"store must be one of {TRAJECTORY_STORES}"
+        self.store = store
+
+        # "full"        : correlate every frame
+        # "progressive" : correlate a decimated sample of sample_frames frames, doubled until the assignment
+        #                 margin (second best - best cost) reaches margin_threshold or every frame is used
+        assert matching in MATCHING_MODES, f"matching must be one of {MATCHING_MODES}"
+        self.matching = matching
+        self.sample_frames = sample_frames
+        self.margin_threshold = margin_threshold
+
         self.trajectories_dir = get_trajectories_dir(self.project_dir, batch_num, treatment_char)
 
         self.trajectories_SV_path = get_sideview_trajectory_path(self.project_dir, batch_num, treatment_char)
@@ -294,12 +402,16 @@ class TrajectoriesLoader():
 
         self.FISHES = self.rearranger()
 
+        self.Save_Matching_Report()
+
         self.Plot_Y_and_Save("post-arranged")
 
         self.FISHES = self.converter(self.FISHES)
 
         self.SaveTrajectories()
 
+        self.Save_Manifest()
+
     def set_coorelation_type(self, corr_type):
 
         assert corr_type in ['pearson', 'spearman', 'kendalltau', 'hoeffd', 'dCor', 'MIC'], "corr_type must be either 'pearson', 'spearman', 'kendalltau', 'hoeffd', 'dCor', 'MIC'"
@@ -364,31 +476,71 @@ class TrajectoriesLoader():
             return mine.mic()
 
 
-    def CoupleRawLoader(self):
+    def correlation_matrix(self, TV_matrix, SV_matrix):
         """
-            Load raw data from 2 files, clean them and couple them together 
+            Correlation of every Top View column with every Side View column
+            Pearson, Spearman and Hoeffding's D are computed for the whole matrix at once, the other types pair by pair
+        :param TV_matrix: array (frames, fishes)
+        :param SV_matrix: array (frames, fishes)
+        :return: array (TV fishes, SV fishes)
         """
+        t0 = time.time()
+
+        if self.correlation_type == 'pearson':
+            matrix = pearson_matrix(TV_matrix, SV_matrix)
+        elif self.correlation_type == 'spearman':
+            matrix = spearman_matrix(TV_matrix, SV_matrix)
+        elif self.correlation_type == 'hoeffd':
+            matrix = hoeffding_matrix(TV_matrix, SV_matrix)
+        else:
+            matrix = np.empty((TV_matrix.shape[1], SV_matrix.shape[1]))
+            for i in range(TV_matrix.shape[1]):
+                for j in range(SV_matrix.shape[1]):
+                    matrix[i, j] = self.correlation_calculation(TV_matrix[:, i], SV_matrix[:, j])
+
+        logger.debug(f"Took {time.time() - t0} seconds to calculate the {self.correlation_type} correlation matrix")
+
+        return matrix
+
+
+    def RawLoader(self, trajectories_path, max_frames = None):
         try:
-            trajectories_SV, tank_list_SV = load_raw_df(self.trajectories_SV_path)
-        except Exception as e:
-            logger.error("Failed to load trajectories from {}".format(self.trajectories_SV_path))
-            logger.error(e)
-            raise ValueError("Failed to load trajectories from {}".format(self.trajectories_SV_path))
-        
-        try:
-            trajectories_TV, tank_list_TV = load_raw_df(self.trajectories_TV_path)
+            return load_raw_df(trajectories_path, max_frames = max_frames)
         except Exception as e:
-            logger.error("Failed to load trajectories from {}".format(self.trajectories_TV_path))
+            logger.error("Failed to load trajectories from {}".format(trajectories_path))
             logger.error(e)
-            raise ValueError("Failed to load trajectories from {}".format(self.trajectories_TV_path))
-        
-        trajectories_SV, trajectories_TV = couple_df_cleaner(input_df1 = trajectories_SV, 
-                                                             input_df2 = trajectories_TV,
-                                                             limitation = self.TOTAL_FRAMES)
-        
-        trajectories_SV = trajectories_SV.astype(float)
-        trajectories_TV = trajectories_TV.astype(float)
+            raise ValueError("Failed to load trajectories from {}".format(trajectories_path))
+
 
+    def CoupleRawLoader(self):
+        """
+            Load raw data from 2 files, clean them and couple them together 
+        """
+        # Only read the frames needed: TOTAL_FRAMES after the leading nan rows of each file
+        trajectories_SV, tank_list_SV = self.RawLoader(self.trajectories_SV_path, max_frames = self.TOTAL_FRAMES)
+        trajectories_TV, tank_list_TV = self.RawLoader(self.trajectories_TV_path, max_frames = self.TOTAL_FRAMES)
+
+        # The leading nan rows of the 2 views combined may need more frames than read, read the whole files then
+        length = min(len(trajectories_SV), len(trajectories_TV))
+        nan_rows = trajectories_SV.iloc[:length].isnull().to_numpy().any(axis=1) | trajectories_TV.iloc[:length].isnull().to_numpy().any(axis=1)
+        TRUNCATED = max(len(trajectories_SV), len(trajectories_TV)) >= self.TOTAL_FRAMES
+        if TRUNCATED and leading_true_count(nan_rows) > length - self.TOTAL_FRAMES:
+            logger.info("Not enough frames after the leading nan rows, reading the whole trajectories files")
+            trajectories_SV, tank_list_SV = self.RawLoader(self.trajectories_SV_path)
+            trajectories_TV, tank_list_TV = self.RawLoader(self.trajectories_TV_path)
+
+        trajectories_SV, trajectories_TV, report = couple_df_cleaner(input_df1 = trajectories_SV, 
+                                                                     input_df2 = trajectories_TV,
+                                                                     limitation = self.TOTAL_FRAMES,
+                                                                     return_report = True)
+
+        self.CLEANING_REPORT = {"Side View": report["first"], "Top View": report["second"]}
+        logger.info(f"Removed {report['trimmed_rows']} leading nan rows and {report['limited_rows']} rows after {self.TOTAL_FRAMES} frames")
+        for view, fishes in self.CLEANING_REPORT.items():
+            for fish_num, fish_report in fishes.items():
+                if fish_report["dropped_frames"] > 0 or fish_report["filled_frames"] > 0:
+                    logger.info(f"{view} Fish {fish_num}: {fish_report['dropped_frames']} frames dropped, {fish_report['filled_frames']} frames filled")
+        
         # Double-check the balance of 2 trajectories
         if len(trajectories_SV) != len(trajectories_TV):
             logger.error("Number of rows in Side View and Top View are not the same, please check your input.")
@@ -408,6 +560,82 @@ class TrajectoriesLoader():
         return fishes
 
 
+    def cost_matrix_calculation(self, TV_matrix, SV_matrix):
+
+        correlation_matrix = self.correlation_matrix(TV_matrix, SV_matrix)
+
+        # Using 1 - correlation as the cost
+        cost_matrix = 1 - correlation_matrix
+        for i, j in zip(*np.nonzero(np.isnan(correlation_matrix))):
+            logger.warning(f"correlation_coeff of Fish {i+1} and Fish {j+1} is NaN, set to negative infinity")
+        cost_matrix[np.isnan(correlation_matrix)] = POS_INF
+
+        return cost_matrix
+
+
+    def matcher(self, TV_matrix, SV_matrix):
+        """
+            Hungarian assignment of Top View fishes to Side View fishes, on all frames or progressively (see self.matching)
+        :return: cost_matrix, row_ind, col_ind
+        """
+        frames = TV_matrix.shape[0]
+
+        if self.matching == "progressive":
+            sample_frames = max(1, min(int(self.sample_frames), frames))
+        else:
+            sample_frames = frames
+
+        while True:
+            stride = max(1, frames // sample_frames)
+            cost_matrix = self.cost_matrix_calculation(TV_matrix[::stride], SV_matrix[::stride])
+
+            # Use the Hungarian algorithm to find the best assignment
+            try:
+                row_ind, col_ind = linear_sum_assignment(cost_matrix)
+            except ValueError as e:
+                if stride > 1:
+                    logger.warning(f"No feasible assignment on every {stride} frames, using more frames")
+                    sample_frames *= 2
+                    continue
+                logger.error("Failed to rearrange trajectories, please check your input.")
+                logger.debug(f"{cost_matrix=}")
+                raise ValueError("Failed to rearrange trajectories, please check your input.") from e
+
+            margin = assignment_margin(cost_matrix, row_ind, col_ind)
+            used_frames = len(range(0, frames, stride))
+
+            logger.info(f"Matching on {used_frames}/{frames} frames (every {stride} frames): assignment margin = {margin}")
+
+            if stride == 1 or margin >= self.margin_threshold:
+                break
+
+            logger.info(f"Assignment margin below {self.margin_threshold}, using more frames")
+            sample_frames *= 2
+
+        self.MATCHING = {"CORR TYPE": self.correlation_type,
+                         "MODE": self.matching,
+                         "FRAMES USED": used_frames,
+                         "STRIDE": stride,
+                         "MARGIN": float(margin) if np.isfinite(margin) else None,
+                         "MARGIN THRESHOLD": self.margin_threshold,
+                         "SV ORDER": [int(j+1) for j in col_ind]}
+
+        return cost_matrix, row_ind, col_ind
+
+
+    def Save_Matching_Report(self):
+        """
+            Record how the views were matched in parameters.json, under "MATCHING"
+        """
+        try:
+            PARAMS = Parameters(project_dir = self.project_dir, 
+                                batch_num = self.batch_num, 
+                                treatment_char = self.treatment_char)
+            PARAMS.Update({"MATCHING": self.MATCHING})
+        except Exception as e:
+            logger.warning(f"Failed to save the matching report to parameters.json: {e}")
+
+
     def rearranger(self):
         """
             Rearrange the trajectories based on the correlation of Y coordinates between Side View and Top View
@@ -416,30 +644,13 @@ class TrajectoriesLoader():
         score_df = pd.DataFrame(columns=columns)
         score_df['TopView'] = [f"TV Y{i}" for i in range(1, 7)]
 
-        # Prepare an empty cost matrix
-        cost_matrix = np.empty((self.FISH_NUM, self.FISH_NUM))
-
-        # Compute Pearson correlation for each pair and fill the cost matrix
-        for i in range(self.FISH_NUM):
-            TV_list = self.tj_TV[f'Y{i+1}'].tolist()
-            for j in range(self.FISH_NUM):
-                SV_list = self.tj_SV[f'Y{j+1}'].tolist()
-                correlation_coeff = self.correlation_calculation(TV_list, SV_list)
-                if np.isnan(correlation_coeff):
-                    logger.warning(f"correlation_coeff of Fish {i+1} and Fish {j+1} is NaN, set to negative infinity")
-                    cost_matrix[i, j] = POS_INF
-                else:
-                    cost_matrix[i, j] = 1 - correlation_coeff  # Using 1 - correlation as the cost
+        # Stack the Y coordinates of both views, one column per fish
+        TV_matrix = np.column_stack([self.tj_TV[f'Y{i+1}'].to_numpy(dtype=np.float64) for i in range(self.FISH_NUM)])
+        SV_matrix = np.column_stack([self.tj_SV[f'Y{j+1}'].to_numpy(dtype=np.float64) for j in range(self.FISH_NUM)])
 
-        self.cost_matrix = cost_matrix
+        cost_matrix, row_ind, col_ind = self.matcher(TV_matrix, SV_matrix)
 
-        # Use the Hungarian algorithm to find the best assignment
-        try:
-            row_ind, col_ind = linear_sum_assignment(cost_matrix)
-        except ValueError as e:
-            logger.error("Failed to rearrange trajectories, please check your input.")
-            logger.debug(f"{cost_matrix=}")
-            raise ValueError("Failed to rearrange trajectories, please check your input.") from e
+        self.cost_matrix = cost_matrix
         
         # Rearrange the columns of TopView dataframe based on optimal assignment
         new_tj_SV = pd.DataFrame(columns=self.tj_SV.columns)
@@ -475,25 +686,48 @@ class TrajectoriesLoader():
 
     def SaveTrajectories(self, save_dict = None, save_dir = None):
         """
-            Save the rearranged trajectories to .csv files 
+            Save the rearranged trajectories to .csv files (or .npy + .json metadata if store == 'npy')
         """
         if save_dir == None:
             save_dir = self.trajectories_dir
         if save_dict == None:
             save_dict = self.FISHES
         save_dir.mkdir(parents=True, exist_ok=True)
+
+        metadata = {"batch": self.batch_num,
+                    "treatment": self.treatment_char,
+                    "params_hash": params_hash({"TOTAL_FRAMES": self.TOTAL_FRAMES,
+                                                "NORMALIZE_RATIO": self.NORMALIZE_RATIO,
+                                                "CORR TYPE": self.correlation_type})}
+
         for fish_name, fish_df in save_dict.items():
-            save_path = save_dir / f"{fish_name}.csv"
-            fish_df.to_csv(save_path, index=False)
+            save_path = save_trajectory(fish_df, save_dir / fish_name, store = self.store, metadata = metadata)
             logger.info(f"Trajectory of {fish_name} saved to {save_path}")
 
-        # Check if number of .csv file in save_dir is the same as FISH_NUM
-        if len(list(save_dir.glob("*.csv"))) != len(save_dict):
-            logger.error("Number of .csv files in {} is not the same as FISH_NUM".format(save_dir))
-            raise ValueError("Number of .csv files in {} is not the same as FISH_NUM".format(save_dir))
+        # Check if number of saved trajectories in save_dir is the same as FISH_NUM
+        if len(list_trajectories(save_dir)) != len(save_dict):
+            logger.error("Number of trajectories in {} is not the same as FISH_NUM".format(save_dir))
+            raise ValueError("Number of trajectories in {} is not the same as FISH_NUM".format(save_dir))
         else:
             logger.info("All trajectories saved to {}".format(save_dir))
 
+    def Save_Manifest(self):
+        """
+            Record the inputs of the saved trajectories, see trajectories_cache_key()
+        """
+        try:
+            write_trajectories_manifest(project_dir = self.project_dir,
+                                        batch_num = self.batch_num,
+                                        treatment_char = self.treatment_char,
+                                        TOTAL_FRAMES = self.TOTAL_FRAMES,
+                                        NORMALIZE_RATIO = self.NORMALIZE_RATIO,
+                                        corr_type = self.correlation_type,
+                                        matching = self.matching,
+                                        fishes = self.FISH_NUM,
+                                        store = self.store)
+        except Exception as e:
+            logger.warning(f"Failed to save the manifest of {self.trajectories_dir}: {e}")
+
     def visualize_cost_matrix(self, title, save_path=None):
         plt.figure()
 
@@ -581,12 +815,12 @@ class Parameters():
 
 
     def Refresh(self):
-        self.PARAMS = self.Load(self)
+        self.PARAMS = self.Load()
 
 
     def Update(self, modify_dict):
 
-        PARAMS = self.Load(self)
+        PARAMS = self.Load()
         
         for key, value in modify_dict.items():
             PARAMS[key] = value
@@ -607,9 +841,9 @@ class Parameters():
             logger.error(f"parameters.json not found at {self.param_path}, please check your input.")
             return None
         
-        # Convert all values to float
+        # Convert all values to float, nested records (e.g. "MATCHING") are kept as they are
         for key, value in data.items():
-            if key == "CORR TYPE":
+            if key == "CORR TYPE" or isinstance(value, (dict, list)):
                 continue
             data[key] = float(value)
 
@@ -636,14 +870,18 @@ class Parameters():
 
 class Loader():
     
-    def __init__(self, project_dir, batch_num, treatment_char, fish_num, params):
+    def __init__(self, project_dir, batch_num, treatment_char, fish_num, params, store='csv'):
 
         self.project_dir = project_dir
         self.batch_num = batch_num
         self.treatment_char = treatment_char
         self.PARAMS = params
 
+        assert store in TRAJECTORY_STORES, f"store must be one of {TRAJECTORY_STORES}"
+        self.store = store
+
         self.fish_name = SAVED_TRAJECTORY_FORMAT.format(fish_num)
+        self.fish_stem = FISH_KEY_FORMAT.format(fish_num)
 
         try:
             self.TOTAL_FRAMES = int(self.PARAMS["DURATION"] * self.PARAMS["FRAME RATE"])
@@ -668,46 +906,62 @@ class Loader():
 
     def FishLoader(self):
 
-        fish_path = self.trajectories_dir / self.fish_name
-        if not fish_path.exists():
+        fish_path = find_trajectory_path(self.trajectories_dir, self.fish_stem, store = self.store)
+        if fish_path == None:
             _ = TrajectoriesLoader(project_dir = self.project_dir,
                                    batch_num = self.batch_num, 
                                    treatment_char=self.treatment_char,
                                    TOTAL_FRAMES = self.TOTAL_FRAMES, 
-                                   NORMALIZE_RATIO = self.NORMALIZE_RATIO)
+                                   NORMALIZE_RATIO = self.NORMALIZE_RATIO,
+                                   store = self.store)
             return self.FishLoader()
         else:
-            logger.info("Loading fish {} from {}".format(self.fish_name, fish_path))
+            logger.info("Loading fish {} from {}".format(self.fish_stem, fish_path))
             try:
-                fish = pd.read_csv(fish_path)
+                fish = load_trajectory(fish_path)
             except Exception as e:
-                logger.error("Failed to load fish {} from {}".format(self.fish_name, fish_path))
+                logger.error("Failed to load fish {} from {}".format(self.fish_stem, fish_path))
                 logger.error("Something went wrong with the TrajectoriesLoader()")
-                raise ValueError("Failed to load fish {} from {}".format(self.fish_name, fish_path))
+                raise ValueError("Failed to load fish {} from {}".format(self.fish_stem, fish_path))
             return fish
         
 
     def Create_Normalized_Trajectories_And_Save(self, unit):
 
-        logger.info(f"Creating normalized trajectories for {self.fish_name} with unit={unit}...")
+        logger.info(f"Creating normalized trajectories for {self.fish_stem} with unit={unit}...")
 
         
         save_dir = get_normalized_trajectories_dir(project_dir = self.project_dir, 
                                                     batch_num = self.batch_num, 
                                                     treatment_char = self.treatment_char,
                                                     unit = unit)
-        save_path = save_dir / f"{self.fish_name}"
+
+        PARAMS_HASH = params_hash({"unit": unit,
+                                   "CONVERSION TV": self.PARAMS["CONVERSION TV"],
+                                   "X POSITION": self.PARAMS["X POSITION"],
+                                   "Y POSITION": self.PARAMS["Y POSITION"],
+                                   "Z POSITION": self.PARAMS["Z POSITION"]})
 
         if save_dir.exists():
-            if save_path.exists():
-                logger.debug(f"{self.fish_name} file existed, skip saving")
-                return
+            save_path = find_trajectory_path(save_dir, self.fish_stem, store = self.store)
+            if save_path != None and save_path.suffix == f".{self.store}":
+                metadata = load_trajectory_metadata(save_path)
+                # .csv files carry no metadata, they are kept as before
+                if metadata == None or metadata.get("params_hash") == PARAMS_HASH:
+                    logger.debug(f"{self.fish_stem} file existed, skip saving")
+                    return
+                logger.info(f"Parameters changed since {save_path} was saved, overwriting")
         else:
             save_dir.mkdir(parents=True, exist_ok=True)
 
+        metadata = {"batch": self.batch_num,
+                    "treatment": self.treatment_char,
+                    "unit": unit,
+                    "params_hash": PARAMS_HASH}
+
         normalized_df = self.Normalizer(input_fish_df = self.FISH, unit=unit)
-        normalized_df.to_csv(save_path, index=False)
-        logger.info(f"Trajectory of {self.fish_name} saved to {save_path}")
+        save_path = save_trajectory(normalized_df, save_dir / self.fish_stem, store = self.store, metadata = metadata)
+        logger.info(f"Trajectory of {self.fish_stem} saved to {save_path}")
 
 
     def Normalizer(self, input_fish_df, unit="pixel"):
@@ -729,8 +983,66 @@ class Loader():
         return normalized_df
         
 
+    def Targets(self):
+        """
+        Named points of the tank, compared with the X, Y, Z columns of the trajectory:
+        X and Y are top view pixels, Z is side view pixels * NORMALIZE_RATIO (CONVERSION TV / CONVERSION SV).
+        "CENTER" is (CENTER X, CENTER Y, CENTER Z) as saved in parameters.json, like the original distance_to(),
+        CENTER Z is therefore not rescaled. The user points saved under "TARGETS" in essential_coords.json, 
+        e.g. "TARGETS": {"FEEDER": [120, 80, 900]}, are taken in the trajectory scale
+        :return: dict name -> [X, Y, Z]
+        """
+        targets = {"CENTER": [self.PARAMS[f"CENTER {axis}"] for axis in ["X", "Y", "Z"]]}
+
+        user_annotation_path = get_static_dir(self.project_dir, self.batch_num, self.treatment_char) / "essential_coords.json"
+        try:
+            with open(user_annotation_path, 'r') as file:
+                user_targets = json.load(file).get("TARGETS", {})
+        except FileNotFoundError:
+            user_targets = {}
+        except Exception as e:
+            logger.warning(f"Failed to read the targets of {user_annotation_path}: {e}")
+            user_targets = {}
+
+        for name, point in user_targets.items():
+            if len(point) != 3:
+                logger.warning(f"Target {name} of {user_annotation_path} ignored, [X, Y, Z] expected, got {point}")
+                continue
+            targets[name] = [float(value) for value in point]
+
+        return targets
+
+
+    def distances_to(self, TARGETS=None):
+        """
+        Distance of every frame to every target, the pixel distance is converted with CONVERSION TV
+        :param TARGETS: list of target names (see Targets()), None = all
+        :return: DataFrame (frames, targets), cm
+        """
+        targets = self.Targets()
+        if TARGETS == None:
+            TARGETS = list(targets.keys())
+
+        missing = [name for name in TARGETS if name not in targets]
+        if len(missing) > 0:
+            raise KeyError(f"Unknown target(s) {missing}, available: {list(targets.keys())}")
+
+        points = [targets[name] for name in TARGETS]
+        distances = point_distances(self.FISH[["X", "Y", "Z"]].to_numpy(dtype=np.float64), points)
+        distances = distances/self.PARAMS["CONVERSION TV"]
+
+        return pd.DataFrame(distances, index=self.FISH.index, columns=TARGETS)
+
+
     def distance_to(self, TARGET="CENTER"):
 
+        return self.distances_to([TARGET])[TARGET].tolist()
+
+
+    def distance_to_loop(self, TARGET="CENTER"):
+        """
+        Original row-by-row implementation of distance_to(), kept as reference for equivalence checks
+        """
         MARKS = {}
         for axis in ["X", "Y", "Z"]:
             MARKS[axis] = self.PARAMS[f"{TARGET} {axis}"]
@@ -749,16 +1061,37 @@ class Loader():
     
 
     def distance_in(self, distance_list, positions, position_name):
+        """
+        :param distance_list: distance of every step, the step i starts at frame i
+        :return: the distances of the steps starting in position_name, [0] * len(distance_list) if the fish never was there
+        """
+        distance_list = np.asarray(distance_list, dtype=np.float64)
+        mask = zone_masks(positions[:len(distance_list)], [position_name])[position_name]
 
-        unique_positions = list(set(positions))
-        if position_name not in unique_positions:
+        if not mask.any():
             logger.debug("Position {} not found in positions list".format(position_name))
             return [0] * len(distance_list)
         else:
-            return [x for i, x in enumerate(distance_list) if positions[i] == position_name]
+            return distance_list[mask].tolist()
+
+
+    def zone_sums(self, values, positions):
+        """
+        Sum of values (one per step or frame) in every zone
+        :return: dict zone -> sum
+        """
+        values = np.asarray(values, dtype=np.float64)
+        masks = zone_masks(positions[:len(values)], ZONES)
+        return {zone: float(values[mask].sum()) for zone, mask in masks.items()}
 
 class CustomDisplay():
 
+    # Result classes only store their attributes in __slots__, no per-instance __dict__
+    __slots__ = ()
+
+    # Names of the per-frame series, dropped by drop_series()
+    SERIES = ()
+
     def __init__(self):
 
         pass
@@ -775,28 +1108,49 @@ class CustomDisplay():
 
         message = "Variables:\n"
         for variable in self.get_variables():
-            message += f'{str(variable)}: {str(getattr(self, variable))}\n'
+            message += f'{str(variable)}: {str(getattr(self, variable, None))}\n'
 
         return message
 
+    def drop_series(self):
+        """
+        Release the per-frame series once the summary statistics are computed
+        """
+        for name in self.SERIES:
+            setattr(self, name, None)
+
+
+def series_array(values, dtype = None):
+    """
+    :param dtype: storage type of the series, SERIES_DTYPE if None. Summary statistics are computed before the conversion
+    """
+    return np.asarray(values, dtype = SERIES_DTYPE if dtype is None else dtype)
+
 
 class Time(CustomDisplay):
 
-    def __init__(self, time_list):
+    __slots__ = ("list", "duration", "percentage", "not_duration", "not_percentage", "unit")
+    SERIES = ("list",)
+
+    def __init__(self, time_list, dtype = None):
 
-        self.list = time_list  # [1, 1, 1, 0, 0, 0, 1, 0]
+        time_list = np.asarray(time_list)  # [1, 1, 1, 0, 0, 0, 1, 0]
 
-        self.duration = sum(self.list)  # in frames
+        self.duration = time_list.sum()  # in frames
         # print(f'Duration: {self.duration} / {len(self.list)}')
-        self.percentage = self.duration / len(self.list) * 100
-        self.not_duration = len(self.list) - self.duration  # in frames
+        self.percentage = self.duration / len(time_list) * 100
+        self.not_duration = len(time_list) - self.duration  # in frames
         self.not_percentage = 100 - self.percentage
         self.unit = 's'
 
+        self.list = series_array(time_list, dtype)
+
     
 
 class Events(CustomDisplay):
 
+    __slots__ = ("dict", "count", "longest", "percentage", "unit")
+
     def __init__(self, event_dict, duration):
 
         self.dict = event_dict
@@ -818,52 +1172,70 @@ class Events(CustomDisplay):
 
 class Area(CustomDisplay):
 
-    def __init__(self, area_list):
+    __slots__ = ("list", "avg", "unit")
+    SERIES = ("list",)
+
+    def __init__(self, area_list, dtype = None):
 
-        self.list = area_list
-        self.avg = round(mean(self.list), ALLOWED_DECIMALS)
+        area_list = np.asarray(area_list, dtype=np.float64)
+        self.avg = round(float(np.mean(area_list)), ALLOWED_DECIMALS)
         self.unit = 'cm^2'
+
+        self.list = series_array(area_list, dtype)
     
 
     def __add__(self, other):
 
-        temp_list = self.list + other.list
-        return Area(temp_list, self.hyp)
+        temp_list = np.concatenate([self.list, other.list])
+        return Area(temp_list)
     
 
 
 class Distance(CustomDisplay):
 
-    def __init__(self, distance_list):
+    __slots__ = ("list", "total", "avg", "unit")
+    SERIES = ("list",)
+
+    def __init__(self, distance_list, dtype = None):
 
-        self.list = distance_list
+        distance_list = np.asarray(distance_list, dtype=np.float64)
 
-        self.total = round(sum(self.list), ALLOWED_DECIMALS)
-        self.avg = round(mean(self.list), ALLOWED_DECIMALS)
+        self.total = round(float(np.sum(distance_list)), ALLOWED_DECIMALS)
+        self.avg = round(float(np.mean(distance_list)), ALLOWED_DECIMALS)
         self.unit = 'cm'
 
+        self.list = series_array(distance_list, dtype)
+
 
     def __add__(self, other):
 
-        temp_list = self.list + other.list
-        return Distance(temp_list, self.hyp)
+        temp_list = np.concatenate([self.list, other.list])
+        return Distance(temp_list)
     
 
 
 class Speed(CustomDisplay):
 
-    def __init__(self, speed_list, total_frames):
+    __slots__ = ("list", "sorted_list", "total_frames", "max", "min", "avg", "unit", "slow", "medium", "fast")
+    SERIES = ("list", "sorted_list")
 
-        self.list = speed_list
+    def __init__(self, speed_list, total_frames, dtype = None):
+
+        speed_list = np.asarray(speed_list, dtype=np.float64)
         self.total_frames = total_frames
 
-        self.max = round(max(self.list), ALLOWED_DECIMALS)
-        self.min = round(min(self.list), ALLOWED_DECIMALS)
-        self.avg = round(mean(self.list), ALLOWED_DECIMALS)
+        self.max = round(float(np.max(speed_list)), ALLOWED_DECIMALS)
+        self.min = round(float(np.min(speed_list)), ALLOWED_DECIMALS)
+        self.avg = round(float(np.mean(speed_list)), ALLOWED_DECIMALS)
         self.unit = 'cm/s'
 
+        # thresholds are compared in float64, only the stored series use dtype
+        self.sorted_list = np.sort(speed_list)
         self.Classifier()
 
+        self.list = series_array(speed_list, dtype)
+        self.sorted_list = series_array(self.sorted_list, dtype)
+
     
     def __add__(self, other):
 
@@ -871,7 +1243,7 @@ class Speed(CustomDisplay):
         if not hasattr(other, 'list') or not hasattr(other, 'total_frames'):
             raise AttributeError("Other object doesn't have 'list' or 'total_frames' attribute")
 
-        temp_list = self.list + other.list
+        temp_list = np.concatenate([self.list, other.list])
 
         if self.total_frames != other.total_frames:
             raise ValueError(f"Total frames of self and other are not the same, {self.total_frames=} != {other.total_frames=}")
@@ -879,43 +1251,67 @@ class Speed(CustomDisplay):
             return Speed(temp_list, self.total_frames)
 
     def Classifier(self, 
-                   THRESHOLD_1 = 1,
-                   THRESHOLD_2 = 10):
-
-        slow_count = 0
-        medium_count = 0
-        fast_count = 0
-
-        for speed in self.list:
-            if speed < THRESHOLD_1:
-                slow_count += 1
-            elif speed < THRESHOLD_2:
-                medium_count += 1
-            else:
-                fast_count += 1
+                   THRESHOLD_1 = SPEED_THRESHOLDS[0],
+                   THRESHOLD_2 = SPEED_THRESHOLDS[1]):
+
+        self.slow, self.medium, self.fast = self.Percentages(THRESHOLD_1, THRESHOLD_2)
+
+
+    def Percentages(self, THRESHOLD_1, THRESHOLD_2):
+        """
+        :return: percentage of frames with speed < THRESHOLD_1, < THRESHOLD_2 and >= THRESHOLD_2
+        """
+        if self.sorted_list is None:
+            raise ValueError("The speed series was dropped, recalculate the speed to classify it again")
+
+        counts = threshold_counts(self.sorted_list, [THRESHOLD_1, THRESHOLD_2])
+
+        return tuple(round(count / self.total_frames * 100, ALLOWED_DECIMALS) for count in counts.tolist())
 
-        self.slow = round(slow_count / self.total_frames * 100, ALLOWED_DECIMALS)
-        self.medium = round(medium_count / self.total_frames * 100, ALLOWED_DECIMALS)
-        self.fast = round(fast_count / self.total_frames * 100, ALLOWED_DECIMALS)
+
+    def Sweep(self, threshold_sets):
+        """
+        Freezing / Swimming / Rapid Movement percentages for several thresholds, the speeds are only sorted once
+        :param threshold_sets: list of (THRESHOLD_1, THRESHOLD_2)
+        :return: DataFrame indexed by (THRESHOLD_1, THRESHOLD_2)
+        """
+        threshold_sets = [tuple(thresholds) for thresholds in threshold_sets]
+        rows = [self.Percentages(*thresholds) for thresholds in threshold_sets]
+        return pd.DataFrame(rows, 
+                            index=pd.MultiIndex.from_tuples(threshold_sets, names=["THRESHOLD_1", "THRESHOLD_2"]), 
+                            columns=["Freezing Time", "Swimming Time", "Rapid Movement Time"])
 
         
 
 class Angle(CustomDisplay):
 
+    __slots__ = ("angle_class", "frame_rate", "CACHE", "interval", "list", "absolute", "total", "avg", "unit", "velocity")
+    SERIES = ("list", "absolute")
+
     def __init__(self, angle_class, frame_rate, interval=1):
 
         self.angle_class = angle_class
         self.frame_rate = frame_rate
 
+        # interval -> (list, absolute, total, avg, velocity), filled by set_interval() and precompute()
+        self.CACHE = {}
+
         self.interval = -1
         self.set_interval(interval=interval)
 
 
-    def calculate_velocity(self):
+    def calculate_velocity(self, angles=None, interval=None):
+        """
+        :param angles, interval: turning angles and their interval, default to the current ones
+        """
+        if angles is None:
+            angles = self.list
+        if interval is None:
+            interval = self.interval
 
-        def chunk_calc(input_list : list[float], chunk_size : int) -> list[float]:
+        def chunk_calc(input_list : np.ndarray, chunk_size : int) -> np.ndarray:
             logger.debug(f"Calculated angular velocity using chunk_calc(), {chunk_size=}")
-            return [abs(sum(input_list[i:i+chunk_size]))%180 for i in range(0, len(input_list), chunk_size)]
+            return np.abs(chunk_sums(input_list, chunk_size)) % 180
         
         # angular_velocity_list = []
         # for i in range(len(self.list)):
@@ -923,9 +1319,9 @@ class Angle(CustomDisplay):
         #     angular_velocity = self.list[i]
         #     angular_velocity_list.append(angular_velocity)
         #     # UNIT: degree/s
-        chunk_size = int(self.frame_rate/self.interval)
-        print(f"{chunk_size=}, {self.frame_rate=} {self.interval=}")
-        angular_velocity_list = chunk_calc(input_list=self.list, chunk_size=chunk_size)
+        chunk_size = int(self.frame_rate/interval)
+        logger.debug(f"{chunk_size=}, {self.frame_rate=} {interval=}")
+        angular_velocity_list = chunk_calc(input_list=angles, chunk_size=chunk_size)
 
         # [NOTE] Used same name for the class and the variablwe to save memory, but they are different
             
@@ -934,57 +1330,122 @@ class Angle(CustomDisplay):
         return angular_velocity
     
 
+    def precompute(self, intervals):
+        """
+        Calculate the turning angles of several intervals at once, set_interval() then reuses them
+        """
+        intervals = [interval for interval in intervals if interval not in self.CACHE]
+        for interval, angles in self.angle_class.turning_angles_multi(intervals).items():
+            self.CACHE[interval] = self.interval_state(interval, angles)
+
+
+    def interval_state(self, interval, angles):
+
+        absolute = np.abs(angles)
+        return (series_array(angles), 
+                series_array(absolute), 
+                round(float(np.sum(absolute)), ALLOWED_DECIMALS), 
+                round(float(np.mean(absolute)), ALLOWED_DECIMALS), 
+                self.calculate_velocity(angles = angles, interval = interval))
+
+
     def set_interval(self, interval):
         
         if self.interval == interval:
             logger.warning(f"Interval is already {self.interval}, no need to set again.")
         else:
             logger.info(f"Setting interval to {interval}")
+
+            if interval not in self.CACHE:
+                angles = self.angle_class.turning_angles(interval=interval)
+                self.CACHE[interval] = self.interval_state(interval, angles)
+
             self.interval = interval
-            
-            self.list = self.angle_class.turning_angles(interval=self.interval)
-            self.absolute = [abs(x) for x in self.list]
-            self.total = round(sum(self.absolute), ALLOWED_DECIMALS)
-            self.avg = round(mean(self.absolute), ALLOWED_DECIMALS)
+            self.list, self.absolute, self.total, self.avg, self.velocity = self.CACHE[interval]
             self.unit = 'degree'
 
-            self.velocity = self.calculate_velocity()
+
+    def clear_cache(self):
+        """
+        Forget the turning angles of the other intervals, the current one stays set
+        """
+        self.CACHE = {interval: state for interval, state in self.CACHE.items() if interval == self.interval}
+
+
+    def drop_series(self):
+        """
+        The summary of the current interval is kept, set_interval() recalculates the series when needed
+        """
+        super().drop_series()
+        self.velocity.drop_series()
+        self.CACHE = {}
+        self.interval = -1
 
 
 
 class Speed_A(CustomDisplay):
 
-    def __init__(self, speed_a_list):
+    __slots__ = ("list", "sorted_list", "total_instances", "max", "min", "avg", "unit", "slow", "fast")
+    SERIES = ("list", "sorted_list")
 
-        self.list = speed_a_list
+    def __init__(self, speed_a_list, dtype = None):
+
+        self.list = np.asarray(speed_a_list, dtype=np.float64)
         self.total_instances = len(self.list)
 
-        self.max = round(max(self.list), ALLOWED_DECIMALS)
-        self.min = round(min(self.list), ALLOWED_DECIMALS)
-        self.avg = round(mean(self.list), ALLOWED_DECIMALS)
+        self.max = round(float(np.max(self.list)), ALLOWED_DECIMALS)
+        self.min = round(float(np.min(self.list)), ALLOWED_DECIMALS)
+        self.avg = round(float(np.mean(self.list)), ALLOWED_DECIMALS)
         self.unit = 'degree/s'
 
+        self.Check_Range()
+        self.sorted_list = np.sort(self.list)
+
         self.Classifier()
 
+        self.list = series_array(self.list, dtype)
 
-    def Classifier(self, THRESHOLD = 90):
 
-        slow_count = 0
-        fast_count = 0
+    def Check_Range(self):
 
-        for i, speed in enumerate(self.list):
-            if speed < 0:
-                raise Exception(f"Negative speed, {speed=} found, please check your input.")
-            if speed > 181:
-                raise Exception(f"Speed > 180, {speed=} found at position {i}/{len(self.list)} please check your input.")
-            
-            if speed <= THRESHOLD:
-                slow_count += 1
-            else:
-                fast_count += 1
+        negative = np.flatnonzero(self.list < 0)
+        if len(negative) > 0:
+            speed = self.list[negative[0]]
+            raise Exception(f"Negative speed, {speed=} found, please check your input.")
+
+        too_fast = np.flatnonzero(self.list > 181)
+        if len(too_fast) > 0:
+            i = too_fast[0]
+            speed = self.list[i]
+            raise Exception(f"Speed > 180, {speed=} found at position {i}/{len(self.list)} please check your input.")
+
+
+    def Classifier(self, THRESHOLD = ANGULAR_VELOCITY_THRESHOLD):
 
-        self.slow = round(slow_count / self.total_instances * 100, ALLOWED_DECIMALS)
-        self.fast = round(fast_count / self.total_instances * 100, ALLOWED_DECIMALS)
+        self.slow, self.fast = self.Percentages(THRESHOLD)
+
+
+    def Percentages(self, THRESHOLD):
+        """
+        :return: percentage of angular velocities <= THRESHOLD and > THRESHOLD
+        """
+        if self.sorted_list is None:
+            raise ValueError("The angular velocity series was dropped, set the interval again to classify it")
+
+        counts = threshold_counts(self.sorted_list, [THRESHOLD], inclusive = True)
+
+        return tuple(round(count / self.total_instances * 100, ALLOWED_DECIMALS) for count in counts.tolist())
+
+
+    def Sweep(self, thresholds):
+        """
+        Slow / Fast angular velocity percentages for several thresholds
+        :return: DataFrame indexed by THRESHOLD
+        """
+        rows = [self.Percentages(threshold) for threshold in thresholds]
+        return pd.DataFrame(rows, 
+                            index=pd.Index(thresholds, name="THRESHOLD"), 
+                            columns=["Slow Angular Velocity Percentage", "Fast Angular Velocity Percentage"])
 
     
     def plot_histogram(self, bins=100, DISPLAY=True, save_path=None, excel_path=None, fish_num=None):
@@ -1003,7 +1464,7 @@ class Speed_A(CustomDisplay):
             plt.savefig(save_path)
 
         if excel_path and fish_num:
-            if fish_num == 1:
+            if fish_num == 1 and os.path.exists(excel_path):
                 os.unlink(excel_path)
             if os.path.exists(excel_path):
                 index=False
@@ -5,17 +5,21 @@ import pandas as pd
 import re
 import os
 import shutil
-from scipy.spatial import ConvexHull
+from scipy.spatial import ConvexHull, cKDTree
+from scipy.stats import rankdata
+from scipy.optimize import linear_sum_assignment
 import numpy as np
 import openpyxl
 import subprocess
 import cv2 
+import hashlib
+import warnings
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-from . import HISTORY_PATH, EPSILON
+from . import HISTORY_PATH, EPSILON, TRAJECTORY_STORES
 
 def num_to_ord(input_number):
     suf = lambda n: "%d%s"%(n,{1:"st",2:"nd",3:"rd"}.get(n%100 if (n%100)<20 else n%10,"th"))
@@ -161,10 +165,14 @@ def compute_turning_angle(x1, y1, x2, y2, x3, y3):
 #         return index_number
     
 def event_extractor(binary_list, positive_token = None):
+    """
+    Runs of consecutive positive_token in binary_list
+    :return: {(start, end): length}, end included
+    """
 
     # find unique values in the binary list
     # binary_list is a list
-    unique_values = list(set(binary_list))
+    unique_values = np.unique(np.asarray(binary_list)).tolist()
 
     if len(unique_values) == 2:
         if positive_token is None:
@@ -180,24 +188,129 @@ def event_extractor(binary_list, positive_token = None):
             if positive_token not in unique_values:
                 raise ValueError("The specified positive token is not in the binary list.")
     
-    binary_list = [1 if i == positive_token else 0 for i in binary_list]
+    starts, lengths = mask_runs(np.asarray(binary_list) == positive_token)
+
+    return {(start, start + length - 1): length for start, length in zip(starts.tolist(), lengths.tolist())}
+
+def mask_runs(mask):
+    """
+    Find the runs of consecutive True values in a boolean mask
+    :param mask: 1D boolean array-like
+    :return: (starts, lengths) as integer arrays, one entry per run
+    """
+    mask = np.asarray(mask, dtype=bool)
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    starts = edges[::2]
+    lengths = edges[1::2] - starts
+
+    return starts, lengths
+
+
+def run_length_encode(values):
+    """
+    :param values: 1D array-like (numbers or labels)
+    :return: (run values, starts, lengths), one entry per run of equal consecutive values
+    """
+    values = np.asarray(values)
+    if values.size == 0:
+        return values.copy(), np.array([], dtype=int), np.array([], dtype=int)
+
+    starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    lengths = np.diff(np.concatenate((starts, [values.size])))
+
+    return values[starts], starts, lengths
+
+
+def bouts(values, tokens):
+    """
+    Bouts (runs) of every token at once
+    :return: dict token -> (starts, lengths), empty arrays for the tokens never found
+    """
+    run_values, starts, lengths = run_length_encode(values)
+    return {token: (starts[run_values == token], lengths[run_values == token]) for token in tokens}
+
+
+def speed_outlier_replacer(speed_list, threshold = 50):
+    """
+    Replace every speed >= threshold by the last preceding speed below threshold (forward fill of the last valid value).
+    Frame 0 is never used as a replacement source and outliers without a valid predecessor are kept,
+    same as the original backward search.
+    :return: (replaced speeds as np.ndarray, replace_count, lengths of the outlier runs)
+    """
+    speeds = np.asarray(speed_list, dtype=float)
+    if speeds.size == 0:
+        return speeds.copy(), 0, np.array([], dtype=int)
+
+    outliers = speeds >= threshold
+    valid = speeds < threshold
+    valid[0] = False
 
-    result = {}
-    start, end = None, None
+    # index of the last valid frame seen so far, -1 if none
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(speeds.size), -1))
+    # the source has to be strictly before the outlier frame
+    source = np.concatenate(([-1], last_valid[:-1]))
 
-    for i in range(len(binary_list)):
-        if binary_list[i] == 1:
-            if start is None:
-                start = i
-            end = i
-        elif start is not None:
-            result[(start, end)] = end - start + 1
-            start, end = None, None
+    replace = outliers & (source >= 0)
+    replaced_speeds = speeds.copy()
+    replaced_speeds[replace] = speeds[source[replace]]
 
-    if start is not None:
-        result[(start, end)] = end - start + 1
+    _, run_lengths = mask_runs(outliers)
 
-    return result
+    return replaced_speeds, int(replace.sum()), run_lengths
+
+
+
+def chunk_sums(values, chunk_size):
+    """
+    Sum of every chunk of chunk_size consecutive values, the last chunk may be shorter
+    :return: np.ndarray, one sum per chunk
+    """
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return values.copy()
+    return np.add.reduceat(values, np.arange(0, values.size, chunk_size))
+
+
+def threshold_counts(sorted_values, thresholds, inclusive = False):
+    """
+    Number of values in each class delimited by the thresholds, NaN values fall in the last class
+    :param sorted_values: values sorted with np.sort
+    :param thresholds: increasing thresholds, n thresholds make n+1 classes
+    :param inclusive: if True a value equal to a threshold belongs to the lower class (value <= threshold),
+                      else to the upper class (value < threshold for the lower one)
+    :return: np.ndarray of counts, one per class
+    """
+    edges = np.searchsorted(sorted_values, thresholds, side = "right" if inclusive else "left")
+    return np.diff(np.concatenate(([0], edges, [len(sorted_values)])))
+
+
+def point_distances(coords, points):
+    """
+    Euclidean distance of every frame to every point, in one broadcasted operation
+    :param coords: array (frames, axes)
+    :param points: array (targets, axes)
+    :return: array (frames, targets)
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+
+    # float_power and the left-to-right sum over the axes mirror the scalar loop of Loader.distance_to_loop()
+    squared = np.float_power(coords[:, None, :] - points[None, :, :], 2)
+    distance = squared[:, :, 0]
+    for axis in range(1, squared.shape[2]):
+        distance = distance + squared[:, :, axis]
+
+    return np.sqrt(distance)
+
+
+def zone_masks(positions, zones):
+    """
+    :param positions: zone name of every frame
+    :return: dict zone -> boolean mask of the frames in the zone
+    """
+    positions = np.asarray(positions)
+    return {zone: positions == zone for zone in zones}
 
 def has_csv_file(directory_path):
     directory = Path(directory_path)
@@ -229,71 +342,82 @@ def remove_sheet_by_name(file_path, sheet_name):
     else:
         return False
 
-############################################# FD and Entropy Calculator #############################################
+############################################### CORRELATION MATRIX ###############################################
 
-def FD_Entropy_Calculator(input_df):
+def pearson_matrix(matrix1, matrix2):
+    """
+    Pearson correlation of every column of matrix1 with every column of matrix2, same value as scipy pearsonr per pair
+    :param matrix1: array (samples, columns1)
+    :param matrix2: array (samples, columns2)
+    :return: array (columns1, columns2), NaN where a column is constant or contains NaN
+    """
+    matrix1 = np.asarray(matrix1, dtype=np.float64)
+    matrix2 = np.asarray(matrix2, dtype=np.float64)
 
-    def countif(input_list, threshold, less=True):
-        count = 0
-        for value in input_list:
-            if less and value < threshold:
-                count+=1
-            elif not less and value > threshold:
-                count+=1
-            
-        return count
+    if matrix1.shape[0] != matrix2.shape[0]:
+        raise ValueError("The matrices have different numbers of samples!")
 
-    x_list = input_df['X']
-    y_list = input_df['Y']
-    z_list = input_df['Z']
+    centered1 = matrix1 - matrix1.mean(axis=0)
+    centered2 = matrix2 - matrix2.mean(axis=0)
 
-    FRAMES = len(x_list)
-    
-    times = [i/50 for i in range(FRAMES)] # D
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized1 = centered1 / np.linalg.norm(centered1, axis=0)
+        normalized2 = centered2 / np.linalg.norm(centered2, axis=0)
+
+    return np.clip(normalized1.T @ normalized2, -1.0, 1.0)
 
-    delta_x = {} #E
-    delta_y = {} #F
-    delta_z = {} #G
-    delta_r = {} #H
-    thetas = {}  #I  
 
-    for i in range(FRAMES):
-        if i==0:
+def spearman_matrix(matrix1, matrix2):
+    """
+    Spearman correlation = Pearson correlation of the ranks (ties get the average rank, as scipy spearmanr)
+    :return: array (columns1, columns2)
+    """
+    ranks1 = rankdata(np.asarray(matrix1, dtype=np.float64), axis=0)
+    ranks2 = rankdata(np.asarray(matrix2, dtype=np.float64), axis=0)
+
+    return pearson_matrix(ranks1, ranks2)
+
+
+def assignment_margin(cost_matrix, row_ind, col_ind):
+    """
+    Cost of the second best assignment minus the cost of the best one (row_ind, col_ind),
+    the second best is found by forbidding each edge of the best assignment in turn
+    :return: margin, inf if there is no other feasible assignment
+    """
+    best_cost = cost_matrix[row_ind, col_ind].sum()
+
+    second_cost = math.inf
+    for i, j in zip(row_ind, col_ind):
+        forbidden = cost_matrix.copy()
+        forbidden[i, j] = math.inf
+        try:
+            rows, cols = linear_sum_assignment(forbidden)
+        except ValueError:
+            # no feasible assignment without this edge
             continue
-        temp_x = x_list[i] - x_list[i-1]
-        temp_y = y_list[i] - y_list[i-1]
-        temp_z = z_list[i] - z_list[i-1]
-        temp_r = math.sqrt(temp_x**2+temp_y**2+temp_z**2)
-
-        delta_x[i] = temp_x
-        delta_y[i] = temp_y
-        delta_z[i] = temp_z
-        delta_r[i] = temp_r
-
-        if i>1:
-            dot_product = (delta_x[i]*delta_x[i-1] + delta_y[i]*delta_y[i-1] + delta_z[i]*delta_z[i-1])
-            product_of_magnitudes = (delta_r[i]*delta_r[i-1])
-            value = dot_product / (product_of_magnitudes + EPSILON)
-            value = max(-1, min(1, value))
-            temp_theta = math.acos(value)*180/math.pi
-            thetas[i] = temp_theta
+        second_cost = min(second_cost, forbidden[rows, cols].sum())
 
-    # r          #J
-    N1 = {}      #K
-    # N2 = {       #L
-    Cr = {}      #M
-    sigma = {}   #N
-    logr = {}    #O
-    logCr = {}   #P
-    
-    thresholds = [(i+1)/10 for i in range(FRAMES)]
-    index_1 = thresholds.index(1)
-    thresholds = thresholds[:index_1] + [1.01] + thresholds[(index_1+1):]
-    thresholds[:20]
+    return second_cost - best_cost
 
-    for i in range(FRAMES):
-        N1[i] = countif(list(delta_r.values()), thresholds[i])
-        Cr[i] = N1[i] / (FRAMES - 1)
+
+############################################# FD and Entropy Calculator #############################################
+
+def correlation_integral(delta_r, thresholds, frames):
+    """
+    Correlation integral of the step lengths for many thresholds at once.
+    N1[i] = number of steps strictly shorter than thresholds[i], found with a binary search on the sorted steps
+    instead of scanning all steps for every threshold (O(N log N) instead of O(N^2)).
+    :return: N1, Cr, logCr as dicts keyed like thresholds (Cr == 0 is replaced by 10e-10 before the log)
+    """
+    sorted_r = np.sort(np.asarray(delta_r, dtype=float))
+    counts = np.searchsorted(sorted_r, np.asarray(list(thresholds.values()), dtype=float), side='left')
+
+    N1 = {}
+    Cr = {}
+    logCr = {}
+    for i, count in zip(thresholds.keys(), counts.tolist()):
+        N1[i] = count
+        Cr[i] = N1[i] / (frames - 1)
 
         try:
             logCr[i] = math.log10(Cr[i])
@@ -303,72 +427,104 @@ def FD_Entropy_Calculator(input_df):
             Cr[i] = 10e-10
             logCr[i] = math.log10(Cr[i])
 
-        sigma[i] = math.log10(Cr[i])/math.log10(thresholds[i])
-        logr[i] = math.log10(thresholds[i])
-
-        
+    return N1, Cr, logCr
 
-    APPROCH = 0.000
-    neg_close = math.inf*(-1)
-    neg_close_pos = -1
-    for i, value in enumerate(list(logr.values())):
-        if value < APPROCH and value > neg_close:
-            neg_close = value
-            neg_close_pos = i
 
-    table_index = list(range(-5, 6))
-    table_index.reverse()
-    table_index
-
-    FD_df = pd.DataFrame(columns = ['number', 'logari', 'logariC', 'x-xbar', 'y-ybar', 
-                            '(x-xbar)(y-ybar)', '(x-xbar)2', '(y-ybar)2', '[yi-(a+bxi)]2'])
-
-    FD_df['number'] = table_index
-    LEN = len(table_index)
-
-    # row, col
-    for row in range(LEN):
-        num = table_index[row]
-        num = num + neg_close_pos
-        FD_df.iloc[row,1] = logr[num]                             # R
-        FD_df.iloc[row,2] = logCr[num]                            # S
+def least_squares_fit(x, y):
+    """
+    Simple linear regression y = a + b*x with the standard errors of the spreadsheet template
+    :param x, y: 1D float arrays of the same length (> 2)
+    :return: dict with slope b, intercept a, residual std s, slope error bErr, intercept error aErr and R^2 RR
+    """
+    LEN = len(x)
 
-    col1 = np.array(list(FD_df['logari']))
-    col2 = np.array(list(FD_df['logariC']))
-    col1_avg = np.average(col1)                                     # average of R
-    col2_avg = np.average(col2)                                     # average of S
+    x_avg = np.average(x)                          # average of R
+    y_avg = np.average(y)                          # average of S
 
-    for row in range(LEN):
-        FD_df.iloc[row,3] = FD_df.iloc[row,1] - col1_avg             # T
-        FD_df.iloc[row,4] = FD_df.iloc[row,2] - col2_avg             # U
-        FD_df.iloc[row,5] = FD_df.iloc[row,3] * FD_df.iloc[row,4]    # V
-        FD_df.iloc[row,6] = FD_df.iloc[row,3]**2                     # W
-        FD_df.iloc[row,7] = FD_df.iloc[row,4]**2                     # X
+    # float_power mirrors the scalar **2 of the spreadsheet port (np.square can differ by 1 ulp)
+    x_dev = x - x_avg                              # T
+    y_dev = y - y_avg                              # U
+    xy_dev = x_dev * y_dev                         # V
+    xx_dev = np.float_power(x_dev, 2)              # W
+    yy_dev = np.float_power(y_dev, 2)              # X
 
     #P4 =SUM(U16:U26)/SUM(V16:V26)
     #P5 =AVERAGE(Q16:Q26)-P4*AVERAGE(P16:P26)
-
-    variable_b = np.sum(np.array(list(FD_df['(x-xbar)(y-ybar)']))) / np.sum(np.array(list(FD_df['(x-xbar)2'])))     # P4
-    variable_a = col2_avg - col1_avg*variable_b                                                                     # P5
+    b = np.sum(xy_dev) / np.sum(xx_dev)
+    a = y_avg - x_avg*b
 
     # '[yi-(a+bxi)]2' =(Q16-($P$5+$P$4*P16))^2
-    for row in range(LEN):
-            FD_df.iloc[row,8] = (FD_df.iloc[row,2]-(variable_a+variable_b*FD_df.iloc[row,1]))**2     # Y
-        
+    residuals = np.float_power(y - (a + b*x), 2)   # Y
+
     #P6 =SQRT(SUM(X16:X26)/(COUNT(X16:X26)-2))
-    variable_s = np.sqrt( np.sum(np.array(list(FD_df['[yi-(a+bxi)]2']))) / (LEN-2) )
+    s = np.sqrt(np.sum(residuals) / (LEN-2))
 
     #R4 =P6/SQRT(SUM(V16:V26))
-    variable_bErr = variable_s / np.sqrt(np.sum(np.array(list(FD_df['(x-xbar)2'])))) 
+    bErr = s / np.sqrt(np.sum(xx_dev))
 
     #R5 =P6*SQRT((1/COUNT(X16:X26))+(AVERAGE(P16:P26)^2)/SUM(V16:V26))
-    variable_aErr = variable_s*np.sqrt((1/LEN)+col1_avg**2/np.sum(np.array(list(FD_df['(x-xbar)2']))))
+    aErr = s*np.sqrt((1/LEN)+x_avg**2/np.sum(xx_dev))
 
     #RR = =(SUM(U16:U26)^2)/(SUM(V16:V26)*SUM(W16:W26))
-    variable_RR = np.sum(np.array(list(FD_df['(x-xbar)(y-ybar)'])))**2 / (np.sum(np.array(list(FD_df['(x-xbar)2']))) * np.sum(np.array(list(FD_df['(y-ybar)2']))))
+    RR = np.sum(xy_dev)**2 / (np.sum(xx_dev) * np.sum(yy_dev))
+
+    return {"b": b, "a": a, "s": s, "bErr": bErr, "aErr": aErr, "RR": RR}
+
+
+def FD_Entropy_Calculator(input_df, window_only = True, return_stats = False):
+    """
+    Fractal Dimension (correlation dimension of the step lengths) and Entropy (of the 3D turning angles)
+    :param window_only: only evaluate the 11 thresholds used by the regression around log(r) = 0,
+                        set to False to evaluate one threshold per frame like the original spreadsheet
+    :param return_stats: also return the regression errors {"bErr", "aErr", "RR"} as a third value
+    """
+    coords = input_df[['X', 'Y', 'Z']].to_numpy(dtype=float)
+    FRAMES = len(coords)
+
+    deltas = np.diff(coords, axis=0)            # E, F, G
+    # float_power mirrors the scalar x**2 (C pow) of the spreadsheet port
+    squared = np.float_power(deltas, 2)
+    delta_r = np.sqrt(squared[:, 0] + squared[:, 1] + squared[:, 2])    # H
+
+    dot_product = deltas[1:, 0]*deltas[:-1, 0] + deltas[1:, 1]*deltas[:-1, 1] + deltas[1:, 2]*deltas[:-1, 2]
+    product_of_magnitudes = delta_r[1:]*delta_r[:-1]
+    values = np.clip(dot_product / (product_of_magnitudes + EPSILON), -1, 1)
+    thetas = np.arccos(values)*180/math.pi    # I
+
+    # r          #J
+    # N1         #K
+    # Cr         #M
+    # logr       #O
+    # logCr      #P
+
+    def threshold(i):
+        # r = 0.1, 0.2, ..., 0.9, 1.01, 1.1, ...
+        return 1.01 if i == 9 else (i+1)/10
+
+    # log(r) < 0 only for r < 1, the closest one to 0 is the last threshold below 1
+    neg_close_pos = min(FRAMES, 9) - 1
+
+    table_index = list(range(-5, 6))
+    table_index.reverse()
+
+    if window_only:
+        indices = [num + neg_close_pos for num in table_index]
+        indices = [i for i in indices if 0 <= i < FRAMES]
+    else:
+        indices = range(FRAMES)
+
+    thresholds = {i: threshold(i) for i in indices}
+    logr = {i: math.log10(r) for i, r in thresholds.items()}
+    N1, Cr, logCr = correlation_integral(delta_r, thresholds, FRAMES)
+
+    # R (log r) and S (log Cr) of the regression table
+    logari = np.array([logr[num + neg_close_pos] for num in table_index])
+    logariC = np.array([logCr[num + neg_close_pos] for num in table_index])
+
+    regression = least_squares_fit(logari, logariC)
 
     def get_entropy():
-        G_array = np.array(list(thetas.values()))
+        G_array = thetas
         G_count = (G_array >= 90).sum()
         G_count2 = (G_array < 90).sum()
         G_len = G_array.size
@@ -380,32 +536,139 @@ def FD_Entropy_Calculator(input_df):
     #H (Entropy)
     variable_Entropy = get_entropy()
 
-    FractalDimension = variable_b
+    FractalDimension = regression["b"]
     Entropy = variable_Entropy
 
+    if return_stats:
+        stats = {"bErr": regression["bErr"],
+                 "aErr": regression["aErr"],
+                 "RR": regression["RR"]}
+        return FractalDimension, Entropy, stats
+
     return FractalDimension, Entropy
 
 
 ############################################## SHOALING AREA / VOLUME ##############################################
 
 
-def HullVolumeCalculator(fishes_coords, surface = ['X', 'Y', 'Z'], save_dir = None):
-    volumes = []
+def stack_fishes_coords(fishes_coords, surface = ['X', 'Y', 'Z']):
+    """
+    Stack the coordinates of all fishes into one array
+    :param fishes_coords: {fish_num: DataFrame with surface columns}, all with the same number of frames
+    :return: np.ndarray of shape (frames, fish, len(surface))
+    """
+    return np.stack([df[surface].to_numpy(dtype=float) for df in fishes_coords.values()], axis=1)
+
+
+def triangle_areas(points):
+    """
+    Area of 2D triangles, points has shape (frames, 3, 2)
+    """
+    ab = points[:, 1] - points[:, 0]
+    ac = points[:, 2] - points[:, 0]
+    return 0.5 * np.abs(ab[:, 0]*ac[:, 1] - ab[:, 1]*ac[:, 0])
+
+
+def tetrahedron_volumes(points):
+    """
+    Volume of 3D tetrahedrons, points has shape (frames, 4, 3)
+    """
+    edges = points[:, 1:] - points[:, :1]
+    return np.abs(np.linalg.det(edges)) / 6
+
+
+def monotone_chain_area(points):
+    """
+    Area of the 2D convex hull of a single frame, points has shape (fish, 2)
+    Andrew's monotone chain, collinear or duplicated points give an area of 0 (same as a failed Qhull call)
+    """
+    pts = sorted(set(map(tuple, points.tolist())))
+    if len(pts) < 3:
+        return 0.0
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower = []
+    for p in pts:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+
+    upper = []
+    for p in reversed(pts):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+
+    hull = lower[:-1] + upper[:-1]
+
+    # Shoelace formula
+    area = 0.0
+    for i in range(len(hull)):
+        x1, y1 = hull[i]
+        x2, y2 = hull[(i+1) % len(hull)]
+        area += x1*y2 - x2*y1
+
+    return abs(area) / 2
+
+
+def qhull_measure(points):
+    """
+    Area (2D) or volume (3D) of the convex hull of a single frame using Qhull, 0 if the hull cannot be calculated
+    """
+    try:
+        return ConvexHull(points).volume
+    except: # In case the convex hull cannot be calculated
+        return 0
+
+
+def convex_hull_measures(coords, engine = "batched"):
+    """
+    Per-frame convex hull area (2D) or volume (3D)
+    :param coords: np.ndarray of shape (frames, fish, dims), dims = 2 or 3
+    :param engine: "batched" uses closed forms for the smallest groups (triangle, tetrahedron),
+                   monotone chain for larger 2D groups and Qhull for larger 3D groups,
+                   "qhull" calls Qhull for every frame (reference)
+    :return: np.ndarray of shape (frames,)
+    """
+    assert engine in ["batched", "qhull"], "engine must be either 'batched' or 'qhull'"
+
+    num_frames, num_fish, dims = coords.shape
+    measures = np.zeros(num_frames)
+
+    # Frames with missing coordinates can't form a hull
+    finite = np.isfinite(coords).all(axis=(1, 2))
+
+    if engine == "qhull":
+        for frame in np.flatnonzero(finite):
+            measures[frame] = qhull_measure(coords[frame])
+        return measures
+
+    if num_fish < dims + 1:
+        # Not enough points for a non-degenerate hull
+        return measures
+
+    if dims == 2 and num_fish == 3:
+        measures[finite] = triangle_areas(coords[finite])
+    elif dims == 3 and num_fish == 4:
+        measures[finite] = tetrahedron_volumes(coords[finite])
+    elif dims == 2:
+        for frame in np.flatnonzero(finite):
+            measures[frame] = monotone_chain_area(coords[frame])
+    else:
+        for frame in np.flatnonzero(finite):
+            measures[frame] = qhull_measure(coords[frame])
+
+    return measures
+
+
+def HullVolumeCalculator(fishes_coords, surface = ['X', 'Y', 'Z'], save_dir = None, engine = "batched"):
 
     # Assuming that each fish dataframe has the same number of frames
-    num_frames = list(fishes_coords.values())[0].shape[0]
+    coords = stack_fishes_coords(fishes_coords, surface)
 
-    for frame in range(num_frames):
-        frame_coords = pd.concat([df.iloc[[frame]] for df in fishes_coords.values()])
-        coords_array = frame_coords[surface].to_numpy()
-        
-        # Calculate the convex hull
-        try:
-            hull = ConvexHull(coords_array)
-            hull_volume = hull.volume
-        except: # In case the convex hull cannot be calculated
-            hull_volume = 0
-        volumes.append(hull_volume)
+    volumes = convex_hull_measures(coords, engine = engine)
 
     # Create a dataframe with the calculated volumes
     df_volumes = pd.DataFrame(volumes, columns=['ConvexHullVolume'])
@@ -420,45 +683,249 @@ def HullVolumeCalculator(fishes_coords, surface = ['X', 'Y', 'Z'], save_dir = No
     return df_volumes
 
 
+
+# Groups from this size use a cKDTree per frame for the nearest neighbours instead of the dense pairwise kernel
+KDTREE_MIN_FISH = 50
+# Maximum number of pairwise distances held in memory at once (frames * fish * fish)
+PAIRWISE_CHUNK_SIZE = 2**22
+
+
+def frame_chunks(frames, fish):
+    """
+    Slices of frames so that a chunk of (frames, fish, fish) distances stays below PAIRWISE_CHUNK_SIZE
+    """
+    step = max(1, PAIRWISE_CHUNK_SIZE // max(1, fish * fish))
+    return [slice(start, min(start + step, frames)) for start in range(0, frames, step)]
+
+
+def pairwise_distances(coords):
+    """
+    Distance between every pair of fishes of every frame
+    :param coords: array (frames, fish, axes)
+    :return: array (frames, fish, fish)
+    """
+    delta = coords[:, :, None, :] - coords[:, None, :, :]
+    return np.sqrt(np.einsum('fijk,fijk->fij', delta, delta))
+
+
+def nearest_neighbour_distances(coords, engine = "auto"):
+    """
+    Distance of every fish to its nearest neighbour
+    :param coords: array (frames, fish, axes), fishes with NaN coordinates are ignored in their frames
+    :param engine: "dense" (pairwise kernel), "kdtree" (cKDTree per frame) or "auto" (kdtree from KDTREE_MIN_FISH fishes)
+    :return: array (frames, fish), NaN if the fish or all its neighbours are missing
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    frames, fish, _ = coords.shape
+
+    if engine == "auto":
+        engine = "kdtree" if fish >= KDTREE_MIN_FISH else "dense"
+
+    nearest = np.full((frames, fish), np.nan)
+    if fish < 2:
+        return nearest
+
+    if engine == "kdtree":
+        for frame in range(frames):
+            valid = np.flatnonzero(~np.isnan(coords[frame]).any(axis=1))
+            if len(valid) < 2:
+                continue
+            distances, _ = cKDTree(coords[frame, valid]).query(coords[frame, valid], k=2)
+            nearest[frame, valid] = distances[:, 1]
+        return nearest
+
+    for chunk in frame_chunks(frames, fish):
+        distances = pairwise_distances(coords[chunk])
+        # no self-distance, missing fishes are never the nearest
+        distances[:, np.arange(fish), np.arange(fish)] = np.inf
+        distances[np.isnan(distances)] = np.inf
+        chunk_nearest = distances.min(axis=2)
+        chunk_nearest[np.isinf(chunk_nearest)] = np.nan
+        nearest[chunk] = chunk_nearest
+
+    return nearest
+
+
+def mean_interindividual_distances(coords):
+    """
+    Mean distance over all pairs of fishes of every frame
+    :param coords: array (frames, fish, axes)
+    :return: array (frames,), NaN if less than 2 fishes are present
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    frames, fish, _ = coords.shape
+
+    mean_distances = np.full(frames, np.nan)
+    if fish < 2:
+        return mean_distances
+
+    upper_i, upper_j = np.triu_indices(fish, k=1)
+    for chunk in frame_chunks(frames, fish):
+        pairs = pairwise_distances(coords[chunk])[:, upper_i, upper_j]
+        present = ~np.isnan(pairs)
+        counts = present.sum(axis=1)
+        sums = np.where(present, pairs, 0).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_distances[chunk] = np.where(counts > 0, sums / counts, np.nan)
+
+    return mean_distances
+
+
+def centroid_distances(coords):
+    """
+    Distance of every fish to the centroid of the shoal
+    :param coords: array (frames, fish, axes)
+    :return: array (frames, fish)
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    with warnings.catch_warnings():
+        # frames where every fish is missing
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        centroid = np.nanmean(coords, axis=1, keepdims=True)
+    return np.linalg.norm(coords - centroid, axis=2)
+
+
+def ShoalDistanceCalculator(fishes_coords, surface = ['X', 'Y', 'Z'], engine = "auto"):
+    """
+    Frame-wise nearest neighbour distance, inter-individual distance and distance to the shoal centroid,
+    each averaged over the fishes of the frame
+    :return: DataFrame indexed by Frame, in the unit of the coordinates
+    """
+    coords = stack_fishes_coords(fishes_coords, surface)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        df_distances = pd.DataFrame({"NearestNeighbourDistance": np.nanmean(nearest_neighbour_distances(coords, engine = engine), axis=1),
+                                     "InterIndividualDistance": mean_interindividual_distances(coords),
+                                     "CentroidDistance": np.nanmean(centroid_distances(coords), axis=1)})
+    df_distances.index.name = 'Frame'
+
+    return df_distances
+
+
+def heading_vectors(coords):
+    """
+    Unit heading of every fish from its frame to frame velocity
+    :param coords: array (frames, fish, axes)
+    :return: array (frames, fish, axes), NaN on frame 0, when the fish did not move or a coordinate is missing
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+
+    velocity = np.full(coords.shape, np.nan)
+    velocity[1:] = np.diff(coords, axis=0)
+
+    speed = np.linalg.norm(velocity, axis=2, keepdims=True)
+    speed[speed == 0] = np.nan
+
+    return velocity / speed
+
+
+def heading_alignment(headings):
+    """
+    Polarization (norm of the mean unit heading) and heading correlation (mean cosine over all pairs of fishes) of every frame.
+    Both come from the sum S of the n valid unit headings: polarization = |S| / n and, since the sum of u_i.u_j over the 
+    pairs i != j is |S|^2 - n, heading correlation = (|S|^2 - n) / (n (n - 1))
+    :param headings: array (frames, fish, axes) of unit vectors, see heading_vectors()
+    :return: (polarization, heading_correlation), arrays (frames,), NaN if less than 2 fishes have a heading
+    """
+    valid = ~np.isnan(headings).any(axis=2)
+    n = valid.sum(axis=1).astype(np.float64)
+
+    heading_sum = np.where(valid[:, :, None], headings, 0).sum(axis=1)
+    squared_norm = np.einsum('fk,fk->f', heading_sum, heading_sum)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        polarization = np.where(n >= 2, np.sqrt(squared_norm) / n, np.nan)
+        heading_correlation = np.where(n >= 2, (squared_norm - n) / (n * (n - 1)), np.nan)
+
+    return polarization, heading_correlation
+
+
+def ShoalHeadingCalculator(fishes_coords, surface = ['X', 'Y', 'Z']):
+    """
+    Frame-wise polarization and pairwise heading correlation of the shoal
+    :return: DataFrame indexed by Frame
+    """
+    coords = stack_fishes_coords(fishes_coords, surface)
+
+    polarization, heading_correlation = heading_alignment(heading_vectors(coords))
+
+    df_headings = pd.DataFrame({"Polarization": polarization,
+                                "HeadingCorrelation": heading_correlation})
+    df_headings.index.name = 'Frame'
+
+    return df_headings
+
 ############################################## INHERITED FROM OLD CODE ##############################################
 
-def load_raw_df(txt_path, sep = "\t"):
-    # Read the .txt file into a dataframe
-    raw_df = pd.read_csv(txt_path, sep = sep)
-    
-    # partial_path = Path(*Path(txt_path).parts[-3:]) if len(Path(txt_path).parts) > 3 else Path(txt_path) 
-    
-    # if len(raw_df) > 0:
-    #     print(f'Loaded raw data from ".\{partial_path}"')
-    # else:
-    #     print(f'No data loaded from ".\{partial_path}"')
+RAW_COORDINATE_COLUMN = re.compile(r"[XY]\d+")
+
+
+def load_raw_df(txt_path, sep = "\t", max_frames = None, dtype = "float64", chunksize = None):
+    """
+    Read the X#, Y# columns of an idTracker trajectories .txt file
+    :param max_frames: stop once max_frames rows are read after the leading rows having nan values, None = whole file
+    :param dtype: "float64" or "float32"
+    :param chunksize: number of rows parsed at a time (default: max_frames if given), bounds the memory used
+    :return: raw_df, tanks_list
+    """
+    read_kwargs = dict(sep = sep,
+                       usecols = lambda col: RAW_COORDINATE_COLUMN.fullmatch(str(col).strip()) is not None,
+                       dtype = dtype)
+
+    if max_frames == None and chunksize == None:
+        raw_df = pd.read_csv(txt_path, **read_kwargs)
+    else:
+        if chunksize == None:
+            chunksize = max(int(max_frames), 1)
+
+        chunks = []
+        total_rows = 0
+        leading_nan_rows = None
+        with pd.read_csv(txt_path, chunksize = chunksize, **read_kwargs) as reader:
+            for chunk in reader:
+                if leading_nan_rows == None:
+                    nan_rows = chunk.isnull().to_numpy().any(axis=1)
+                    if not nan_rows.all():
+                        leading_nan_rows = total_rows + leading_true_count(nan_rows)
+                chunks.append(chunk)
+                total_rows += len(chunk)
+                if max_frames != None and leading_nan_rows != None and total_rows - leading_nan_rows >= max_frames:
+                    break
+
+        if len(chunks) == 0:
+            raw_df = pd.read_csv(txt_path, nrows = 0, **read_kwargs)
+        else:
+            raw_df = pd.concat(chunks, ignore_index = True)
+        if max_frames != None and leading_nan_rows != None:
+            raw_df = raw_df.iloc[:leading_nan_rows + int(max_frames)]
+
+    raw_df.columns = [str(col).strip() for col in raw_df.columns]
 
-    # Remove unnecessary columns
     tanks_list = []
     for col in raw_df.columns:
-        if "unnamed" in col.lower() or "prob" in col.lower():
-            raw_df.drop(col, axis=1, inplace=True)
-        if "x" in col.lower():
+        if col.startswith("X"):
             # find the number in the column name
             tank_num = re.findall(r'\d+', col)
             tank_num = int(tank_num[0])
             tanks_list.append(tank_num)
-    # print('Tanks found: ', tanks_list)
 
     return raw_df, tanks_list
 
+def leading_true_count(mask):
+    """
+    :return: length of the run of True at the start of the boolean array
+    """
+    false_idx = np.flatnonzero(~np.asarray(mask, dtype=bool))
+    return int(false_idx[0]) if len(false_idx) > 0 else len(mask)
+
+
 def remove_first_row_if_nan(input_df, limitation):
-    # if the first row of the dataframe has nan values, remove the entire first row
-    removed_rows = 0
-    while len(input_df) > limitation:
-        row_0 = input_df.iloc[0, :]
-        if row_0.isnull().values.any():
-            input_df = input_df.iloc[1:, :]
-            removed_rows += 1
-            # reset index
-            input_df = input_df.reset_index(drop=True)
-        else:
-            break
+    # if the first rows of the dataframe have nan values, remove them, keeping at least limitation rows
+    nan_rows = input_df.isnull().to_numpy().any(axis=1)
+    removed_rows = min(leading_true_count(nan_rows), max(0, len(input_df) - limitation))
+    if removed_rows > 0:
+        input_df = input_df.iloc[removed_rows:, :].reset_index(drop=True)
     return input_df, removed_rows
 
 def clean_df(input_df, fill = False, frames = 0, remove_nan = True, limitation = 15000): 
@@ -482,9 +949,39 @@ def clean_df(input_df, fill = False, frames = 0, remove_nan = True, limitation =
 
     return output_df, removed_rows
 
-def couple_nan_remover(input_df1, input_df2, limitation = 15000):
-    # Balance 2 dataframes
-    
+def fish_columns(input_df):
+    """
+    :return: dict fish number -> coordinate columns of the fish (e.g. 1 -> ["X1", "Y1"])
+    """
+    columns = {}
+    for col in input_df.columns:
+        fish_num = re.findall(r'\d+', str(col))
+        if len(fish_num) > 0:
+            columns.setdefault(int(fish_num[0]), []).append(col)
+    return columns
+
+
+def nan_report(input_df, trimmed_nan_rows):
+    """
+    :param trimmed_nan_rows: boolean mask (rows removed at the start) of the NaN rows of input_df before trimming
+    :return: dict fish number -> {"dropped_frames", "filled_frames"}
+    """
+    report = {}
+    for fish_num, cols in fish_columns(input_df).items():
+        nan_frames = input_df[cols].isnull().to_numpy().any(axis=1)
+        report[fish_num] = {"dropped_frames": int(trimmed_nan_rows[fish_num].sum()),
+                            "filled_frames": int(nan_frames.sum())}
+    return report
+
+
+def couple_nan_remover(input_df1, input_df2, limitation = 15000, return_report = False):
+    """
+    Balance 2 dataframes, remove the first rows having nan values in either of them (keeping at least limitation rows),
+    then only take the first limitation rows
+    :param return_report: also return the number of removed rows and, per fish of each dataframe, 
+                          the removed rows where the fish was missing and the missing rows left to be filled
+    """
+
     length_diff = len(input_df1) - len(input_df2)
     # Remove the last length_diff rows of the longer dataframe
     if length_diff > 0:
@@ -494,49 +991,53 @@ def couple_nan_remover(input_df1, input_df2, limitation = 15000):
         input_df2 = input_df2.iloc[:length_diff, :]
         logger.debug(f"Removed {length_diff} rows from the end of input_df2")
 
-    remove_window = len(input_df1) - limitation
-    origin_length = len(input_df1)
-    drop_rows = []
+    input_df1 = input_df1.reset_index(drop=True)
+    input_df2 = input_df2.reset_index(drop=True)
 
-    for row_num in range(origin_length):
-        try:
-            df1_row = input_df1.iloc[row_num, :]
-            df2_row = input_df2.iloc[row_num, :]
-        except:
-            break
-
-        if df1_row.isnull().values.any() or df2_row.isnull().values.any():
-            drop_rows.append(row_num)
-            remove_window -= 1
+    # Joint nan mask of the 2 views
+    nan_rows = input_df1.isnull().to_numpy().any(axis=1) | input_df2.isnull().to_numpy().any(axis=1)
 
-            # reset index
-            input_df1 = input_df1.reset_index(drop=True)
-            input_df2 = input_df2.reset_index(drop=True)
+    trim_rows = min(leading_true_count(nan_rows), max(0, len(input_df1) - limitation))
 
-        if remove_window <= 0:
-            break
+    trimmed = {}
+    for key, input_df in [("first", input_df1), ("second", input_df2)]:
+        trimmed[key] = {fish_num: input_df[cols].iloc[:trim_rows].isnull().to_numpy().any(axis=1) 
+                        for fish_num, cols in fish_columns(input_df).items()}
 
-    # Remove the row in drop_rows from the dataframe:
-    input_df1.drop(drop_rows)
-    logger.debug(f"Removed {len(drop_rows)} nan-containing rows from first dataframe")
-    input_df2.drop(drop_rows)
-    logger.debug(f"Removed {len(drop_rows)} nan-containing rows from second dataframe")
+    input_df1 = input_df1.iloc[trim_rows:, :].reset_index(drop=True)
+    input_df2 = input_df2.iloc[trim_rows:, :].reset_index(drop=True)
+    logger.debug(f"Removed {trim_rows} nan-containing rows from the beginning of both dataframes")
 
+    limited_rows = 0
     if len(input_df1) > limitation:
         logger.debug(f"Dataframe have {len(input_df1)=} rows, only take the first {limitation} rows")
+        limited_rows = len(input_df1) - limitation
         input_df1 = input_df1.iloc[:limitation, :]
         input_df2 = input_df2.iloc[:limitation, :]
 
-    return input_df1, input_df2
+    if not return_report:
+        return input_df1, input_df2
+
+    report = {"balanced_rows": abs(length_diff),
+              "trimmed_rows": trim_rows,
+              "limited_rows": limited_rows,
+              "frames": len(input_df1),
+              "first": nan_report(input_df1, trimmed["first"]),
+              "second": nan_report(input_df2, trimmed["second"])}
 
+    return input_df1, input_df2, report
 
-def couple_df_cleaner(input_df1, input_df2, fill = True, remove_nan = True, limitation = 15000):
+
+def couple_df_cleaner(input_df1, input_df2, fill = True, remove_nan = True, limitation = 15000, return_report = False):
+    report = None
     # Remove the initial rows with nan values
     if remove_nan:
         logger.info("Removing nans from the beginning of two given trajectories dataframes")
-        input_df1, input_df2 = couple_nan_remover(input_df1, input_df2, limitation)
+        input_df1, input_df2, report = couple_nan_remover(input_df1, input_df2, limitation, return_report = True)
 
     if fill == False:
+        if return_report:
+            return input_df1, input_df2, report
         return input_df1, input_df2
     
     # Fill the nan values using forward fill and backward fill
@@ -560,6 +1061,8 @@ def couple_df_cleaner(input_df1, input_df2, fill = True, remove_nan = True, limi
     else:
         logger.info("First dataframe is clean of nan values")
 
+    if return_report:
+        return output_df1, output_df2, report
     return output_df1, output_df2
 
 def append_df_to_excel(filename, df, sheet_name='Sheet1', startcol=None, startrow=None, col_sep = 0, row_sep = 0,
@@ -709,17 +1212,8 @@ def excel_polish(file_path, batch_num=1, inplace=True):
             continue
         # Select the sheet
         sheet = workbook[sheet_name]
-        
-        # Loop through each column in the sheet
-        for col in sheet.columns:
-            # Set the width of the column to 17.00 (160 pixels)
-            sheet.column_dimensions[col[0].column_letter].width = 17.00
 
-            logger.debug(f"Set column {col[0].column_letter} width to 17.00")
-        
-        # Enable text wrapping for the header row
-        for cell in sheet[1]:
-            cell.alignment = openpyxl.styles.Alignment(wrapText=True, horizontal='center', vertical='center')
+        polish_worksheet(sheet)
 
 
     # Save the modified workbook
@@ -730,6 +1224,189 @@ def excel_polish(file_path, batch_num=1, inplace=True):
         logger.info(f"UNSUCCESS polish for {file_path}")
 
 
+def polish_worksheet(sheet):
+
+    # Loop through each column in the sheet
+    for col in sheet.columns:
+        # Set the width of the column to 17.00 (160 pixels)
+        sheet.column_dimensions[col[0].column_letter].width = 17.00
+
+    # Enable text wrapping for the header row
+    for cell in sheet[1]:
+        cell.alignment = openpyxl.styles.Alignment(wrapText=True, horizontal='center', vertical='center')
+
+
+def last_header_column(sheet):
+    """
+    :return: 1-based index of the last column with a header in the first row, 0 if the sheet has no header
+    """
+    for col_idx in range(sheet.max_column, 0, -1):
+        if sheet.cell(row=1, column=col_idx).value is not None:
+            return col_idx
+    return 0
+
+
+def drop_columns_by_header(sheet, suffixes):
+    """
+    Delete the columns whose header ends with one of the suffixes, then the blank separator columns left behind
+    """
+    for col_idx in range(sheet.max_column, 0, -1):
+        header = sheet.cell(row=1, column=col_idx).value
+        if isinstance(header, str) and header.endswith(tuple(suffixes)):
+            sheet.delete_cols(col_idx)
+
+    last_col = last_header_column(sheet)
+    if last_col < sheet.max_column:
+        sheet.delete_cols(last_col + 1, sheet.max_column - last_col)
+
+    for col_idx in range(last_col, 0, -1):
+        if sheet.cell(row=1, column=col_idx).value is None:
+            if col_idx == 1 or sheet.cell(row=1, column=col_idx-1).value is None:
+                sheet.delete_cols(col_idx)
+
+
+class ExcelReport():
+    """
+    Collect the endpoint, shoaling and average tables of the analyzed treatments in memory, 
+    then write every EndPoints.xlsx once, merging and polishing the cells in the same pass
+    """
+
+    SHOALING_SHEET = "Shoaling"
+
+    def __init__(self):
+        # excel_path -> {"treatments": {char: tables}, "shoaling": {char: df}, "sheets": {name: (df, index)}}
+        self.WORKBOOKS = {}
+
+    def __len__(self):
+        return len(self.WORKBOOKS)
+
+    def workbook_tables(self, excel_path):
+        excel_path = Path(excel_path)
+        if excel_path not in self.WORKBOOKS:
+            self.WORKBOOKS[excel_path] = {"treatments": {}, "shoaling": {}, "sheets": {}}
+        return self.WORKBOOKS[excel_path]
+
+    def Add_Treatment(self, excel_path, treatment_char, endpoints_df, average_df = None, shoaling_df = None):
+        """
+        :param endpoints_df: one row per fish, written with its index to the sheet named treatment_char
+        :param average_df: single row written next to endpoints_df, merged over the fish rows
+        :param shoaling_df: columns appended to the Shoaling sheet, replacing those of the same treatment
+        """
+        tables = self.workbook_tables(excel_path)
+        tables["treatments"][treatment_char] = {"endpoints": endpoints_df, "average": average_df}
+        if shoaling_df is not None:
+            tables["shoaling"][treatment_char] = shoaling_df
+
+    def Add_Sheet(self, excel_path, sheet_name, df, index = True):
+        tables = self.workbook_tables(excel_path)
+        tables["sheets"][sheet_name] = (df, index)
+
+    @staticmethod
+    def remove_sheet(writer, sheet_name):
+        if sheet_name in writer.book.sheetnames:
+            writer.book.remove(writer.book[sheet_name])
+            logger.info(f"Existing sheet {sheet_name} removed.")
+        # pandas < 1.5 keeps its own mapping of the sheets
+        sheets = getattr(writer, "sheets", None)
+        if isinstance(sheets, dict) and sheet_name in sheets:
+            del sheets[sheet_name]
+
+    @staticmethod
+    def clear_sheet(writer, sheet_name):
+        """
+        Replace an existing sheet by an empty one at the same position, the workbook keeps its sheet order
+        """
+        if sheet_name not in writer.book.sheetnames:
+            return
+        index = writer.book.sheetnames.index(sheet_name)
+        ExcelReport.remove_sheet(writer, sheet_name)
+
+        worksheet = writer.book.create_sheet(sheet_name, index)
+        sheets = getattr(writer, "sheets", None)
+        if isinstance(sheets, dict):
+            sheets[sheet_name] = worksheet
+
+    def Write_Treatment(self, writer, treatment_char, tables):
+
+        endpoints_df = tables["endpoints"]
+        endpoints_df.to_excel(writer, sheet_name=treatment_char)
+
+        average_df = tables["average"]
+        if average_df is None:
+            return
+
+        startcol = endpoints_df.index.nlevels + len(endpoints_df.columns)
+        average_df.to_excel(writer, sheet_name=treatment_char, startcol=startcol, index=False)
+
+        worksheet = writer.book[treatment_char]
+        end_row = max(1 + len(endpoints_df), 2)
+        for col_idx in range(startcol + 1, startcol + len(average_df.columns) + 1):
+            if end_row > 2:
+                worksheet.merge_cells(start_row=2, start_column=col_idx, end_row=end_row, end_column=col_idx)
+            worksheet.cell(row=2, column=col_idx).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
+
+    def Write_Shoaling(self, writer, shoaling):
+
+        book = writer.book
+        if self.SHOALING_SHEET in book.sheetnames:
+            sheet = book[self.SHOALING_SHEET]
+            drop_columns_by_header(sheet, [f" {treatment_char}" for treatment_char in shoaling.keys()])
+            last_col = last_header_column(sheet)
+            startcol = last_col + 1 if last_col > 0 else 0
+        else:
+            startcol = 0
+
+        for treatment_char, shoaling_df in shoaling.items():
+            shoaling_df.to_excel(writer, sheet_name=self.SHOALING_SHEET, startcol=startcol, index=False)
+            startcol += len(shoaling_df.columns) + 1
+
+    def Write_Workbook(self, excel_path, tables):
+
+        if excel_path.exists():
+            writer = pd.ExcelWriter(excel_path, engine='openpyxl', mode='a', if_sheet_exists='overlay')
+        else:
+            writer = pd.ExcelWriter(excel_path, engine='openpyxl', mode='w')
+
+        with writer:
+            for sheet_name in list(tables["treatments"].keys()) + list(tables["sheets"].keys()):
+                self.clear_sheet(writer, sheet_name)
+
+            for treatment_char, treatment_tables in tables["treatments"].items():
+                self.Write_Treatment(writer, treatment_char, treatment_tables)
+                logger.debug(f"Sheet {treatment_char} written to {excel_path}")
+
+            if len(tables["shoaling"]) > 0:
+                self.Write_Shoaling(writer, tables["shoaling"])
+
+            for sheet_name, (df, index) in tables["sheets"].items():
+                df.to_excel(writer, sheet_name=sheet_name, index=index)
+
+            for sheet_name in writer.book.sheetnames:
+                if "analysis" in sheet_name.lower():
+                    continue
+                polish_worksheet(writer.book[sheet_name])
+
+        logger.info(f"{excel_path} is written and polished.")
+
+    def Write(self):
+        """
+        :return: dict excel_path -> None if written, else the error message
+        """
+        RESULTS = {}
+        for excel_path, tables in self.WORKBOOKS.items():
+            try:
+                self.Write_Workbook(excel_path, tables)
+                RESULTS[excel_path] = None
+            except Exception as e:
+                logger.error(f"Failed to write {excel_path}")
+                logger.exception(e)
+                RESULTS[excel_path] = str(e)
+
+        self.WORKBOOKS = {}
+
+        return RESULTS
+
+
 def open_explorer(path):
     # Check if the given path exists
     if os.path.exists(path):
@@ -740,6 +1417,258 @@ def open_explorer(path):
 
 
 
+##################################### TRAJECTORY STORE #####################################
+
+def params_hash(params):
+    """
+    Short stable hash of the parameters an intermediate file depends on
+    """
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def save_trajectory(fish_df, save_path, store = "csv", metadata = None, dtype = "float64"):
+    """
+    :param save_path: path of the trajectory, the suffix is replaced according to store
+    :param metadata: (npy only) extra info saved next to the array, e.g. batch, treatment, params_hash
+    :return: path of the saved file
+    """
+    assert store in TRAJECTORY_STORES, f"store must be one of {TRAJECTORY_STORES}"
+
+    save_path = Path(save_path)
+
+    if store == "csv":
+        save_path = save_path.with_suffix(".csv")
+        fish_df.to_csv(save_path, index=False)
+        return save_path
+
+    save_path = save_path.with_suffix(".npy")
+    np.save(save_path, fish_df.to_numpy(dtype=dtype))
+
+    header = {} if metadata == None else dict(metadata)
+    header["columns"] = [str(column) for column in fish_df.columns]
+    header["dtype"] = str(np.dtype(dtype))
+    header["frames"] = len(fish_df)
+    with open(save_path.with_suffix(".json"), "w") as file:
+        json.dump(header, file, indent=4)
+
+    return save_path
+
+
+def load_trajectory_metadata(trajectory_path):
+    metadata_path = Path(trajectory_path).with_suffix(".json")
+    if not metadata_path.exists():
+        return None
+    with open(metadata_path, "r") as file:
+        return json.load(file)
+
+
+def load_trajectory(trajectory_path, mmap = True):
+    """
+    :return: DataFrame of the .csv or .npy trajectory, .npy arrays are memory mapped (read-only) by default
+    """
+    trajectory_path = Path(trajectory_path)
+
+    if trajectory_path.suffix == ".csv":
+        return pd.read_csv(trajectory_path)
+
+    metadata = load_trajectory_metadata(trajectory_path)
+    if metadata == None:
+        raise FileNotFoundError(f"Metadata of {trajectory_path} not found")
+
+    array = np.load(trajectory_path, mmap_mode = "r" if mmap else None)
+    return pd.DataFrame(array, columns = metadata["columns"])
+
+
+def find_trajectory_path(directory, fish_stem, store = "csv"):
+    """
+    :return: path of the saved trajectory named fish_stem, the requested store first, None if not found
+    """
+    directory = Path(directory)
+    suffixes = [".csv", ".npy"] if store == "csv" else [".npy", ".csv"]
+    for suffix in suffixes:
+        trajectory_path = directory / f"{fish_stem}{suffix}"
+        if not trajectory_path.exists():
+            continue
+        if suffix == ".npy" and not trajectory_path.with_suffix(".json").exists():
+            continue
+        return trajectory_path
+    return None
+
+
+def list_trajectories(directory):
+    """
+    :return: dict fish stem -> trajectory path, .csv and .npy files counted once per fish
+    """
+    directory = Path(directory)
+    trajectories = {}
+    if not directory.exists():
+        return trajectories
+    for trajectory_path in sorted(directory.glob("*.npy")):
+        if trajectory_path.with_suffix(".json").exists():
+            trajectories[trajectory_path.stem] = trajectory_path
+    for trajectory_path in sorted(directory.glob("*.csv")):
+        trajectories.setdefault(trajectory_path.stem, trajectory_path)
+    return trajectories
+
+
+def has_trajectory_file(directory_path):
+    return len(list_trajectories(directory_path)) > 0
+
+
+def export_trajectories_to_csv(directory, overwrite = False):
+    """
+    Write a .csv copy of every .npy trajectory in directory
+    :return: list of written .csv paths
+    """
+    written = []
+    for trajectory_path in sorted(Path(directory).glob("*.npy")):
+        csv_path = trajectory_path.with_suffix(".csv")
+        if csv_path.exists() and not overwrite:
+            continue
+        fish_df = load_trajectory(trajectory_path, mmap = False)
+        fish_df.to_csv(csv_path, index=False)
+        written.append(csv_path)
+        logger.info(f"{trajectory_path.name} exported to {csv_path}")
+    return written
+
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_hash(file_path, previous = None):
+    """
+    sha1 of the file content
+    :param previous: record returned earlier for the same file, its sha1 is reused if size and mtime are unchanged
+    :return: record {"size", "mtime_ns", "sha1"}
+    """
+    stat = Path(file_path).stat()
+    if previous != None and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return dict(previous)
+
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha1.update(block)
+
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1.hexdigest()}
+
+
+def load_manifest(directory):
+    manifest_path = Path(directory) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+    try:
+        with open(manifest_path, "r") as file:
+            return json.load(file)
+    except Exception as e:
+        logger.warning(f"Failed to read {manifest_path}: {e}")
+        return None
+
+
+def save_manifest(directory, manifest):
+    manifest_path = Path(directory) / MANIFEST_NAME
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file, indent=4)
+    return manifest_path
+
+
+def trajectory_files(directory):
+    """
+    Saved trajectories (.csv, .npy and their .json metadata) and manifest of directory
+    :return: list of existing paths
+    """
+    directory = Path(directory)
+    if not directory.exists():
+        return []
+
+    files = []
+    for trajectory_path in list(directory.glob("*.csv")) + list(directory.glob("*.npy")):
+        for path in [trajectory_path, trajectory_path.with_suffix(".json")]:
+            if path.exists():
+                files.append(path)
+
+    manifest_path = directory / MANIFEST_NAME
+    if manifest_path.exists():
+        files.append(manifest_path)
+
+    return files
+
+
+def remove_trajectories(directory):
+    """
+    Delete the saved trajectories (.csv, .npy and their .json metadata) and the manifest of directory
+    :return: number of deleted trajectory files
+    """
+    removed = 0
+    for path in trajectory_files(directory):
+        path.unlink()
+        if path.name != MANIFEST_NAME:
+            removed += 1
+
+    return removed
+
+
+def move_trajectories(directory, destination):
+    """
+    Move the saved trajectories and the manifest of directory to destination, other files stay in place
+    :return: number of moved files
+    """
+    files = trajectory_files(directory)
+    if len(files) > 0:
+        Path(destination).mkdir(parents=True, exist_ok=True)
+    for path in files:
+        shutil.move(str(path), str(Path(destination) / path.name))
+
+    return len(files)
+
+
+def json_value(value):
+    """
+    numpy scalars to the python int / float json can write
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def load_endpoints_cache(cache_path):
+    """
+    :return: {group: {"key": ..., "endpoints": {name: {"value", "unit"}}}}, empty if missing or unreadable
+    """
+    cache_path = Path(cache_path)
+    if not cache_path.exists():
+        return {}
+    try:
+        with open(cache_path, "r") as file:
+            cache = json.load(file)
+    except Exception as e:
+        logger.warning(f"Failed to read {cache_path}: {e}")
+        return {}
+
+    if not isinstance(cache, dict):
+        logger.warning(f"Unexpected content in {cache_path}, ignored")
+        return {}
+
+    # Records of another layout are dropped, their groups are recalculated
+    return {group: record for group, record in cache.items() 
+            if isinstance(record, dict) and "key" in record and isinstance(record.get("endpoints"), dict)}
+
+
+def save_endpoints_cache(cache_path, cache):
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    cache = {group: {"key": record["key"],
+                     "endpoints": {name: {"value": json_value(endpoint["value"]), "unit": endpoint["unit"]} 
+                                   for name, endpoint in record["endpoints"].items()}}
+             for group, record in cache.items()}
+
+    with open(cache_path, "w") as file:
+        json.dump(cache, file, indent=4)
+    return cache_path
+
+
 ##################################### CONSTANT GENERATOR #####################################
 
 def get_working_dir(project_dir, batch_num):
@@ -761,6 +1690,23 @@ def get_treatment_dir(project_dir, batch_num, treatment_char):
         raise FileNotFoundError(f"Couldn't find treatment directory with pattern [{treatment_char} -]")
     
 
+def get_batch_nums(project_dir):
+    batch_nums = []
+    for child_dir in Path(project_dir).iterdir():
+        found = re.fullmatch(r"Batch (\d+)", child_dir.name)
+        if child_dir.is_dir() and found:
+            batch_nums.append(int(found.group(1)))
+    return sorted(batch_nums)
+
+def get_treatment_chars(project_dir, batch_num):
+    working_dir = get_working_dir(project_dir, batch_num)
+    treatment_chars = []
+    for child_dir in os.listdir(working_dir):
+        found = re.match(r"([A-Z]) - ", child_dir)
+        if found and (working_dir / child_dir).is_dir():
+            treatment_chars.append(found.group(1))
+    return sorted(treatment_chars)
+
 def get_static_dir(project_dir, batch_num, treatment_char):
     working_dir = get_working_dir(project_dir, batch_num)
     return working_dir / "static" / treatment_char
@@ -773,6 +1719,10 @@ def get_normalized_trajectories_dir(project_dir, batch_num, treatment_char, unit
     static_dir = get_static_dir(project_dir, batch_num, treatment_char)
     return static_dir / f"trajectories_normalized_{unit}"
 
+def get_endpoints_cache_dir(project_dir, batch_num, treatment_char):
+    static_dir = get_static_dir(project_dir, batch_num, treatment_char)
+    return static_dir / "endpoints_cache"
+
 def get_sideview_trajectory_path(project_dir, batch_num, treatment_char):
     treatment_dir = get_treatment_dir(project_dir, batch_num, treatment_char)
     return treatment_dir / "Side View" / "trajectories_nogaps.txt"
@@ -0,0 +1,199 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from Libs.executor import Executor
+from Libs.misc import get_batch_nums, get_treatment_chars, ExcelReport
+from . import TEMPLATE_PATH
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def Treatment_Analyzer(project_dir, batch_num, treatment_char, corr_type='pearson', AV_interval=None, fish_workers=1, store='csv', matching='full', endpoint_cache=True, time_bins=None):
+    """
+    PARAMS_LOADING -> TRAJECTORIES_LOADING -> ENDPOINTS_ANALYSIS of one treatment without touching EndPoints.xlsx.
+    Defined at module level so that it can be sent to a worker process.
+    :return: the Executor holding EndPoints, shoaling data and timing, ready for Export_To_Excel()
+    """
+    executor = Executor(project_dir=project_dir,
+                        batch_num=batch_num,
+                        treatment_char=treatment_char,
+                        EndPointsAnalyze=True,
+                        workers=fish_workers,
+                        store=store,
+                        endpoint_cache=endpoint_cache,
+                        keep_series=False,
+                        time_bins=time_bins)
+
+    ERROR = executor.PARAMS_LOADING()
+    if ERROR != None:
+        raise ValueError(ERROR)
+
+    executor.TRAJECTORIES_LOADING(corr_type = corr_type, matching = matching)
+
+    executor.ENDPOINTS_ANALYSIS(OVERWRITE=True, AV_interval=AV_interval, EXPORT=False)
+
+    executor.Release()
+
+    return executor
+
+
+class Scheduler():
+    """
+    Analyze many treatments (and batches) of a project concurrently in worker processes.
+    The computation runs in the workers, the results are collected by the calling process in the requested order
+    and every EndPoints.xlsx is written once at the end of the run.
+    """
+
+    def __init__(self,
+                 project_dir=None,
+                 batch_nums=None,
+                 treatment_chars=None,
+                 corr_type='pearson',
+                 AV_interval=None,
+                 OVERWRITE=False,
+                 workers=None,
+                 fish_workers=1,
+                 store='csv',
+                 matching='full',
+                 endpoint_cache=True,
+                 time_bins=None,
+                 progress_window=None):
+
+        if project_dir == None:
+            self.project_dir = TEMPLATE_PATH
+            logger.warning("No project directory specified. Using template directory instead.")
+        else:
+            self.project_dir = project_dir
+
+        if batch_nums == None:
+            batch_nums = get_batch_nums(self.project_dir)
+
+        # List of (batch_num, treatment_char), in writing order
+        self.jobs = []
+        for batch_num in batch_nums:
+            if treatment_chars == None:
+                chars = get_treatment_chars(self.project_dir, batch_num)
+            else:
+                chars = treatment_chars
+            for treatment_char in chars:
+                self.jobs.append((batch_num, treatment_char))
+
+        self.corr_type = corr_type
+        self.AV_interval = AV_interval
+        self.OVERWRITE = OVERWRITE
+
+        if workers == None:
+            workers = os.cpu_count() or 1
+        self.workers = max(1, int(workers))
+        self.fish_workers = fish_workers
+        self.store = store
+        self.matching = matching
+        self.endpoint_cache = endpoint_cache
+        self.time_bins = time_bins
+
+        self.progress_window = progress_window
+
+        self.timing = {}
+        self.REPORTS = {}
+
+        self.EXCEL_REPORT = ExcelReport()
+
+
+    def update_progress_bar(self, value, text):
+        if self.progress_window is not None:
+            self.progress_window.group_update(value, text)
+
+
+    def pending_jobs(self):
+        """
+        Skip the treatments already written to EndPoints.xlsx, unless OVERWRITE
+        """
+        pending = []
+        for batch_num, treatment_char in self.jobs:
+            checker = Executor(project_dir=self.project_dir, batch_num=batch_num, treatment_char=treatment_char)
+            if checker.analyzed_check() == "Analyzed" and not self.OVERWRITE:
+                logger.info(f"Batch {batch_num} - {treatment_char} already analyzed, skipped.")
+                self.REPORTS[(batch_num, treatment_char)] = {"status": "Existed", "excel_path": checker.excel_path}
+            else:
+                pending.append((batch_num, treatment_char))
+        return pending
+
+
+    def Writer(self, executor):
+        """
+        Queue the tables of the treatment, existing sheets are replaced when the workbooks are written
+        """
+        executor.Export_To_Excel(excel_path = executor.excel_path, report = self.EXCEL_REPORT)
+
+
+    def Write_Workbooks(self):
+
+        _starttime = time.time()
+
+        ERRORS = self.EXCEL_REPORT.Write()
+
+        for job, report in self.REPORTS.items():
+            if report["status"] != "Completed":
+                continue
+            ERROR = ERRORS.get(report["excel_path"])
+            if ERROR != None:
+                report["status"] = "Failed"
+                report["error"] = ERROR
+
+        self.timing["Excel export"] = time.time() - _starttime
+
+
+    def run(self):
+
+        _starttime = time.time()
+
+        jobs = self.pending_jobs()
+
+        if len(jobs) == 0:
+            logger.info("Nothing to analyze.")
+            return self.REPORTS
+
+        workers = min(self.workers, len(jobs))
+        logger.info(f"Analyzing {len(jobs)} treatments with {workers} worker processes...")
+
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = {}
+            for batch_num, treatment_char in jobs:
+                futures[(batch_num, treatment_char)] = pool.submit(Treatment_Analyzer,
+                                                                   self.project_dir,
+                                                                   batch_num,
+                                                                   treatment_char,
+                                                                   self.corr_type,
+                                                                   self.AV_interval,
+                                                                   self.fish_workers,
+                                                                   self.store,
+                                                                   self.matching,
+                                                                   self.endpoint_cache,
+                                                                   self.time_bins)
+
+            # Write in submission order, results finished early wait for their turn
+            for done, (job, future) in enumerate(futures.items(), start=1):
+                batch_num, treatment_char = job
+                try:
+                    executor = future.result()
+                    self.Writer(executor)
+                    self.REPORTS[job] = {"status": "Completed",
+                                         "excel_path": executor.excel_path,
+                                         "timing": executor.timing}
+                    logger.info(f"Batch {batch_num} - {treatment_char} completed.")
+                except Exception as e:
+                    logger.error(f"Batch {batch_num} - {treatment_char} failed.")
+                    logger.error(e)
+                    self.REPORTS[job] = {"status": "Failed", "error": str(e)}
+
+                self.update_progress_bar(value = done / len(jobs) * 100,
+                                         text = f"Analyzed Batch {batch_num} - {treatment_char}")
+
+        self.Write_Workbooks()
+
+        self.timing["Project analysis"] = time.time() - _starttime
+
+        return self.REPORTS
@@ -45,11 +45,8 @@ customtkinter.set_default_color_theme("green")  # Themes: "blue" (standard), "gr
 ########################################### SETUP LOGGING CONFIGURATION ###############################################
 logger = logging.getLogger(__name__)
 
-Path('Log').mkdir(parents=True, exist_ok=True)
 log_file = 'Log/log.txt'
 
-initiator()
-
 class ContextFilter(logging.Filter):
     """
     This is a filter which injects contextual information into the log.
@@ -59,38 +56,44 @@ class ContextFilter(logging.Filter):
         record.pathname = os.path.basename(record.pathname)  # Modify this line if you want to alter the path
         return True
 
-# Define the log format with colors
-log_format = "%(asctime)s %(log_color)s%(levelname)-8s%(reset)s [%(pathname)s] %(message)s"
 
-# Create a formatter with colored output
-formatter = ColoredFormatter(log_format)
+def setup_logging():
+    """
+    Handlers of the root logger, only set up when main.py is run.
+    The worker processes of the analysis re-import this module on Windows (spawn), they must not add their own handlers
+    """
+    Path('Log').mkdir(parents=True, exist_ok=True)
 
-# Get the root logger
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+    # Define the log format with colors
+    log_format = "%(asctime)s %(log_color)s%(levelname)-8s%(reset)s [%(pathname)s] %(message)s"
 
-# Create a filter
-f = ContextFilter()
+    # Create a formatter with colored output
+    formatter = ColoredFormatter(log_format)
 
-# Create a file handler to save logs to the file
-file_handler = logging.FileHandler(log_file, mode='a')  # Set the mode to 'a' for append
-file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s [%(pathname)s] %(message)s"))
-file_handler.addFilter(f)  # Add the filter to the file handler
-file_handler.setLevel(logging.DEBUG)
+    # Get the root logger
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
 
-# Create a stream handler to display logs on the console with colored output
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-stream_handler.addFilter(f)  # Add the filter to the stream handler
-stream_handler.setLevel(logging.DEBUG)
+    # Create a filter
+    f = ContextFilter()
 
-# Add the handlers to the logger
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+    # Create a file handler to save logs to the file
+    file_handler = logging.FileHandler(log_file, mode='a')  # Set the mode to 'a' for append
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s [%(pathname)s] %(message)s"))
+    file_handler.addFilter(f)  # Add the filter to the file handler
+    file_handler.setLevel(logging.DEBUG)
 
-########################################################################################################################
+    # Create a stream handler to display logs on the console with colored output
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.addFilter(f)  # Add the filter to the stream handler
+    stream_handler.setLevel(logging.DEBUG)
 
-THE_HISTORY = HISTORY()
+    # Add the handlers to the logger
+    root_logger.addHandler(file_handler)
+    root_logger.addHandler(stream_handler)
+
+########################################################################################################################
 
 
 class App(customtkinter.CTk):
@@ -593,10 +596,9 @@ class App(customtkinter.CTk):
             trajectories_n_p = {}
 
             trajectories_n_p_dir = static_dir / 'trajectories_normalized_cm'
-            for csv_path in list(trajectories_n_p_dir.iterdir()):
-                csv_stem = csv_path.stem
+            for csv_stem, csv_path in list_trajectories(trajectories_n_p_dir).items():
                 logger.debug(f"{csv_stem=}")
-                df = pd.read_csv(csv_path)
+                df = load_trajectory(csv_path, mmap=False)
                 try:
                     df.drop("Z_SV", axis=1, inplace=True)
                 except:
@@ -1105,7 +1107,7 @@ class App(customtkinter.CTk):
         
         return True
 
-    def analyze_treatment(self, PROGRESS_WINDOW, treatment_char = None):
+    def analyze_treatment(self, PROGRESS_WINDOW, treatment_char = None, report = None):
 
         if self.CURRENT_PROJECT == "":
             tkinter.messagebox.showerror("Error", "Please select a project")
@@ -1133,7 +1135,8 @@ class App(customtkinter.CTk):
                             batch_num=batch_num, 
                             treatment_char=treatment_char, 
                             EndPointsAnalyze=self.EPA,
-                            progress_window=PROGRESS_WINDOW)
+                            progress_window=PROGRESS_WINDOW,
+                            report=report)
         
         #######################################################################
         PROGRESS_WINDOW.lift()
@@ -1211,27 +1214,45 @@ class App(customtkinter.CTk):
 
         TREATMENT_LIST_CHAR = [self.treatment_to_treatment_char(treatment) for treatment in self.TREATMENTLIST]
 
-        for i, treatment_char in enumerate(TREATMENT_LIST_CHAR):
-            _message = f"Analyzing treatment {treatment_char}"
-            _progress = (i+1) / len(TREATMENT_LIST_CHAR) * 100
-            PROGRESS_WINDOW.group_update(_progress, text = _message)
-            logger.info(_message)
+        # EndPoints.xlsx is written once, after all treatments are analyzed
+        EXCEL_REPORT = ExcelReport()
 
-            # set TreatmentOptions to the analyzing treatment
-            self.TreatmentOptions.set(self.TREATMENTLIST[i])
-            # apply changes to the parameters
-            self.refresh()
+        try:
+            for i, treatment_char in enumerate(TREATMENT_LIST_CHAR):
+                _message = f"Analyzing treatment {treatment_char}"
+                _progress = (i+1) / len(TREATMENT_LIST_CHAR) * 100
+                PROGRESS_WINDOW.group_update(_progress, text = _message)
+                logger.info(_message)
 
-            # ANALYZE TREATMENT
-            EPA_path, _ = self.analyze_treatment(PROGRESS_WINDOW, treatment_char=treatment_char)
+                # set TreatmentOptions to the analyzing treatment
+                self.TreatmentOptions.set(self.TREATMENTLIST[i])
+                # apply changes to the parameters
+                self.refresh()
 
-            time_for_treatment[treatment_char] = time.time() - time0
-            time0 = time.time()
+                # ANALYZE TREATMENT
+                EPA_path, _ = self.analyze_treatment(PROGRESS_WINDOW, treatment_char=treatment_char, report=EXCEL_REPORT)
+
+                time_for_treatment[treatment_char] = time.time() - time0
+                time0 = time.time()
+
+            PROGRESS_WINDOW.group_update(100, text = "Writing EndPoints.xlsx...")
+        finally:
+            # The treatments analyzed before an error are still written
+            WRITE_ERRORS = {excel_path: error for excel_path, error in EXCEL_REPORT.Write().items() if error != None}
 
         # Destroy the progress window
         logger.debug("Destroying the progress window")
         PROGRESS_WINDOW.destroy()
 
+        if len(WRITE_ERRORS) > 0:
+            _message = "Failed to write the results to:"
+            for excel_path, error in WRITE_ERRORS.items():
+                _message += f"\n  {excel_path}: {error}"
+            _message += "\nClose the file if it is open in another program (e.g. Excel) and analyze again."
+            tkinter.messagebox.showerror("Error", _message)
+            logger.error(_message)
+            return
+
         _message = f"Time taken: {round(time.time() - time00, 2)} seconds"
         _message += f"\nTime taken for each treatment:"
         for treatment_char in TREATMENT_LIST_CHAR:
@@ -1308,5 +1329,9 @@ class App(customtkinter.CTk):
 
 
 if __name__ == "__main__":
+    setup_logging()
+    initiator()
+    THE_HISTORY = HISTORY()
+
     app = App()
     app.mainloop()
\ No newline at end of file
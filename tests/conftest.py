@@ -0,0 +1,61 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Libs.misc import get_working_dir, get_static_dir, get_trajectories_dir, save_trajectory
+from Libs import FISH_KEY_FORMAT
+
+
+PROJECT_PARAMS = {"DURATION": 60.0,
+                  "FRAME RATE": 50.0,
+                  "X POSITION": 50.0,
+                  "Y POSITION": 60.0,
+                  "Z POSITION": 900.0,
+                  "CENTER X": 350.0,
+                  "CENTER Y": 350.0,
+                  "CENTER Z": 450.0,
+                  "CONVERSION TV": 29.6,
+                  "CONVERSION SV": 30.65,
+                  "UPPER": 300.0,
+                  "LOWER": 600.0}
+
+
+def swimming_trajectory(frames, seed=0):
+    """
+    Random walk in the tank, diving through the 3 zones, with a few tracking jumps (speed outliers)
+    """
+    rng = np.random.default_rng(seed)
+    X = 350 + np.cumsum(rng.normal(0, 2, size=frames))
+    Y = 350 + np.cumsum(rng.normal(0, 2, size=frames))
+    Z_SV = 450 + 300 * np.sin(np.linspace(0, 6 * np.pi, frames) + seed) + rng.normal(0, 5, size=frames)
+    X[frames // 3] += 400
+
+    df = pd.DataFrame({"X": X, "Y": Y, "Z": Z_SV * PROJECT_PARAMS["CONVERSION TV"] / PROJECT_PARAMS["CONVERSION SV"]})
+    df["Z_SV"] = Z_SV
+    return df
+
+
+@pytest.fixture
+def saved_project(tmp_path):
+    """
+    Project whose Batch 1 - A already has saved trajectories, analyzed without raw files
+    :return: function (fishes, seed=0, store="csv") -> (project_dir, params)
+    """
+    def make(fishes=1, seed=0, store="csv"):
+        # Treatment directory without its raw Side View / Top View trajectories
+        (get_working_dir(tmp_path, 1) / "A - Control").mkdir(parents=True, exist_ok=True)
+        trajectories_dir = get_trajectories_dir(tmp_path, 1, "A")
+        trajectories_dir.mkdir(parents=True, exist_ok=True)
+        with open(get_static_dir(tmp_path, 1, "A") / "parameters.json", "w") as file:
+            json.dump(PROJECT_PARAMS, file, indent=4)
+
+        frames = int(PROJECT_PARAMS["DURATION"] * PROJECT_PARAMS["FRAME RATE"])
+        for fish_num in range(1, fishes + 1):
+            save_trajectory(swimming_trajectory(frames, seed = seed + fish_num),
+                            trajectories_dir / FISH_KEY_FORMAT.format(fish_num),
+                            store = store)
+        return tmp_path, dict(PROJECT_PARAMS)
+
+    return make
@@ -0,0 +1,110 @@
+"""
+Bouts of the zones and of the speed classes, see Zone_Section() and Kinematics_Section()
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from Libs.analyzer import GeneralAnalysis
+from Libs.executor import EndPoints_Adder
+
+
+PARAMS = {"DURATION": 6,
+          "FRAME RATE": 10,
+          "CONVERSION TV": 29.6,
+          "CONVERSION SV": 30.65,
+          "UPPER": 300.0,
+          "LOWER": 600.0}
+
+TOTAL_FRAMES = PARAMS["DURATION"] * PARAMS["FRAME RATE"]
+
+# X steps (pixel) of each speed class: 0 cm/s, ~2.0 cm/s and ~13.5 cm/s
+FREEZE, SWIM, RAPID = 0, 6, 40
+
+
+def analysis(z_sv, x_steps = None):
+    """
+    GeneralAnalysis of a fish moving along X, with the given Z_SV (zones) and X steps (speed classes)
+    """
+    if x_steps is None:
+        x_steps = [SWIM] * (TOTAL_FRAMES - 1)
+    assert len(z_sv) == TOTAL_FRAMES and len(x_steps) == TOTAL_FRAMES - 1
+
+    df = pd.DataFrame({"X": np.concatenate(([100.0], 100 + np.cumsum(x_steps, dtype=float))),
+                       "Y": 200.0,
+                       "Z": 300.0,
+                       "Z_SV": np.asarray(z_sv, dtype=float)})
+
+    fish = GeneralAnalysis.__new__(GeneralAnalysis)
+    fish.PARAMS = PARAMS
+    fish.TOTAL_FRAMES = TOTAL_FRAMES
+    fish.engine = "numpy"
+    fish.FISH = df
+    fish.TJ_df = df
+    fish.BasicCalculation(groups = ["kinematics", "zone"])
+    return fish
+
+
+def z_sv_with_top(*top_ranges):
+    """
+    :param top_ranges: (first, last) frames in the top, inclusive
+    """
+    z_sv = np.full(TOTAL_FRAMES, 450.0)
+    for first, last in top_ranges:
+        z_sv[first:last + 1] = 100.0
+    return z_sv
+
+
+def test_never_in_top():
+    fish = analysis(z_sv_with_top())
+    endpoints = EndPoints_Adder(fish, groups = ["zone"])
+
+    assert endpoints["Latency to the Top"]["value"] == PARAMS["DURATION"]
+    assert endpoints["Total entries to the Top"]["value"] == 0
+    assert endpoints["Average Top Bout Duration"]["value"] == 0
+    assert endpoints["Longest Top Bout Duration"]["value"] == 0
+    assert endpoints["Time in Top"]["value"] == 0
+
+
+def test_top_bouts_at_both_ends():
+    # frames 0-9 (1 s) and 30-59 (3 s, up to the last frame)
+    fish = analysis(z_sv_with_top((0, 9), (30, TOTAL_FRAMES - 1)))
+    endpoints = EndPoints_Adder(fish, groups = ["zone"])
+
+    assert endpoints["Latency to the Top"]["value"] == 0
+    assert endpoints["Total entries to the Top"]["value"] == 2
+    assert endpoints["Average Top Bout Duration"]["value"] == pytest.approx(2.0)
+    assert endpoints["Longest Top Bout Duration"]["value"] == pytest.approx(3.0)
+    assert endpoints["Time in Top"]["value"] == pytest.approx(40 / TOTAL_FRAMES * 100)
+    np.testing.assert_allclose(fish.Bout_Durations("TOP"), [1.0, 3.0])
+
+
+def test_latency_to_the_top():
+    fish = analysis(z_sv_with_top((25, 27), (40, 55)))
+
+    assert fish.latency_to_top == pytest.approx(2.5)
+    assert fish.travel_in_TOP.count == 2
+    assert fish.top_bout_longest == pytest.approx(1.6)
+    assert fish.top_bout_avg == pytest.approx((0.3 + 1.6) / 2)
+
+
+def test_speed_bouts():
+    # steps 0-9 freezing, 10-19 swimming, 20-24 rapid, 25-29 swimming, 30-34 rapid, 35-48 swimming, 49-58 freezing (up to the last step)
+    x_steps = [FREEZE] * 10 + [SWIM] * 10 + [RAPID] * 5 + [SWIM] * 5 + [RAPID] * 5 + [SWIM] * 14 + [FREEZE] * 10
+    fish = analysis(z_sv_with_top(), x_steps)
+    endpoints = EndPoints_Adder(fish, groups = ["kinematics"])
+
+    assert endpoints["Freezing Bouts"]["value"] == 2
+    assert endpoints["Average Freezing Bout Duration"]["value"] == pytest.approx(1.0)
+    assert endpoints["Rapid Movement Bouts"]["value"] == 2
+    np.testing.assert_allclose(fish.Bout_Durations("FREEZING"), [1.0, 1.0])
+    np.testing.assert_allclose(fish.Bout_Durations("RAPID"), [0.5, 0.5])
+    np.testing.assert_allclose(fish.Bout_Durations("SWIMMING"), [1.0, 0.5, 1.4])
+
+
+def test_no_freezing():
+    fish = analysis(z_sv_with_top())
+
+    assert fish.freezing_bouts == 0
+    assert fish.freezing_bout_avg == 0
+    assert fish.rapid_bouts == 0
@@ -0,0 +1,40 @@
+"""
+Per-fish endpoints of Fish_Analyzer()
+"""
+import pytest
+
+from Libs.executor import Fish_Analyzer, ENDPOINT_NAMES
+
+
+# Columns of EndPoints.xlsx before any endpoint was added, they must keep their position
+BASE_COLUMNS = ["Total Distance",
+                "Average Speed",
+                "Total Absolute Turn Angle",
+                "Average Angular Velocity",
+                "Slow Angular Velocity Percentage",
+                "Fast Angular Velocity Percentage",
+                "Meandering",
+                "Freezing Time",
+                "Swimming Time",
+                "Rapid Movement Time",
+                "Time in Top",
+                "Time in Middle",
+                "Time in Bottom",
+                "Average distance to Center of the Tank",
+                "Total distances traveled in Top",
+                "Total entries to the Top",
+                "Fractal Dimension",
+                "Entropy"]
+
+
+def test_base_columns_first():
+    assert list(ENDPOINT_NAMES.keys())[:len(BASE_COLUMNS)] == BASE_COLUMNS
+
+
+@pytest.mark.parametrize("endpoint_cache", [False, True])
+def test_endpoints_order(saved_project, endpoint_cache):
+    project_dir, params = saved_project()
+
+    _, _, endpoints, _ = Fish_Analyzer(project_dir, 1, "A", 1, params, endpoint_cache = endpoint_cache)
+
+    assert list(endpoints.keys()) == list(ENDPOINT_NAMES.keys())
@@ -0,0 +1,108 @@
+"""
+Invalidation of the per-fish endpoints cache, see Cached_EndPoints()
+"""
+import json
+
+import numpy as np
+import pytest
+
+import Libs.analyzer
+from Libs.analyzer import GeneralAnalysis, ENDPOINT_GROUPS
+from Libs.executor import Fish_Analyzer
+from Libs.misc import get_endpoints_cache_dir, get_trajectories_dir, load_trajectory, save_trajectory
+
+
+@pytest.fixture
+def calculated_groups(monkeypatch):
+    """
+    Groups passed to BasicCalculation() by every analysis, in order
+    """
+    calls = []
+    basic_calculation = GeneralAnalysis.BasicCalculation
+
+    def recording(self, DEFAULT_INTERVAL = 1, groups = None):
+        calls.append(list(ENDPOINT_GROUPS) if groups is None else list(groups))
+        return basic_calculation(self, DEFAULT_INTERVAL = DEFAULT_INTERVAL, groups = groups)
+
+    monkeypatch.setattr(GeneralAnalysis, "BasicCalculation", recording)
+    return calls
+
+
+def analyze(project_dir, params, AV_interval = 1, endpoint_cache = True):
+    _, _, endpoints, _ = Fish_Analyzer(project_dir, 1, "A", 1, params, AV_interval = AV_interval, endpoint_cache = endpoint_cache)
+    return endpoints
+
+
+def cache_path(project_dir):
+    return get_endpoints_cache_dir(project_dir, 1, "A") / "Fish 1.json"
+
+
+def test_cached_endpoints_are_reused(saved_project, calculated_groups):
+    project_dir, params = saved_project()
+
+    first = analyze(project_dir, params)
+    second = analyze(project_dir, params)
+
+    assert calculated_groups == [ENDPOINT_GROUPS]
+    assert second == first
+    assert second == analyze(project_dir, params, endpoint_cache = False)
+
+
+def test_new_av_interval_only_recalculates_angles(saved_project, calculated_groups):
+    project_dir, params = saved_project()
+    analyze(project_dir, params, AV_interval = 1)
+
+    endpoints = analyze(project_dir, params, AV_interval = 5)
+
+    assert calculated_groups[1:] == [["angle"]]
+    assert endpoints == analyze(project_dir, params, AV_interval = 5, endpoint_cache = False)
+
+
+def test_new_zone_limits_only_recalculate_zones(saved_project, calculated_groups):
+    project_dir, params = saved_project()
+    analyze(project_dir, params)
+
+    params.update({"UPPER": 350.0, "LOWER": 550.0})
+    endpoints = analyze(project_dir, params)
+
+    assert calculated_groups[1:] == [["zone"]]
+    assert endpoints == analyze(project_dir, params, endpoint_cache = False)
+
+
+def test_new_trajectory_recalculates_everything(saved_project, calculated_groups):
+    project_dir, params = saved_project()
+    analyze(project_dir, params)
+
+    trajectory_path = get_trajectories_dir(project_dir, 1, "A") / "Fish 1.csv"
+    trajectory = load_trajectory(trajectory_path)
+    trajectory["X"] += np.linspace(0, 5, len(trajectory))
+    save_trajectory(trajectory, trajectory_path)
+    endpoints = analyze(project_dir, params)
+
+    assert calculated_groups[1:] == [ENDPOINT_GROUPS]
+    assert endpoints == analyze(project_dir, params, endpoint_cache = False)
+
+
+@pytest.mark.parametrize("content", ["{not json", "[1, 2, 3]", json.dumps({"kinematics": "corrupted", "angle": {"key": 1}})])
+def test_corrupt_cache_is_ignored(saved_project, calculated_groups, content):
+    project_dir, params = saved_project()
+    expected = analyze(project_dir, params)
+
+    cache_path(project_dir).write_text(content)
+    endpoints = analyze(project_dir, params)
+
+    assert calculated_groups[1:] == [ENDPOINT_GROUPS]
+    assert endpoints == expected
+    # and replaced by a valid cache
+    assert analyze(project_dir, params) == expected
+    assert len(calculated_groups) == 2
+
+
+def test_cache_of_another_version_is_ignored(saved_project, calculated_groups, monkeypatch):
+    project_dir, params = saved_project()
+    analyze(project_dir, params)
+
+    monkeypatch.setattr(Libs.analyzer, "ENDPOINT_CACHE_VERSION", Libs.analyzer.ENDPOINT_CACHE_VERSION + 1)
+    analyze(project_dir, params)
+
+    assert calculated_groups[1:] == [ENDPOINT_GROUPS]
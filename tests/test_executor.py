@@ -0,0 +1,55 @@
+"""
+Treatment analysis with the Executor, on saved trajectories
+"""
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import Libs.executor
+from Libs.executor import Executor
+
+
+def analyzed(project_dir, workers):
+    executor = Executor(project_dir = project_dir, batch_num = 1, treatment_char = "A", workers = workers)
+    assert executor.PARAMS_LOADING() is None
+    executor.TRAJECTORIES_LOADING()
+    executor.ENDPOINTS_ANALYSIS(OVERWRITE = True, EXPORT = False)
+    return executor
+
+
+def test_default_workers():
+    assert Executor(project_dir = "unused").workers >= 1
+
+
+def test_parallel_matches_sequential(saved_project):
+    project_dir, _ = saved_project(fishes = 3)
+
+    sequential = analyzed(project_dir, workers = 1)
+    parallel = analyzed(project_dir, workers = 3)
+
+    assert parallel.EndPoints == sequential.EndPoints
+
+
+def test_pool_failure_falls_back_to_sequential(saved_project, monkeypatch):
+    project_dir, _ = saved_project(fishes = 2)
+
+    def broken_pool(self, **kwargs):
+        raise BrokenProcessPool("worker killed")
+    monkeypatch.setattr(Executor, "Fish_Adder_Parallel", broken_pool)
+
+    executor = analyzed(project_dir, workers = 2)
+    assert sorted(executor.EndPoints.keys()) == [1, 2]
+
+
+def test_analysis_error_is_not_rerun(saved_project, monkeypatch):
+    project_dir, _ = saved_project(fishes = 2)
+
+    def failing_analysis(self, **kwargs):
+        raise ValueError("Failed to load fish")
+    def sequential_rerun(*args, **kwargs):
+        pytest.fail("the fishes were analyzed again sequentially")
+    monkeypatch.setattr(Executor, "Fish_Adder_Parallel", failing_analysis)
+    monkeypatch.setattr(Libs.executor, "Fish_Analyzer", sequential_rerun)
+
+    with pytest.raises(ValueError, match="Failed to load fish"):
+        analyzed(project_dir, workers = 2)
@@ -0,0 +1,64 @@
+"""
+Equivalence of the contingency-table Hoeffding's D with the per-sample reference
+"""
+import numpy as np
+import pytest
+
+from Libs.XtendedCorrel import hoeffding, hoeffding_samples, hoeffding_ranks, hoeffding_d, hoeffding_d_loop, hoeffding_matrix, MAX_SAMPLES
+
+
+def samples(n, seed=0, ties=None):
+    """
+    Correlated pair, rounded to `ties` decimals to create ties
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=n)
+    y = x + rng.normal(scale=0.8, size=n)
+    if ties is not None:
+        x, y = np.round(x, ties), np.round(y, ties)
+    return x, y
+
+
+@pytest.mark.parametrize("n, ties", [(5, None), (40, None), (40, 0), (2000, None), (2000, 1), (2000, 0)])
+def test_hoeffding_d(n, ties):
+    x, y = samples(n, seed=n, ties=ties)
+    R, S = hoeffding_ranks(x), hoeffding_ranks(y)
+
+    assert hoeffding_d(R, S) == pytest.approx(hoeffding_d_loop(R, S), rel=1e-12, abs=1e-15)
+
+
+def test_hoeffding_d_constant_column():
+    x, _ = samples(100)
+    R, S = hoeffding_ranks(x), hoeffding_ranks(np.ones(100))
+
+    assert hoeffding_d(R, S) == pytest.approx(hoeffding_d_loop(R, S), rel=1e-12, abs=1e-15)
+
+
+def test_hoeffding_undersampled():
+    x, y = samples(2 * MAX_SAMPLES + 10, ties=2)
+    xs, ys = hoeffding_samples(x, y)
+    assert len(xs) == len(ys) <= MAX_SAMPLES
+
+    R, S = hoeffding_ranks(xs), hoeffding_ranks(ys)
+    assert hoeffding(x, y) == pytest.approx(hoeffding_d_loop(R, S), rel=1e-12, abs=1e-15)
+
+
+@pytest.mark.parametrize("n", [0, 1, 2, 3, 4])
+def test_hoeffding_too_few_samples(n):
+    x, y = samples(n)
+    R, S = hoeffding_ranks(x), hoeffding_ranks(y)
+
+    assert np.isnan(hoeffding_d(R, S))
+    assert np.isnan(hoeffding_d_loop(R, S))
+    assert np.isnan(hoeffding(x, y))
+
+
+def test_hoeffding_matrix():
+    x, y = samples(300, ties=1)
+    matrix = np.column_stack([x, y, x * y])
+    matrix[::7, 2] = np.nan
+
+    result = hoeffding_matrix(matrix, matrix)
+    for i in range(3):
+        for j in range(3):
+            assert result[i, j] == pytest.approx(hoeffding(matrix[:, i], matrix[:, j]), rel=1e-12, abs=1e-15)
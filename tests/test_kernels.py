@@ -0,0 +1,148 @@
+"""
+Equivalence of the vectorized kernels with the reference implementations they replace
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from Libs.analyzer import GeneralAnalysis, TurningAngles
+from Libs.general import Angle
+from Libs.misc import convex_hull_measures
+
+
+PARAMS = {"CONVERSION TV": 23.5,
+          "CONVERSION SV": 19.0,
+          "FRAME RATE": 50,
+          "UPPER": 300.0,
+          "LOWER": 600.0,
+          "CENTER X": 512.0,
+          "CENTER Y": 384.0,
+          "CENTER Z": 450.0}
+
+
+def trajectory(frames, seed=0, nan_rows=(), still_rows=()):
+    """
+    Random walk with NaN rows and zero-length steps (row i repeats row i-1)
+    """
+    rng = np.random.default_rng(seed)
+    coords = 500 + np.cumsum(rng.normal(0, 5, size=(frames, 3)), axis=0)
+    for row in still_rows:
+        coords[row] = coords[row - 1]
+    coords[list(nan_rows)] = np.nan
+
+    df = pd.DataFrame(coords, columns=["X", "Y", "Z"])
+    df["Z_SV"] = df["Z"] * PARAMS["CONVERSION SV"] / PARAMS["CONVERSION TV"]
+    return df
+
+
+def analysis(df, tmp_path):
+    """
+    GeneralAnalysis on an in-memory trajectory, without reading a project
+    """
+    fish = GeneralAnalysis.__new__(GeneralAnalysis)
+    fish.project_dir = tmp_path
+    fish.batch_num = 1
+    fish.treatment_char = "A"
+    fish.PARAMS = PARAMS
+    fish.FISH = df
+    fish.TJ_df = df
+    return fish
+
+
+TRAJECTORIES = {"plain": dict(frames=200),
+                "nan rows": dict(frames=200, nan_rows=(0, 17, 18, 199)),
+                "zero steps": dict(frames=200, still_rows=(5, 6, 7, 120)),
+                "nan and zero steps": dict(frames=200, nan_rows=(30, 31), still_rows=(32, 90)),
+                "single frame": dict(frames=1),
+                "empty": dict(frames=0)}
+
+
+@pytest.mark.parametrize("case", TRAJECTORIES.keys())
+def test_kinematics(case, tmp_path):
+    fish = analysis(trajectory(**TRAJECTORIES[case]), tmp_path)
+
+    distances, speeds, positions = fish.Kinematics_Vectorized()
+    ref_distances, ref_speeds, ref_positions = fish.Kinematics_Reference()
+
+    np.testing.assert_array_equal(distances, ref_distances)
+    np.testing.assert_array_equal(speeds, ref_speeds)
+    assert positions == ref_positions
+
+
+@pytest.mark.parametrize("case", TRAJECTORIES.keys())
+@pytest.mark.parametrize("interval", [1, 3])
+def test_turning_angles(case, interval):
+    df = trajectory(**TRAJECTORIES[case])
+    angles = TurningAngles(df["X"], df["Y"])
+
+    result = angles.turning_angles(interval=interval)
+    reference = angles.turning_angles_loop(interval=interval)
+
+    assert len(result) == len(reference)
+    # acos of the reference loses ~1e-6 degree near 0 and 180 degrees
+    np.testing.assert_allclose(result, reference, rtol=0, atol=1e-5)
+
+
+def test_turning_angles_degenerate():
+    # Straight line, U-turn, step of length 0, NaN coordinate
+    X = [0, 1, 2, 1, 1, np.nan, 3]
+    Y = [0, 0, 0, 0, 0, 0, 0]
+    angles = TurningAngles(X, Y)
+
+    np.testing.assert_allclose(angles.turning_angles(), angles.turning_angles_loop(), rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("case", TRAJECTORIES.keys())
+def test_distance_to_center(case, tmp_path):
+    fish = analysis(trajectory(**TRAJECTORIES[case]), tmp_path)
+
+    np.testing.assert_array_equal(fish.distance_to("CENTER"), fish.distance_to_loop("CENTER"))
+
+
+@pytest.mark.parametrize("dims, num_fish", [(2, 3), (2, 6), (3, 4), (3, 7)])
+def test_convex_hull_measures(dims, num_fish):
+    rng = np.random.default_rng(dims * num_fish)
+    coords = rng.uniform(0, 100, size=(50, num_fish, dims))
+    coords[4, 0, 0] = np.nan
+    coords[9] = coords[9, :1]   # every fish at the same point
+
+    batched = convex_hull_measures(coords, engine="batched")
+    reference = convex_hull_measures(coords, engine="qhull")
+
+    np.testing.assert_allclose(batched, reference, rtol=1e-9, atol=1e-9)
+
+
+def test_convex_hull_measures_empty():
+    coords = np.empty((0, 4, 3))
+
+    assert convex_hull_measures(coords, engine="batched").shape == (0,)
+    assert convex_hull_measures(coords, engine="qhull").shape == (0,)
+
+
+def test_angle_cache_keeps_current_interval():
+    df = trajectory(400)
+    angle = Angle(TurningAngles(df["X"], df["Y"]), frame_rate=PARAMS["FRAME RATE"], interval=1)
+    angle.precompute([1, 2, 5])
+    angle.set_interval(5)
+    total = angle.total
+
+    angle.clear_cache()
+
+    assert list(angle.CACHE.keys()) == [5]
+    assert angle.interval == 5 and angle.total == total
+    angle.set_interval(2)
+    np.testing.assert_allclose(angle.list, TurningAngles(df["X"], df["Y"]).turning_angles(interval=2))
+
+
+def test_targets(tmp_path):
+    fish = analysis(trajectory(50), tmp_path)
+    assert list(fish.Targets().keys()) == ["CENTER"]
+
+    static_dir = tmp_path / "Batch 1" / "static" / "A"
+    static_dir.mkdir(parents=True)
+    (static_dir / "essential_coords.json").write_text('{"TARGETS": {"FEEDER": [500, 400, 450], "BAD": [1, 2]}}')
+
+    distances = fish.distances_to()
+    assert list(distances.columns) == ["CENTER", "FEEDER"]
+    expected = np.linalg.norm(fish.FISH[["X", "Y", "Z"]].to_numpy() - [500, 400, 450], axis=1) / PARAMS["CONVERSION TV"]
+    np.testing.assert_allclose(distances["FEEDER"], expected)
@@ -0,0 +1,125 @@
+"""
+Vectorized helpers of Libs.misc against the loops they replace
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from Libs.misc import speed_outlier_replacer, couple_nan_remover
+
+
+def speed_outlier_loop(speeds, threshold):
+    """
+    Backward search of the original Kinematics section
+    """
+    speed_list = []
+    replace_count = 0
+    for i in range(len(speeds)):
+        speed = speeds[i]
+        if speed >= threshold:
+            for j in range(i-1, 0, -1):
+                if speed_list[j] < threshold:
+                    speed = speed_list[j]
+                    replace_count += 1
+                    break
+        speed_list.append(speed)
+    return speed_list, replace_count
+
+
+def speeds_with_outliers(frames, seed, outlier_frames=()):
+    rng = np.random.default_rng(seed)
+    speeds = rng.uniform(0, 20, size=frames)
+    # runs of outliers of random lengths
+    for start in rng.integers(0, frames, size=frames // 20):
+        speeds[start:start + rng.integers(1, 6)] = rng.uniform(50, 200)
+    speeds[list(outlier_frames)] = 75.0
+    return speeds
+
+
+@pytest.mark.parametrize("seed, outlier_frames", [(0, ()), (1, (0,)), (2, (1,)), (3, (0, 1)), (4, (0, 1, 2, 3)), (5, (299,))])
+def test_speed_outlier_replacer(seed, outlier_frames):
+    speeds = speeds_with_outliers(300, seed, outlier_frames)
+    speeds[[40, 41]] = np.nan
+
+    replaced, replace_count, run_lengths = speed_outlier_replacer(speeds, threshold=50)
+    reference, reference_count = speed_outlier_loop(speeds.tolist(), threshold=50)
+
+    np.testing.assert_array_equal(replaced, reference)
+    assert replace_count == reference_count
+    assert run_lengths.sum() == np.count_nonzero(speeds >= 50)
+
+
+def test_speed_outlier_replacer_threshold_and_edges():
+    # equal to the threshold is an outlier, frame 0 is never a source
+    speeds = [10, 50, 60, 5, 50, 49.9]
+    replaced, replace_count, run_lengths = speed_outlier_replacer(speeds, threshold=50)
+    reference, reference_count = speed_outlier_loop(speeds, threshold=50)
+
+    np.testing.assert_array_equal(replaced, reference)
+    assert replace_count == reference_count == 1
+    assert run_lengths.tolist() == [2, 1]
+
+    replaced, replace_count, run_lengths = speed_outlier_replacer([], threshold=50)
+    assert replaced.size == 0 and replace_count == 0 and run_lengths.size == 0
+
+
+def view(frames, seed, nan_cells=()):
+    """
+    Raw trajectories of 2 fishes, nan_cells = [(row, fish)]
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.uniform(0, 500, size=(frames, 4)), columns=["X1", "Y1", "X2", "Y2"])
+    for row, fish in nan_cells:
+        df.loc[row, [f"X{fish}", f"Y{fish}"]] = np.nan
+    return df
+
+
+def test_couple_nan_remover_balances_lengths():
+    first, second = view(10, 0), view(12, 1)
+
+    cleaned1, cleaned2, report = couple_nan_remover(first, second, limitation = 100, return_report = True)
+
+    assert len(cleaned1) == len(cleaned2) == 10
+    pd.testing.assert_frame_equal(cleaned2, second.iloc[:10])
+    assert report["balanced_rows"] == 2
+    assert report["trimmed_rows"] == 0 and report["limited_rows"] == 0
+
+
+def test_couple_nan_remover_joint_leading_rows():
+    # rows 0-2 missing in the second view only, row 3 in the first view only, row 6 is not leading
+    first = view(20, 0, nan_cells=[(3, 2), (6, 1)])
+    second = view(20, 1, nan_cells=[(0, 1), (1, 1), (2, 1), (2, 2)])
+
+    cleaned1, cleaned2, report = couple_nan_remover(first, second, limitation = 10, return_report = True)
+
+    assert report["trimmed_rows"] == 4
+    assert report["limited_rows"] == 6
+    assert report["frames"] == len(cleaned1) == len(cleaned2) == 10
+    pd.testing.assert_frame_equal(cleaned1, first.iloc[4:14].reset_index(drop=True))
+    pd.testing.assert_frame_equal(cleaned2, second.iloc[4:14].reset_index(drop=True))
+
+    assert report["first"] == {1: {"dropped_frames": 0, "filled_frames": 1},
+                               2: {"dropped_frames": 1, "filled_frames": 0}}
+    assert report["second"] == {1: {"dropped_frames": 3, "filled_frames": 0},
+                                2: {"dropped_frames": 1, "filled_frames": 0}}
+
+
+def test_couple_nan_remover_keeps_limitation_rows():
+    # 6 leading NaN rows but only 2 can go without falling below the limitation
+    first = view(10, 0, nan_cells=[(row, 1) for row in range(6)])
+    second = view(10, 1)
+
+    cleaned1, _, report = couple_nan_remover(first, second, limitation = 8, return_report = True)
+
+    assert report["trimmed_rows"] == 2 and report["limited_rows"] == 0
+    assert len(cleaned1) == 8
+    assert report["first"][1] == {"dropped_frames": 2, "filled_frames": 4}
+
+
+def test_couple_nan_remover_without_report():
+    first, second = view(30, 0), view(30, 1)
+
+    cleaned1, cleaned2 = couple_nan_remover(first, second, limitation = 25)
+
+    pd.testing.assert_frame_equal(cleaned1, first.iloc[:25])
+    pd.testing.assert_frame_equal(cleaned2, second.iloc[:25])
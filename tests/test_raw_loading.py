@@ -0,0 +1,110 @@
+"""
+Reading only the needed frames of the raw idTracker trajectories
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from Libs.general import TrajectoriesLoader
+from Libs.misc import load_raw_df, couple_df_cleaner
+
+
+def raw_txt(path, frames, fishes=2, nan_rows=(), seed=0):
+    """
+    idTracker trajectories_nogaps.txt: X#, Y#, ProbId# columns, tab separated with a trailing tab in the header
+    :param nan_rows: rows where every fish is missing
+    """
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for fish in range(1, fishes + 1):
+        columns[f"X{fish}"] = np.round(rng.uniform(0, 1000, frames), 2)
+        columns[f"Y{fish}"] = np.round(rng.uniform(0, 1000, frames), 2)
+        columns[f"ProbId{fish}"] = np.round(rng.uniform(0, 1, frames), 5)
+    df = pd.DataFrame(columns)
+    for fish in range(1, fishes + 1):
+        df.loc[list(nan_rows), [f"X{fish}", f"Y{fish}"]] = np.nan
+
+    lines = ["\t".join(df.columns) + "\t"]
+    for row in df.itertuples(index=False):
+        lines.append("\t".join("NaN" if np.isnan(value) else repr(value) for value in row))
+    path.write_text("\n".join(lines) + "\n")
+    return path
+
+
+def test_only_coordinate_columns(tmp_path):
+    path = raw_txt(tmp_path / "trajectories_nogaps.txt", 20, fishes=3)
+
+    raw_df, tanks_list = load_raw_df(path)
+
+    assert list(raw_df.columns) == ["X1", "Y1", "X2", "Y2", "X3", "Y3"]
+    assert tanks_list == [1, 2, 3]
+    assert raw_df.dtypes.unique().tolist() == [np.float64]
+
+
+@pytest.mark.parametrize("chunksize", [None, 1, 3, 7, 1000])
+@pytest.mark.parametrize("leading_nan", [0, 5, 12])
+def test_max_frames(tmp_path, chunksize, leading_nan):
+    path = raw_txt(tmp_path / "trajectories_nogaps.txt", 60, nan_rows=range(leading_nan))
+    full_df, _ = load_raw_df(path)
+
+    raw_df, tanks_list = load_raw_df(path, max_frames = 10, chunksize = chunksize)
+
+    # max_frames rows are kept after the leading nan rows
+    pd.testing.assert_frame_equal(raw_df, full_df.iloc[:leading_nan + 10])
+    assert tanks_list == [1, 2]
+
+
+def test_max_frames_longer_than_file(tmp_path):
+    path = raw_txt(tmp_path / "trajectories_nogaps.txt", 15, nan_rows=range(3))
+    full_df, _ = load_raw_df(path)
+
+    raw_df, _ = load_raw_df(path, max_frames = 100, chunksize = 4)
+
+    pd.testing.assert_frame_equal(raw_df, full_df)
+
+
+def test_only_nan_rows(tmp_path):
+    path = raw_txt(tmp_path / "trajectories_nogaps.txt", 15, nan_rows=range(15))
+
+    raw_df, _ = load_raw_df(path, max_frames = 5, chunksize = 4)
+
+    assert len(raw_df) == 15 and raw_df.isnull().all().all()
+
+
+def test_float32(tmp_path):
+    path = raw_txt(tmp_path / "trajectories_nogaps.txt", 30, nan_rows=[0, 1])
+    full_df, _ = load_raw_df(path)
+
+    raw_df, _ = load_raw_df(path, max_frames = 10, dtype = "float32")
+
+    assert raw_df.dtypes.unique().tolist() == [np.float32]
+    np.testing.assert_array_equal(raw_df.to_numpy(), full_df.iloc[:12].to_numpy(dtype=np.float32))
+
+
+def couple_loader(tmp_path, sv_nan_rows, tv_nan_rows, frames=40, total_frames=20):
+    loader = TrajectoriesLoader.__new__(TrajectoriesLoader)
+    loader.trajectories_SV_path = raw_txt(tmp_path / "sv.txt", frames, nan_rows=sv_nan_rows, seed=1)
+    loader.trajectories_TV_path = raw_txt(tmp_path / "tv.txt", frames, nan_rows=tv_nan_rows, seed=2)
+    loader.TOTAL_FRAMES = total_frames
+    return loader
+
+
+@pytest.mark.parametrize("sv_nan_rows, tv_nan_rows", [((), ()),
+                                                      (range(5), range(3)),
+                                                      # the joint leading nan rows are longer than those of each view,
+                                                      # more frames than read are needed
+                                                      (range(5), range(5, 10)),
+                                                      (range(0, 20, 2), range(1, 20, 2))])
+def test_couple_raw_loader(tmp_path, sv_nan_rows, tv_nan_rows):
+    loader = couple_loader(tmp_path, sv_nan_rows, tv_nan_rows)
+
+    trajectories_SV, trajectories_TV, tank_list_SV, tank_list_TV = loader.CoupleRawLoader()
+
+    expected_SV, expected_TV = couple_df_cleaner(load_raw_df(loader.trajectories_SV_path)[0],
+                                                 load_raw_df(loader.trajectories_TV_path)[0],
+                                                 limitation = loader.TOTAL_FRAMES)
+    pd.testing.assert_frame_equal(trajectories_SV, expected_SV)
+    pd.testing.assert_frame_equal(trajectories_TV, expected_TV)
+    assert len(trajectories_SV) == loader.TOTAL_FRAMES
+    assert tank_list_SV == tank_list_TV == [1, 2]
+
@@ -0,0 +1,30 @@
+"""
+Rewriting the sheets of an existing EndPoints.xlsx
+"""
+import openpyxl
+import pandas as pd
+
+from Libs.misc import ExcelReport
+
+
+def endpoints(value):
+    return pd.DataFrame({"Total Distance": [value, value + 1]}, index=["Fish 1", "Fish 2"])
+
+
+def test_rewritten_sheets_keep_their_position(tmp_path):
+    excel_path = tmp_path / "EndPoints.xlsx"
+    with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
+        for sheet_name in ["analysis", "A", "B", "A - Time Bins", "notes"]:
+            endpoints(0).to_excel(writer, sheet_name=sheet_name)
+
+    report = ExcelReport()
+    report.Add_Treatment(excel_path, "A", endpoints(10))
+    report.Add_Sheet(excel_path, "A - Time Bins", endpoints(20))
+    report.Add_Treatment(excel_path, "C", endpoints(30))
+    assert report.Write() == {excel_path: None}
+
+    book = openpyxl.load_workbook(excel_path)
+    assert book.sheetnames == ["analysis", "A", "B", "A - Time Bins", "notes", "C"]
+    assert book["A"]["B2"].value == 10
+    assert book["A - Time Bins"]["B2"].value == 20
+    assert book["B"]["B2"].value == 0
@@ -0,0 +1,186 @@
+"""
+Shoaling kernels of Libs.misc (distances and headings) against frame by frame loops
+"""
+import itertools
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.distance import pdist
+
+import Libs.misc
+from Libs.misc import nearest_neighbour_distances, mean_interindividual_distances, centroid_distances
+from Libs.misc import heading_vectors, heading_alignment, ShoalHeadingCalculator
+
+
+def shoal(frames, fish, seed=0, missing=()):
+    """
+    Coordinates (frames, fish, 3) of a shoal, missing = (frame, fish) pairs set to NaN
+    """
+    rng = np.random.default_rng(seed)
+    coords = 500 + np.cumsum(rng.normal(0, 5, size=(frames, fish, 3)), axis=0)
+    for frame, fish_index in missing:
+        coords[frame, fish_index] = np.nan
+    return coords
+
+
+# frame 1: one fish missing, frame 2: a single fish left, frame 3: every fish missing
+MISSING = [(1, 0), (2, 0), (2, 1), (2, 2), (3, 0), (3, 1), (3, 2), (3, 3), (7, 3)]
+
+
+def present(coords, frame):
+    return [fish for fish in range(coords.shape[1]) if not np.isnan(coords[frame, fish]).any()]
+
+
+def nearest_neighbour_loop(coords):
+    frames, fish, _ = coords.shape
+    nearest = np.full((frames, fish), np.nan)
+    for frame in range(frames):
+        valid = present(coords, frame)
+        for i in valid:
+            others = [np.linalg.norm(coords[frame, i] - coords[frame, j]) for j in valid if j != i]
+            if len(others) > 0:
+                nearest[frame, i] = min(others)
+    return nearest
+
+
+def mean_interindividual_loop(coords):
+    mean_distances = np.full(coords.shape[0], np.nan)
+    for frame in range(coords.shape[0]):
+        valid = present(coords, frame)
+        if len(valid) >= 2:
+            mean_distances[frame] = pdist(coords[frame, valid]).mean()
+    return mean_distances
+
+
+def centroid_loop(coords):
+    frames, fish, _ = coords.shape
+    distances = np.full((frames, fish), np.nan)
+    for frame in range(frames):
+        valid = present(coords, frame)
+        if len(valid) == 0:
+            continue
+        centroid = coords[frame, valid].mean(axis=0)
+        for i in valid:
+            distances[frame, i] = np.linalg.norm(coords[frame, i] - centroid)
+    return distances
+
+
+@pytest.mark.parametrize("engine", ["dense", "kdtree", "auto"])
+@pytest.mark.parametrize("missing", [(), MISSING])
+def test_nearest_neighbour_distances(engine, missing):
+    coords = shoal(frames=10, fish=4, missing=missing)
+
+    np.testing.assert_allclose(nearest_neighbour_distances(coords, engine = engine), nearest_neighbour_loop(coords))
+
+
+def test_nearest_neighbour_engines_agree():
+    coords = shoal(frames=20, fish=60, seed=1, missing=[(0, 5), (3, 59), (3, 0)] + [(4, fish) for fish in range(59)])
+
+    dense = nearest_neighbour_distances(coords, engine = "dense")
+    kdtree = nearest_neighbour_distances(coords, engine = "kdtree")
+
+    np.testing.assert_allclose(dense, kdtree)
+    assert np.isnan(dense[4]).all()
+    assert np.isnan(dense[0, 5]) and not np.isnan(dense[0, 4])
+
+
+def test_nearest_neighbour_in_chunks(monkeypatch):
+    coords = shoal(frames=25, fish=4, missing=MISSING)
+    expected = nearest_neighbour_distances(coords, engine = "dense")
+
+    # 3 frames of 4 x 4 distances at a time
+    monkeypatch.setattr(Libs.misc, "PAIRWISE_CHUNK_SIZE", 50)
+
+    np.testing.assert_allclose(nearest_neighbour_distances(coords, engine = "dense"), expected)
+    np.testing.assert_allclose(mean_interindividual_distances(coords), mean_interindividual_loop(coords))
+
+
+@pytest.mark.parametrize("missing", [(), MISSING])
+def test_mean_interindividual_distances(missing):
+    coords = shoal(frames=10, fish=4, missing=missing)
+
+    np.testing.assert_allclose(mean_interindividual_distances(coords), mean_interindividual_loop(coords))
+
+
+@pytest.mark.parametrize("missing", [(), MISSING])
+def test_centroid_distances(missing):
+    coords = shoal(frames=10, fish=4, missing=missing)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        distances = centroid_distances(coords)
+
+    np.testing.assert_allclose(distances, centroid_loop(coords))
+
+
+def test_single_fish():
+    coords = shoal(frames=5, fish=1)
+
+    assert np.isnan(nearest_neighbour_distances(coords)).all()
+    assert np.isnan(mean_interindividual_distances(coords)).all()
+    np.testing.assert_allclose(centroid_distances(coords), 0)
+
+
+def heading_alignment_loop(coords):
+    """
+    Polarization and mean cosine over the pairs of fishes, from the velocities of every frame
+    """
+    frames, fish, _ = coords.shape
+    polarization = np.full(frames, np.nan)
+    heading_correlation = np.full(frames, np.nan)
+    for frame in range(1, frames):
+        headings = []
+        for i in range(fish):
+            velocity = coords[frame, i] - coords[frame - 1, i]
+            speed = np.linalg.norm(velocity)
+            if not np.isnan(speed) and speed > 0:
+                headings.append(velocity / speed)
+        if len(headings) < 2:
+            continue
+        polarization[frame] = np.linalg.norm(np.mean(headings, axis=0))
+        heading_correlation[frame] = np.mean([np.dot(u, v) for u, v in itertools.combinations(headings, 2)])
+    return polarization, heading_correlation
+
+
+def still(coords, moments):
+    """
+    (frame, fish) pairs of moments where the fish does not move since the previous frame
+    """
+    coords = coords.copy()
+    for frame, fish in moments:
+        coords[frame, fish] = coords[frame - 1, fish]
+    return coords
+
+
+@pytest.mark.parametrize("case", ["plain", "missing", "stationary", "aligned"])
+def test_heading_alignment(case):
+    coords = shoal(frames=12, fish=4, seed=2)
+    if case == "missing":
+        coords = shoal(frames=12, fish=4, seed=2, missing=MISSING)
+    elif case == "stationary":
+        # frame 5: 2 fishes left with a heading, frame 6: a single one
+        coords = still(coords, [(5, 0), (5, 1), (6, 0), (6, 1), (6, 2), (9, 3)])
+    elif case == "aligned":
+        coords = np.cumsum(np.ones((12, 4, 3)), axis=0) + np.arange(4)[None, :, None]
+
+    polarization, heading_correlation = heading_alignment(heading_vectors(coords))
+    expected_polarization, expected_correlation = heading_alignment_loop(coords)
+
+    np.testing.assert_allclose(polarization, expected_polarization)
+    np.testing.assert_allclose(heading_correlation, expected_correlation, atol=1e-12)
+    assert np.isnan(polarization[0]) and np.isnan(heading_correlation[0])
+    if case == "aligned":
+        np.testing.assert_allclose(polarization[1:], 1)
+        np.testing.assert_allclose(heading_correlation[1:], 1)
+
+
+@pytest.mark.parametrize("frames", [0, 1])
+def test_heading_alignment_without_steps(frames):
+    coords = shoal(frames=frames, fish=3)
+
+    df_headings = ShoalHeadingCalculator({fish: pd.DataFrame(coords[:, fish], columns=["X", "Y", "Z"]) for fish in range(3)})
+
+    assert len(df_headings) == frames
+    assert df_headings.isnull().all().all()
@@ -0,0 +1,55 @@
+"""
+Time-binned endpoints of GeneralAnalysis.Time_Bins(), they have to add up to the endpoints of the whole session
+"""
+import numpy as np
+import pytest
+
+from Libs import ALLOWED_DECIMALS
+from Libs.executor import Fish_Analyzer
+
+
+# The bins are rounded to ALLOWED_DECIMALS
+TOLERANCE = 10 ** -ALLOWED_DECIMALS
+
+
+@pytest.mark.parametrize("bin_seconds", [60, 20, 25])
+def test_bins_add_up_to_the_session(saved_project, bin_seconds):
+    project_dir, params = saved_project()
+
+    _, fish, endpoints, _ = Fish_Analyzer(project_dir, 1, "A", 1, params, endpoint_cache = False, time_bins = bin_seconds)
+    time_bins = fish.time_bins
+
+    bin_frames = bin_seconds * params["FRAME RATE"]
+    frames_per_bin = np.diff(np.append(np.arange(0, fish.TOTAL_FRAMES, bin_frames), fish.TOTAL_FRAMES))
+    steps_per_bin = frames_per_bin.copy()
+    steps_per_bin[-1] -= 1
+    # the last bin is shorter when bin_seconds does not divide the duration (25 s bins: 25, 25, 10 s)
+    assert len(time_bins) == int(np.ceil(params["DURATION"] / bin_seconds))
+    assert frames_per_bin.sum() == fish.TOTAL_FRAMES
+
+    def session_value(name):
+        return endpoints[name]["value"]
+
+    assert time_bins["Distance (cm)"].sum() == pytest.approx(session_value("Total Distance"), abs = len(time_bins) * TOLERANCE)
+    assert time_bins["Entries to the Top (times)"].sum() == session_value("Total entries to the Top")
+
+    # Percentages are per frame of the bin, Average Speed per step (one step less than frames in the last bin)
+    for name, session_name in [("Time in Top (%)", "Time in Top"),
+                               ("Time in Middle (%)", "Time in Middle"),
+                               ("Time in Bottom (%)", "Time in Bottom"),
+                               ("Freezing Time (%)", "Freezing Time"),
+                               ("Swimming Time (%)", "Swimming Time"),
+                               ("Rapid Movement Time (%)", "Rapid Movement Time")]:
+        weighted = (time_bins[name] * frames_per_bin).sum() / fish.TOTAL_FRAMES
+        assert weighted == pytest.approx(session_value(session_name), abs = 2 * TOLERANCE)
+
+    weighted_speed = (time_bins["Average Speed (cm/s)"] * steps_per_bin).sum() / steps_per_bin.sum()
+    assert weighted_speed == pytest.approx(session_value("Average Speed"), abs = 2 * TOLERANCE)
+
+
+def test_bin_labels(saved_project):
+    project_dir, params = saved_project()
+
+    _, fish, _, _ = Fish_Analyzer(project_dir, 1, "A", 1, params, endpoint_cache = False, time_bins = 25)
+
+    assert list(fish.time_bins.index) == ["0-25 s", "25-50 s", "50-60 s"]
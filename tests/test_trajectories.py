@@ -0,0 +1,88 @@
+"""
+Backup of the saved trajectories while they are rebuilt
+"""
+from Libs.executor import Executor
+from Libs.general import trajectories_dirs, backup_trajectories, restore_trajectories, discard_trajectories_backup
+from Libs.misc import get_working_dir, get_trajectories_dir, load_manifest, trajectory_files
+
+
+def saved_trajectories(tmp_path):
+    dirs = trajectories_dirs(tmp_path, 1, "A")
+    for directory in dirs.values():
+        directory.mkdir(parents=True)
+        for name in ["Fish 1.npy", "Fish 1.json", "manifest.json", "trajectories_Y_pre-arranged.png"]:
+            (directory / name).write_text(f"old {name}")
+    return dirs
+
+
+def test_restore_after_failed_rebuild(tmp_path):
+    dirs = saved_trajectories(tmp_path)
+
+    backup_dir = backup_trajectories(tmp_path, 1, "A")
+    for directory in dirs.values():
+        assert trajectory_files(directory) == []
+        # other files stay in place
+        assert (directory / "trajectories_Y_pre-arranged.png").exists()
+
+    # partial rebuild
+    (dirs["trajectories"] / "Fish 1.npy").write_text("new")
+    restore_trajectories(tmp_path, 1, "A", backup_dir)
+
+    for directory in dirs.values():
+        assert sorted(path.name for path in trajectory_files(directory)) == ["Fish 1.json", "Fish 1.npy", "manifest.json"]
+        assert (directory / "Fish 1.npy").read_text() == "old Fish 1.npy"
+    assert not backup_dir.exists()
+
+
+def test_discard_after_rebuild(tmp_path):
+    dirs = saved_trajectories(tmp_path)
+
+    backup_dir = backup_trajectories(tmp_path, 1, "A")
+    (dirs["trajectories"] / "Fish 1.npy").write_text("new")
+    discard_trajectories_backup(backup_dir)
+
+    assert (dirs["trajectories"] / "Fish 1.npy").read_text() == "new"
+    assert not backup_dir.exists()
+
+
+def test_backup_without_trajectories(tmp_path):
+    backup_dir = backup_trajectories(tmp_path, 1, "A")
+    restore_trajectories(tmp_path, 1, "A", backup_dir)
+
+    assert not backup_dir.exists()
+
+
+def loaded(project_dir):
+    executor = Executor(project_dir = project_dir, batch_num = 1, treatment_char = "A")
+    assert executor.PARAMS_LOADING() is None
+    executor.TRAJECTORIES_LOADING()
+    return executor
+
+
+def test_saved_trajectories_without_manifest_are_kept(saved_project):
+    project_dir, _ = saved_project(fishes = 2)
+    for view in ["Side View", "Top View"]:
+        raw_dir = get_working_dir(project_dir, 1) / "A - Control" / view
+        raw_dir.mkdir(parents = True)
+        (raw_dir / "trajectories_nogaps.txt").write_text(f"X1\tY1\n{view}\n")
+
+    trajectories_dir = get_trajectories_dir(project_dir, 1, "A")
+    saved = {path.name: path.read_bytes() for path in trajectory_files(trajectories_dir)}
+
+    executor = loaded(project_dir)
+
+    # the trajectories are not rebuilt (it would fail on these raw files), a manifest is recorded for them
+    assert {path.name: path.read_bytes() for path in trajectory_files(trajectories_dir) if path.name != "manifest.json"} == saved
+    manifest = load_manifest(trajectories_dir)
+    assert manifest["fishes"] == 2 and manifest["store"] == "csv"
+    assert not executor.trajectories_outdated()
+
+
+def test_missing_raw_trajectories(saved_project):
+    project_dir, _ = saved_project(fishes = 2)
+    trajectories_dir = get_trajectories_dir(project_dir, 1, "A")
+    saved = {path.name: path.read_bytes() for path in trajectory_files(trajectories_dir)}
+
+    loaded(project_dir)
+
+    assert {path.name: path.read_bytes() for path in trajectory_files(trajectories_dir)} == saved